@@ -1,15 +1,25 @@
 from __future__ import with_statement
+import contextlib
 import os
 import itertools
 import functools
+import hashlib
 import operator
-import requests
+import random
 import sys
 import tarfile
 import time
 from datetime import datetime
 import json
+import threading
+import urllib
 import zipfile
+from urlparse import urlparse, urlunparse, parse_qsl
+from datimhttpclient import DatimHttpClient
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class DatimBase:
@@ -38,6 +48,29 @@ class DatimBase:
     REPO_STEM_SOURCES = 'sources'
     REPO_STEM_COLLECTIONS = 'collections'
 
+    # Name of the JSON file inside of an OCL export zip
+    OCL_EXPORT_ZIP_MEMBER_NAME = 'export.json'
+
+    # OCL export generation polling settings (in seconds). OCL returns 204 if an export does not exist yet
+    # and 208 while it is being generated.
+    OCL_EXPORT_NOT_READY_STATUS_CODES = [204, 208]
+    OCL_EXPORT_POLL_INITIAL_DELAY = 2
+    OCL_EXPORT_POLL_MAX_DELAY = 60
+    OCL_EXPORT_POLL_TIMEOUT = 1800
+    OCL_EXPORT_POLL_WORKERS = 8
+    OCL_EXPORT_POLL_ABORT_INTERVAL = 1
+
+    # Records the repository version and content hash of each downloaded OCL export so unchanged exports are
+    # not downloaded again
+    OCL_EXPORT_MANIFEST_FILENAME = 'ocl_export_manifest.json'
+
+    # Records the repositories that an import may have changed since their latest version, whose released exports
+    # are therefore not known to be current
+    OCL_UNVERSIONED_REPOS_FILENAME = 'ocl_unversioned_repos.json'
+
+    # Number of pages of a paged OCL or DHIS2 response that are requested at the same time
+    PAGED_FETCH_WORKERS = 4
+
     __location__ = os.path.realpath(
         os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -51,25 +84,19 @@ class DatimBase:
         self.dhis2pwd = ''
         self.ocl_dataset_repos = None
         self.str_active_dataset_ids = ''
+        self.http_client = DatimHttpClient.get_shared_client()
+        self._ocl_export_manifest = None
+        self._ocl_export_manifest_lock = threading.Lock()
 
     def vlog(self, verbose_level=0, *args):
         """ Output log information if verbosity setting is equal or greater than this verbose level """
         if self.verbosity < verbose_level:
             return
-        sys.stdout.write('[' + str(datetime.now()) + '] ')
-        for arg in args:
-            sys.stdout.write(str(arg))
-            sys.stdout.write(' ')
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+        self.log(*args)
 
     def log(self, *args):
-        """ Output log information """
-        sys.stdout.write('[' + str(datetime.now()) + '] ')
-        for arg in args:
-            sys.stdout.write(str(arg))
-            sys.stdout.write(' ')
-        sys.stdout.write('\n')
+        """ Output log information -- written as a single line so that output from concurrent steps does not mix """
+        sys.stdout.write('[' + str(datetime.now()) + '] ' + ''.join([str(arg) + ' ' for arg in args]) + '\n')
         sys.stdout.flush()
 
     def _convert_endpoint_to_filename_fmt(seld, endpoint):
@@ -83,9 +110,6 @@ class DatimBase:
     def endpoint2filename_ocl_export_tar(self, endpoint):
         return 'ocl-' + self._convert_endpoint_to_filename_fmt(endpoint) + '.zip'
 
-    def endpoint2filename_ocl_export_json(self, endpoint):
-        return 'ocl-' + self._convert_endpoint_to_filename_fmt(endpoint) + '-raw.json'
-
     def endpoint2filename_ocl_export_intermediate_json(self, endpoint):
         return 'ocl-' + self._convert_endpoint_to_filename_fmt(endpoint) + '-intermediate.json'
 
@@ -124,26 +148,57 @@ class DatimBase:
         """ Adds full absolute path to the filename """
         return os.path.join(self.__location__, filename)
 
+    def add_query_params(self, url, query_params):
+        """ Returns the URL with the specified query parameters added, replacing any existing values """
+        parsed_url = urlparse(url)
+        params = [(k, v) for k, v in parse_qsl(parsed_url.query, keep_blank_values=True) if k not in query_params]
+        params += sorted(query_params.items())
+        return urlunparse(parsed_url._replace(query=urllib.urlencode(params)))
+
+    def fetch_pages(self, fetch_page, get_num_pages, num_workers=None):
+        """
+        Fetches the first page of a paged response, reads the total number of pages from it, and then fetches
+        the remaining pages concurrently
+        :param fetch_page: Callable that accepts a 1-based page number and returns that page
+        :param get_num_pages: Callable that accepts the first page and returns the total number of pages
+        :param num_workers: Maximum number of pages to fetch at the same time. Defaults to PAGED_FETCH_WORKERS.
+        :return: list of pages in page order
+        """
+        first_page = fetch_page(1)
+        num_pages = get_num_pages(first_page)
+        if num_pages > 1:
+            self.vlog(1, 'Fetching %s more pages...' % (num_pages - 1))
+        return [first_page] + self.map_concurrently(
+            fetch_page, range(2, num_pages + 1), num_workers=num_workers or self.PAGED_FETCH_WORKERS)
+
     def get_ocl_repositories(self, endpoint=None, key_field='id', require_external_id=True,
                              active_attr_name='__datim_sync'):
         """
         Gets repositories from OCL using the provided URL, optionally filtering
-        by external_id and a custom attribute indicating active status
+        by external_id and a custom attribute indicating active status.
+        All pages are requested concurrently once the first page reports the total number of repositories.
         """
-        filtered_repos = {}
-        next_url = self.oclenv + endpoint
-        while next_url:
-            response = requests.get(next_url, headers=self.oclapiheaders)
+        url = self.oclenv + endpoint
+
+        def fetch_page(page):
+            response = self.http_client.get(self.add_query_params(url, {'page': page}), headers=self.oclapiheaders)
             response.raise_for_status()
-            repos = response.json()
-            for repo in repos:
+            return response
+
+        def get_num_pages(response):
+            page_size = int(dict(parse_qsl(urlparse(url).query)).get('limit') or
+                            response.headers.get('num_returned') or 0)
+            if not page_size or 'num_found' not in response.headers:
+                return 1
+            return (int(response.headers['num_found']) + page_size - 1) // page_size
+
+        filtered_repos = {}
+        for response in self.fetch_pages(fetch_page, get_num_pages):
+            for repo in response.json():
                 if (not require_external_id or ('external_id' in repo and repo['external_id'])) and (
                             not active_attr_name or (repo['extras'] and active_attr_name in repo['extras'] and repo[
                             'extras'][active_attr_name])):
                     filtered_repos[repo[key_field]] = repo
-            next_url = ''
-            if 'next' in response.headers and response.headers['next'] and response.headers['next'] != 'None':
-                next_url = response.headers['next']
         return filtered_repos
 
     def load_datasets_from_ocl(self):
@@ -171,6 +226,117 @@ class DatimBase:
             self.log('ERROR: No dataset IDs returned from OCL. Exiting...')
             sys.exit(1)
 
+    def get_file_hash(self, filename):
+        """ Returns the SHA-1 hex digest of the contents of the specified file """
+        file_hash = hashlib.sha1()
+        with open(self.attach_absolute_path(filename), 'rb') as input_file:
+            for block in iter(functools.partial(input_file.read, 1024 * 1024), ''):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    def load_ocl_export_manifest(self):
+        """ Loads the manifest of previously downloaded OCL exports, keyed by OCL environment and endpoint """
+        with self._ocl_export_manifest_lock:
+            if self._ocl_export_manifest is None:
+                self._ocl_export_manifest = self.read_shared_json_file(self.OCL_EXPORT_MANIFEST_FILENAME)
+            return self._ocl_export_manifest
+
+    def read_shared_json_file(self, filename):
+        """ Returns the contents of a JSON file shared by concurrent syncs, or {} if it is missing or invalid """
+        file_path = self.attach_absolute_path(filename)
+        if os.path.isfile(file_path):
+            try:
+                with open(file_path, 'rb') as handle:
+                    return json.load(handle)
+            except ValueError:
+                self.log('WARNING: Ignoring invalid file "%s"' % filename)
+        return {}
+
+    def update_shared_json_file(self, filename, update):
+        """
+        Re-reads a JSON file that is shared by concurrent MER, SIMS and Mechanisms syncs, applies update(contents)
+        and replaces the file, while holding a lock on a separate lock file so that concurrent updates are merged
+        instead of overwriting each other
+        :param filename: Name of the JSON file
+        :param update: Callable that is passed the current contents (a dict) and modifies them in place
+        :return: dict Updated contents
+        """
+        file_path = self.attach_absolute_path(filename)
+        with open(file_path + '.lock', 'a+') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                contents = self.read_shared_json_file(filename)
+                update(contents)
+                tmp_path = '%s.%s.tmp' % (file_path, os.getpid())
+                with open(tmp_path, 'wb') as output_file:
+                    output_file.write(json.dumps(contents, indent=2, sort_keys=True))
+                os.rename(tmp_path, file_path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return contents
+
+    def update_ocl_export_manifest(self, endpoint='', repo_version_id='', zipfilename=''):
+        """
+        Records a successfully downloaded OCL export in the manifest and saves the manifest to file. The manifest is
+        shared by concurrent syncs, so the entry is merged into the manifest currently saved to file.
+        """
+        manifest_entry = {
+            'oclenv': self.oclenv,
+            'endpoint': endpoint,
+            'repo_version_id': repo_version_id,
+            'zipfilename': zipfilename,
+            'sha1': self.get_file_hash(zipfilename),
+            'downloaded': str(datetime.now()),
+        }
+        self.load_ocl_export_manifest()
+        with self._ocl_export_manifest_lock:
+            manifest = self.update_shared_json_file(
+                self.OCL_EXPORT_MANIFEST_FILENAME,
+                lambda contents: contents.update({self.oclenv + endpoint: manifest_entry}))
+            self._ocl_export_manifest.update(manifest)
+
+    def get_unversioned_ocl_repos(self):
+        """
+        Returns the endpoints of the repositories in this OCL environment that an import may have changed since
+        their latest version was created, e.g. because the import stopped before STEP 12
+        :return: set of repository endpoints
+        """
+        return set(entry['endpoint'] for entry in self.read_shared_json_file(
+            self.OCL_UNVERSIONED_REPOS_FILENAME).values() if entry['oclenv'] == self.oclenv)
+
+    def update_unversioned_ocl_repos(self, add_endpoints=None, remove_endpoints=None):
+        """
+        Records repositories that an import is about to change and removes repositories whose changes have all
+        been versioned (or that the import did not change)
+        :param add_endpoints: Endpoints of the repositories to add, e.g. ['/orgs/PEPFAR/sources/MER/']
+        :param remove_endpoints: Endpoints of the repositories to remove
+        :return: None
+        """
+        def update(unversioned_repos):
+            for endpoint in add_endpoints or []:
+                unversioned_repos[self.oclenv + endpoint] = {
+                    'oclenv': self.oclenv, 'endpoint': endpoint, 'since': str(datetime.now())}
+            for endpoint in remove_endpoints or []:
+                unversioned_repos.pop(self.oclenv + endpoint, None)
+
+        self.update_shared_json_file(self.OCL_UNVERSIONED_REPOS_FILENAME, update)
+
+    def is_ocl_export_unchanged(self, endpoint='', repo_version_id='', zipfilename=''):
+        """
+        Returns whether the local copy of an OCL export is already the specified repository version, according
+        to the manifest, and has not been modified since it was downloaded
+        """
+        manifest_entry = self.load_ocl_export_manifest().get(self.oclenv + endpoint)
+        if (not manifest_entry or manifest_entry['repo_version_id'] != repo_version_id or
+                manifest_entry.get('zipfilename') != zipfilename or
+                not os.path.isfile(self.attach_absolute_path(zipfilename)) or
+                self.get_file_hash(zipfilename) != manifest_entry['sha1']):
+            return False
+        self.vlog(1, 'SKIPPING: Local export "%s" is already version "%s"' % (zipfilename, repo_version_id))
+        return True
+
     def filecmp(self, filename1, filename2):
         """
         Do the two files have exactly the same size and contents?
@@ -194,10 +360,11 @@ class DatimBase:
         """
         Increment version for OCL repositories that were modified according to the provided import results object
         :param import_results:
-        :return:
+        :return: list of the endpoints of the repositories that were versioned
         """
         dt = datetime.utcnow()
         cnt = 0
+        versioned_endpoints = []
         for ocl_export_key, ocl_export_def in self.OCL_EXPORT_DEFS.iteritems():
             cnt += 1
 
@@ -222,71 +389,214 @@ class DatimBase:
             new_repo_version_url = self.oclenv + repo_version_endpoint
             self.vlog(1, 'Create new repo version request URL:', new_repo_version_url)
             self.vlog(1, json.dumps(new_repo_version_data))
-            r = requests.post(new_repo_version_url,
-                              data=json.dumps(new_repo_version_data),
-                              headers=self.oclapiheaders)
+            r = self.http_client.post(new_repo_version_url,
+                                      data=json.dumps(new_repo_version_data),
+                                      headers=self.oclapiheaders)
             r.raise_for_status()
             repo_version_endpoint = str(ocl_export_def['endpoint']) + str(new_repo_version_data['id']) + '/'
             self.vlog(1, '[OCL Export %s of %s] %s: Created new repository version "%s"' % (
                 cnt, len(self.OCL_EXPORT_DEFS), ocl_export_key, repo_version_endpoint))
+            versioned_endpoints.append(ocl_export_endpoint)
+        return versioned_endpoints
 
-    def get_ocl_export(self, endpoint='', version='', zipfilename='', jsonfilename=''):
+    def get_ocl_repo_version_id(self, endpoint='', version=''):
         """
-        Fetches an export of the specified repository version and saves to file.
-        Use version="latest" to fetch the most recent released repo version.
-        Note that the export must already exist before using this method.
+        Returns the ID of the specified repository version, resolving "latest" to the most recent released version
         :param endpoint: endpoint must point to the repo endpoint only, e.g. '/orgs/myorg/sources/mysource/'
         :param version: repo version ID or "latest"
-        :param zipfilename: Filename to save the compressed OCL export to
-        :param jsonfilename: Filename to save the decompressed OCL-JSON export to
-        :return: bool True upon success; False otherwise
+        :return: str Repository version ID
         """
-        # Get the latest version of the repo
-        if version == 'latest':
-            url_latest_version = self.oclenv + endpoint + 'latest/'
-            self.vlog(1, 'Latest version request URL:', url_latest_version)
-            r = requests.get(url_latest_version)
-            r.raise_for_status()
-            latest_version_attr = r.json()
-            repo_version_id = latest_version_attr['id']
-            self.vlog(1, 'Latest version ID:', repo_version_id)
-        else:
-            repo_version_id = version
+        if version != 'latest':
+            return version
+        url_latest_version = self.oclenv + endpoint + 'latest/'
+        self.vlog(1, 'Latest version request URL:', url_latest_version)
+        r = self.http_client.get(url_latest_version)
+        r.raise_for_status()
+        latest_version_attr = r.json()
+        repo_version_id = latest_version_attr['id']
+        self.vlog(1, 'Latest version ID:', repo_version_id)
+        return repo_version_id
 
-        # Get the export
+    def is_ocl_export_ready(self, endpoint='', repo_version_id=''):
+        """
+        Returns whether the export of the specified repository version is ready to download, without downloading it
+        :param endpoint: endpoint must point to the repo endpoint only, e.g. '/orgs/myorg/sources/mysource/'
+        :param repo_version_id: repo version ID
+        :return: bool
+        """
         url_ocl_export = self.oclenv + endpoint + repo_version_id + '/export/'
-        self.vlog(1, 'Export URL:', url_ocl_export)
-        r = requests.get(url_ocl_export)
+        r = self.http_client.get(url_ocl_export, allow_redirects=False, stream=True)
+        r.close()
         r.raise_for_status()
-        if r.status_code == 204:
-            # Create the export and try one more time...
-            self.log('WARNING: Export does not exist for "%s". Creating export...' % url_ocl_export)
-            new_export_request = requests.post(url_ocl_export)
-            if new_export_request.status_code == 202:
-                # Wait for export to be processed then try to fetch it
-                self.log('INFO: Waiting 30 seconds while export is being generated...')
-                time.sleep(30)
-                r = requests.get(url_ocl_export)
-                r.raise_for_status()
-            else:
-                self.log('ERROR: Unable to generate export for "%s"' % url_ocl_export)
-                sys.exit(1)
+        return r.status_code not in self.OCL_EXPORT_NOT_READY_STATUS_CODES
 
-        # Write tar'd export to file
-        with open(self.attach_absolute_path(zipfilename), 'wb') as handle:
-            for block in r.iter_content(1024):
-                handle.write(block)
-        self.vlog(1, '%s bytes saved to "%s"' % (r.headers['Content-Length'], zipfilename))
+    def request_ocl_export(self, endpoint='', repo_version_id=''):
+        """
+        Checks whether the export of the specified repository version exists and, if not, asks OCL to generate it
+        :param endpoint: endpoint must point to the repo endpoint only, e.g. '/orgs/myorg/sources/mysource/'
+        :param repo_version_id: repo version ID
+        :return: bool True if the export is ready now; False if it is being generated
+        """
+        url_ocl_export = self.oclenv + endpoint + repo_version_id + '/export/'
+        self.vlog(1, 'Export URL:', url_ocl_export)
+        if self.is_ocl_export_ready(endpoint=endpoint, repo_version_id=repo_version_id):
+            return True
+        self.log('WARNING: Export does not exist for "%s". Creating export...' % url_ocl_export)
+        new_export_request = self.http_client.post(url_ocl_export, headers=self.oclapiheaders)
+        if new_export_request.status_code not in [202, 409]:
+            # 202: Export generation queued; 409: Export generation already in progress
+            self.log('ERROR: Unable to generate export for "%s"' % url_ocl_export)
+            sys.exit(1)
+        return False
 
-        # Decompress the tar and rename
-        zip_ref = zipfile.ZipFile(self.attach_absolute_path(zipfilename), 'r')
-        zip_ref.extractall(self.__location__)
-        zip_ref.close()
-        os.rename(self.attach_absolute_path('export.json'), self.attach_absolute_path(jsonfilename))
-        self.vlog(1, 'Export decompressed to "%s"' % jsonfilename)
+    def wait_for_ocl_exports(self, export_requests, export_ready_callback=None, abort_check=None):
+        """
+        Polls OCL until each of the requested exports is ready. Due exports are checked concurrently and each
+        export backs off exponentially (with jitter) between checks. Exits if any export is not ready in time.
+        :param export_requests: List of dicts, each with at least an "endpoint" and "repo_version_id"
+        :param export_ready_callback: Optional callable that is passed each export request as soon as it is ready
+        :param abort_check: Optional callable that is called at least every OCL_EXPORT_POLL_ABORT_INTERVAL
+            seconds and raises to stop waiting, e.g. when the sync was stopped by another step
+        :return: None
+        """
+        pending = list(export_requests)
+        time_started = time.time()
+        for export_request in pending:
+            export_request['poll_delay'] = self.OCL_EXPORT_POLL_INITIAL_DELAY
+            export_request['poll_next_check'] = time_started + self.OCL_EXPORT_POLL_INITIAL_DELAY
+        if pending:
+            self.vlog(1, 'Waiting for %s OCL export(s) to be generated...' % len(pending))
+        while pending:
+            if abort_check:
+                abort_check()
+            now = time.time()
+            due = [export_request for export_request in pending if export_request['poll_next_check'] <= now]
+            if due:
+                ready_results = self.map_concurrently(
+                    lambda export_request: self.is_ocl_export_ready(
+                        endpoint=export_request['endpoint'], repo_version_id=export_request['repo_version_id']),
+                    due, num_workers=self.OCL_EXPORT_POLL_WORKERS)
+                for export_request, is_ready in zip(due, ready_results):
+                    if is_ready:
+                        self.vlog(1, 'OCL export ready after %.0f seconds: %s%s/' % (
+                            time.time() - time_started, export_request['endpoint'],
+                            export_request['repo_version_id']))
+                        pending.remove(export_request)
+                        if export_ready_callback:
+                            export_ready_callback(export_request)
+                    else:
+                        export_request['poll_delay'] = min(
+                            export_request['poll_delay'] * 2, self.OCL_EXPORT_POLL_MAX_DELAY)
+                        export_request['poll_next_check'] = time.time() + random.uniform(
+                            export_request['poll_delay'] / 2.0, export_request['poll_delay'])
+            if not pending:
+                break
+            if time.time() - time_started > self.OCL_EXPORT_POLL_TIMEOUT:
+                for export_request in pending:
+                    self.log('ERROR: Export for "%s%s/" was not generated within %s seconds' % (
+                        export_request['endpoint'], export_request['repo_version_id'], self.OCL_EXPORT_POLL_TIMEOUT))
+                sys.exit(1)
+            delay = max(0, min([export_request['poll_next_check'] for export_request in pending]) - time.time())
+            if abort_check:
+                delay = min(delay, self.OCL_EXPORT_POLL_ABORT_INTERVAL)
+            time.sleep(delay)
+
+    def download_ocl_export(self, endpoint='', repo_version_id='', zipfilename=''):
+        """
+        Downloads an export of the specified repository version that is ready and saves it to file.
+        The export is kept compressed -- use open_ocl_export to read it.
+        :param endpoint: endpoint must point to the repo endpoint only, e.g. '/orgs/myorg/sources/mysource/'
+        :param repo_version_id: repo version ID
+        :param zipfilename: Filename to save the compressed OCL export to
+        :return: bool True upon success; False otherwise
+        """
+        url_ocl_export = self.oclenv + endpoint + repo_version_id + '/export/'
+        r = self.http_client.download(url_ocl_export, self.attach_absolute_path(zipfilename))
+        r.raise_for_status()
+        self.vlog(1, '%s bytes saved to "%s"' % (os.path.getsize(self.attach_absolute_path(zipfilename)), zipfilename))
+        self.update_ocl_export_manifest(endpoint=endpoint, repo_version_id=repo_version_id, zipfilename=zipfilename)
 
         return True
 
+    @contextlib.contextmanager
+    def open_ocl_export(self, zipfilename=''):
+        """
+        Opens the OCL-JSON export inside of a downloaded export zip for reading, without extracting it to disk.
+        Use as a context manager, e.g.: with self.open_ocl_export(zipfilename) as export_file: json.load(export_file)
+        :param zipfilename: Filename of the compressed OCL export
+        :return: file-like object streaming the decompressed OCL-JSON export
+        """
+        zip_ref = zipfile.ZipFile(self.attach_absolute_path(zipfilename), 'r')
+        try:
+            export_file = zip_ref.open(self.OCL_EXPORT_ZIP_MEMBER_NAME)
+            try:
+                yield export_file
+            finally:
+                export_file.close()
+        finally:
+            zip_ref.close()
+
+    def get_ocl_export(self, endpoint='', version='', zipfilename=''):
+        """
+        Fetches an export of the specified repository version and saves to file.
+        Use version="latest" to fetch the most recent released repo version.
+        If the export does not exist yet, it is generated and polled until ready.
+        :param endpoint: endpoint must point to the repo endpoint only, e.g. '/orgs/myorg/sources/mysource/'
+        :param version: repo version ID or "latest"
+        :param zipfilename: Filename to save the compressed OCL export to
+        :return: bool True upon success; False otherwise
+        """
+        repo_version_id = self.get_ocl_repo_version_id(endpoint=endpoint, version=version)
+        if self.is_ocl_export_unchanged(endpoint=endpoint, repo_version_id=repo_version_id, zipfilename=zipfilename):
+            return True
+        if not self.request_ocl_export(endpoint=endpoint, repo_version_id=repo_version_id):
+            self.wait_for_ocl_exports([{'endpoint': endpoint, 'repo_version_id': repo_version_id}])
+        return self.download_ocl_export(endpoint=endpoint, repo_version_id=repo_version_id, zipfilename=zipfilename)
+
+    def map_concurrently(self, func, items, num_workers=1):
+        """
+        Calls func once for each item using a bounded pool of worker threads and returns the results in the
+        same order as items. Items may be any iterable, including a queue that is still being filled. If any
+        call fails (including calls to sys.exit), no new items are started and the first error is re-raised
+        in the calling thread once the running calls have finished.
+        :param func: Callable that accepts a single item
+        :param items: Iterable of items to process
+        :param num_workers: Maximum number of items to process at the same time
+        :return: list of results
+        """
+        if isinstance(items, (list, tuple)):
+            num_workers = min(num_workers, len(items))
+        item_iterator = enumerate(items)
+        results = {}
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    with lock:
+                        if errors:
+                            return
+                        i, item = next(item_iterator)
+                    results[i] = func(item)
+                except StopIteration:
+                    return
+                except BaseException:
+                    with lock:
+                        errors.append(sys.exc_info())
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, num_workers))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return [results[i] for i in sorted(results)]
+
     def find_nth(self, haystack, needle, n):
         """ Find nth occurence of a substring within a string """
         start = haystack.find(needle)
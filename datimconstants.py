@@ -28,20 +28,24 @@ class DatimConstants:
     MER_PRESENTATION_SORT_COLUMN = 4
     SIMS_PRESENTATION_SORT_COLUMN = 2
 
-    # SIMS DHIS2 Queries
+    # SIMS DHIS2 Queries. Paged queries must end their order with the unique id, so that records with the same
+    # (or no) code or name cannot move between pages.
     SIMS_DHIS2_QUERIES = {
         'SimsAssessmentTypes': {
             'id': 'SimsAssessmentTypes',
             'name': 'DATIM-DHIS2 SIMS Assessment Types',
             'query': 'api/dataElements.json?fields=name,code,id,valueType,lastUpdated,dataElementGroups[id,name]&'
-                     'order=code:asc&paging=false&filter=dataElementGroups.id:in:[{{active_dataset_ids}}]',
+                     'order=code:asc,id:asc&filter=dataElementGroups.id:in:[{{active_dataset_ids}}]',
+            'paged': True,
+            'chunk_attr': 'active_dataset_ids',
             'conversion_method': 'dhis2diff_sims_assessment_types'
         },
         'SimsOptionSets': {
             'id': 'SimsOptionSets',
             'name': 'DATIM-DHIS2 SIMS Option Sets',
             'query': 'api/optionSets/?fields=id,name,lastUpdated,options[id,code,name]&'
-                     'filter=name:like:SIMS%20v2&paging=false&order=name:asc',
+                     'filter=name:like:SIMS%20v2&order=name:asc,id:asc',
+            'paged': True,
             'conversion_method': 'dhis2diff_sims_option_sets'
         }
     }
@@ -55,7 +59,9 @@ class DatimConstants:
                      'categoryCombo[id,code,name,lastUpdated,created,'
                      'categoryOptionCombos[id,code,name,lastUpdated,created]],'
                      'dataSetElements[*,dataSet[id,name,shortName]]&'
-                     'paging=false&filter=dataSetElements.dataSet.id:in:[{{active_dataset_ids}}]',
+                     'order=id:asc&filter=dataSetElements.dataSet.id:in:[{{active_dataset_ids}}]',
+            'paged': True,
+            'chunk_attr': 'active_dataset_ids',
             'conversion_method': 'dhis2diff_mer'
         }
     }
@@ -67,7 +73,9 @@ class DatimConstants:
             'name': 'DATIM-DHIS2 Funding Mechanisms',
             'query': 'api/categoryOptionCombos.json?fields=id,code,name,created,lastUpdated,'
                      'categoryOptions[id,endDate,startDate,organisationUnits[code,name],'
-                     'categoryOptionGroups[id,name,code,groupSets[id,name]]]&order=code:asc&filter=categoryCombo.id:eq:wUpfppgjEza&paging=false',
+                     'categoryOptionGroups[id,name,code,groupSets[id,name]]]&order=code:asc,id:asc&'
+                     'filter=categoryCombo.id:eq:wUpfppgjEza',
+            'paged': True,
             'conversion_method': 'dhis2diff_mechanisms'
         }
     }
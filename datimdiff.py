@@ -0,0 +1,113 @@
+"""
+Keyed diff of the OCL and DHIS2 resources prepared for a sync
+
+Both sides of the diff are dictionaries of resources keyed by URL, so added and removed resources are found with
+set operations on the keys. A resource present on both sides is unchanged if it is equal to its counterpart or if
+both have the same canonical content hash, which ignores the order of lists and the order of dictionary keys.
+Field-level changes are only computed for the remaining, changed resources. The result has the same shape as
+DeepDiff(t1, t2, ignore_order=True, verbose_level=2): dictionary_item_added, dictionary_item_removed,
+values_changed, type_changes, iterable_item_added and iterable_item_removed, each keyed by a path such as
+"root['/orgs/PEPFAR/sources/MER/concepts/TX_CURR/']['names'][0]". As in DeepDiff, changed list items are reported
+as one removed and one added item at their index in the old and new list.
+
+Values that compare equal in Python (e.g. 1 and 1.0, or 'a' and u'a') are treated as unchanged, whereas DeepDiff
+reports a type change. This makes no difference for resources loaded from JSON.
+"""
+import difflib
+import hashlib
+import json
+
+
+class DatimKeyedDiff(dict):
+    """ Diff of two dictionaries of resources keyed by URL, in the format of DeepDiff with ignore_order=True """
+
+    ROOT_PATH = 'root'
+
+    def __init__(self, t1, t2):
+        """
+        :param t1: Old resources, e.g. the cleaned OCL export, keyed by URL
+        :param t2: New resources, e.g. the converted DHIS2 export, keyed by URL
+        """
+        dict.__init__(self)
+        self.num_unchanged = 0
+        t1_keys = set(t1)
+        t2_keys = set(t2)
+        for key in t2_keys - t1_keys:
+            self.report('dictionary_item_added', self.get_path(self.ROOT_PATH, key), t2[key])
+        for key in t1_keys - t2_keys:
+            self.report('dictionary_item_removed', self.get_path(self.ROOT_PATH, key), t1[key])
+        for key in t1_keys & t2_keys:
+            if self.is_changed(t1[key], t2[key]):
+                self.diff_values(self.get_path(self.ROOT_PATH, key), t1[key], t2[key])
+            else:
+                self.num_unchanged += 1
+
+    @staticmethod
+    def get_path(parent_path, key):
+        if isinstance(key, basestring):
+            return "%s['%s']" % (parent_path, key)
+        return '%s[%s]' % (parent_path, key)
+
+    @classmethod
+    def get_canonical_json(cls, value):
+        """ Returns a JSON representation of the value that does not depend on the order of lists and keys """
+        if isinstance(value, dict):
+            return '{%s}' % ','.join(sorted(
+                '%s:%s' % (json.dumps(k), cls.get_canonical_json(v)) for k, v in value.iteritems()))
+        elif isinstance(value, (list, tuple)):
+            return '[%s]' % ','.join(sorted(cls.get_canonical_json(item) for item in value))
+        return json.dumps(value)
+
+    @classmethod
+    def get_content_hash(cls, value):
+        return hashlib.sha1(cls.get_canonical_json(value)).digest()
+
+    def is_changed(self, t1, t2):
+        """ Returns whether two versions of a resource differ, ignoring the order of lists """
+        if t1 is t2 or t1 == t2:
+            return False
+        return self.get_content_hash(t1) != self.get_content_hash(t2)
+
+    def report(self, report_type, path, change):
+        self.setdefault(report_type, {})[path] = change
+
+    def diff_values(self, path, t1, t2):
+        """ Reports the differences between the old and new value at the path """
+        if t1 is t2 or t1 == t2:
+            return
+        if type(t1) is not type(t2):
+            self.report('type_changes', path, {
+                'old_type': type(t1), 'new_type': type(t2), 'old_value': t1, 'new_value': t2})
+        elif isinstance(t1, dict):
+            for key in t2:
+                if key not in t1:
+                    self.report('dictionary_item_added', self.get_path(path, key), t2[key])
+            for key in t1:
+                if key not in t2:
+                    self.report('dictionary_item_removed', self.get_path(path, key), t1[key])
+                else:
+                    self.diff_values(self.get_path(path, key), t1[key], t2[key])
+        elif isinstance(t1, (list, tuple)):
+            # Items are matched by content, ignoring their order; each distinct item is reported at its first index
+            t1_indexes = {}
+            for i, item in enumerate(t1):
+                t1_indexes.setdefault(self.get_canonical_json(item), i)
+            t2_indexes = {}
+            for i, item in enumerate(t2):
+                t2_indexes.setdefault(self.get_canonical_json(item), i)
+            for item_json, i in t2_indexes.iteritems():
+                if item_json not in t1_indexes:
+                    self.report('iterable_item_added', '%s[%s]' % (path, i), t2[i])
+            for item_json, i in t1_indexes.iteritems():
+                if item_json not in t2_indexes:
+                    self.report('iterable_item_removed', '%s[%s]' % (path, i), t1[i])
+        elif t1 != t2:
+            change = {'new_value': t2, 'old_value': t1}
+            if isinstance(t1, basestring) and ('\n' in t1 or '\n' in t2):
+                try:
+                    diff = u'\n'.join(difflib.unified_diff(t1.splitlines(), t2.splitlines(), lineterm=''))
+                except UnicodeDecodeError:
+                    diff = None
+                if diff:
+                    change['diff'] = diff
+            self.report('values_changed', path, change)
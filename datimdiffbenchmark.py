@@ -0,0 +1,116 @@
+"""
+Benchmark of the keyed diff engine (DatimKeyedDiff) against DeepDiff on the metadata bundled with this repository
+
+The MER, SIMS and Mechanisms resources in the metadata folder are keyed by URL, as in the cleaned OCL exports,
+and compared with a copy in which a fixed share of the resources were added, removed, renamed, given a new data
+type or had the order of their names changed. Both engines are run on the same input, their results are checked
+for equality and the time of each is reported.
+
+Usage: python datimdiffbenchmark.py [number of repetitions]
+"""
+import json
+import os
+import random
+import sys
+import time
+from deepdiff import DeepDiff
+from datimdiff import DatimKeyedDiff
+
+
+METADATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metadata')
+
+# Bundled import lines per benchmark dataset
+DATASETS = [
+    ('MER', ['MER_Indicator/MER_Indicator.json', 'MER_Disaggregation/MER_Disaggregation.json']),
+    ('SIMS', ['SIMS/converted_sims_export.json']),
+    ('Mechanisms', ['Mechanisms/converted_mechanisms_export.json']),
+]
+
+# Share of the resources changed in the new copy, by type of change
+CHANGE_RATES = {'added': 0.02, 'removed': 0.02, 'renamed': 0.02, 'datatype': 0.01, 'reordered': 0.02}
+
+
+def load_import_lines(file_path):
+    """ Returns the resources of a JSON file that holds a list, or a sequence, of import lines """
+    with open(file_path, 'rb') as input_file:
+        content = input_file.read()
+    decoder = json.JSONDecoder()
+    lines = []
+    offset = 0
+    while offset < len(content):
+        if content[offset].isspace():
+            offset += 1
+            continue
+        value, offset = decoder.raw_decode(content, offset)
+        lines.extend(value if isinstance(value, list) else [value])
+    return lines
+
+
+def get_keyed_resources(lines):
+    """ Returns the resources keyed by URL, with one reference per expression as in the cleaned OCL exports """
+    resources = {}
+    for line in lines:
+        owner_url = '/orgs/%s/' % line.get('owner', '')
+        if line['type'] == 'Concept':
+            concept_id = line.get('id') or line.get('concept_id') or line.get('external_id')
+            resources['%ssources/%s/concepts/%s/' % (owner_url, line.get('source', ''), concept_id)] = line
+        elif line['type'] == 'Reference':
+            for expression in line['data']['expressions']:
+                key = '%scollections/%s/references/?concept=%s' % (owner_url, line.get('collection', ''), expression)
+                resources[key] = {'type': 'Reference', 'collection_url': '%scollections/%s/' % (
+                    owner_url, line.get('collection', '')), 'data': {'expressions': [expression]}}
+    return resources
+
+
+def get_changed_copy(resources, seed=0):
+    """ Returns a copy of the resources with the share of changes given by CHANGE_RATES """
+    rand = random.Random(seed)
+    changed = json.loads(json.dumps(resources))
+    keys = sorted(changed)
+    for key in rand.sample(keys, int(len(keys) * CHANGE_RATES['removed'])):
+        del changed[key]
+    for key in rand.sample(keys, int(len(keys) * CHANGE_RATES['added'])):
+        if key in changed:
+            changed[key + 'NEW/'] = json.loads(json.dumps(changed[key]))
+    concept_keys = [key for key in sorted(changed) if changed[key].get('names')]
+    for key in rand.sample(concept_keys, int(len(concept_keys) * CHANGE_RATES['renamed'])):
+        changed[key]['names'][0]['name'] += ' (renamed)'
+    for key in rand.sample(concept_keys, int(len(concept_keys) * CHANGE_RATES['datatype'])):
+        changed[key]['datatype'] = None
+    for key in rand.sample(concept_keys, int(len(concept_keys) * CHANGE_RATES['reordered'])):
+        changed[key]['names'].reverse()
+    return changed
+
+
+def get_comparable(diff):
+    return dict((report_type, dict(changes)) for report_type, changes in diff.iteritems() if changes)
+
+
+def run_benchmark(num_repetitions=1):
+    print('%-12s %10s %8s %14s %14s %9s %6s' % (
+        'Dataset', 'Resources', 'Changes', 'DeepDiff (s)', 'Keyed diff (s)', 'Speedup', 'Equal'))
+    for dataset_name, file_names in DATASETS:
+        lines = []
+        for file_name in file_names:
+            lines.extend(load_import_lines(os.path.join(METADATA_PATH, file_name)))
+        ocl_resources = json.loads(json.dumps(get_keyed_resources(lines)))
+        dhis2_resources = get_changed_copy(ocl_resources)
+
+        start_time = time.time()
+        for _ in range(num_repetitions):
+            deep_diff = DeepDiff(ocl_resources, dhis2_resources, ignore_order=True, verbose_level=2)
+        deep_diff_seconds = (time.time() - start_time) / num_repetitions
+
+        start_time = time.time()
+        for _ in range(num_repetitions):
+            keyed_diff = DatimKeyedDiff(ocl_resources, dhis2_resources)
+        keyed_diff_seconds = (time.time() - start_time) / num_repetitions
+
+        print('%-12s %10s %8s %14.3f %14.3f %8.1fx %6s' % (
+            dataset_name, len(ocl_resources), sum(len(changes) for changes in keyed_diff.values()),
+            deep_diff_seconds, keyed_diff_seconds, deep_diff_seconds / max(keyed_diff_seconds, 0.000001),
+            get_comparable(deep_diff) == get_comparable(keyed_diff)))
+
+
+if __name__ == '__main__':
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
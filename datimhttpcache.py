@@ -0,0 +1,168 @@
+"""
+On-disk conditional-GET cache for large, rarely changing HTTP payloads (e.g. DHIS2 metadata queries)
+
+Responses are keyed by their fully expanded URL. The ETag and Last-Modified validators of each cached
+response are sent back as If-None-Match and If-Modified-Since, and a 304 Not Modified response is served
+from disk. Cached bodies are evicted least-recently-used first once the cache exceeds its size limit. The index
+is re-read and updated under a file lock, so that syncs running at the same time can share the cache directory.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DatimHttpCache:
+    """ Conditional-GET cache that stores response bodies on disk with size-based LRU eviction """
+
+    INDEX_FILENAME = 'index.json'
+    DEFAULT_MAX_SIZE = 500 * 1024 * 1024
+
+    def __init__(self, cache_dir='', http_client=None, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param cache_dir: Absolute path of the directory that holds the cache index and cached bodies
+        :param http_client: DatimHttpClient used to send requests
+        :param max_size: Maximum total size in bytes of cached bodies
+        """
+        self.cache_dir = cache_dir
+        self.http_client = http_client
+        self.max_size = max_size
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        """ Returns the cache index saved on disk """
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, 'rb') as handle:
+                    return json.load(handle)
+            except ValueError:
+                pass
+        return {}
+
+    def _update_index(self, update):
+        """
+        Re-reads the index from disk, applies update(index), evicts entries and saves the index while holding both
+        the thread lock and a lock on a separate lock file, so that concurrent syncs sharing the cache directory
+        keep each other's entries. Returns the result of update.
+        """
+        with self._lock:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(os.path.join(self.cache_dir, self.INDEX_FILENAME + '.lock'), 'a+') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._index = self._load_index()
+                    result = update(self._index)
+                    self._evict()
+                    self._save_index()
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return result
+
+    def _save_index(self):
+        """ Saves the cache index to disk. Must be called from _update_index. """
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        tmp_path = '%s.%s.tmp' % (index_path, os.getpid())
+        with open(tmp_path, 'wb') as output_file:
+            output_file.write(json.dumps(self._index))
+        os.rename(tmp_path, index_path)
+
+    def _evict(self):
+        """
+        Removes least recently used entries until the cache fits its size limit, and cached bodies that no entry
+        refers to. Must be called from _update_index, since bodies are only written while holding its locks.
+        """
+        index = self._index
+        total_size = sum([entry['size'] for entry in index.values()])
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total_size <= self.max_size:
+                break
+            total_size -= index[key]['size']
+            body_path = os.path.join(self.cache_dir, index[key]['filename'])
+            if os.path.isfile(body_path):
+                os.remove(body_path)
+            del index[key]
+        filenames = set(entry['filename'] for entry in index.values())
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.body') and filename not in filenames:
+                os.remove(os.path.join(self.cache_dir, filename))
+
+    def get_cache_key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get_to_file(self, url, output_path, **kwargs):
+        """
+        Sends a conditional GET for the URL and writes the current response body to output_path
+        :param url: Fully expanded URL of the request, used as the cache key
+        :param output_path: Absolute path of the file to write the response body to
+        :param kwargs: Any additional keyword arguments accepted by DatimHttpClient.download (e.g. auth)
+        :return: tuple (int number of bytes written, bool True if served from the cache)
+        """
+        key = self.get_cache_key(url)
+        with self._lock:
+            entry = self._load_index().get(key)
+            if entry and not os.path.isfile(os.path.join(self.cache_dir, entry['filename'])):
+                entry = None
+
+        # Send the request, including validators from the cached response if available
+        headers = dict(kwargs.pop('headers', None) or {})
+        validator_headers = dict(headers)
+        if entry:
+            if entry.get('etag'):
+                validator_headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                validator_headers['If-Modified-Since'] = entry['last_modified']
+        r = self.http_client.download(url, output_path, headers=validator_headers, **kwargs)
+
+        # Not modified, so serve the body from the cache
+        if entry and r.status_code == 304:
+            r.close()
+
+            def serve_cached_body(index):
+                cached_entry = index.get(key)
+                if not cached_entry or cached_entry['filename'] != entry['filename']:
+                    return None
+                body_path = os.path.join(self.cache_dir, cached_entry['filename'])
+                if not os.path.isfile(body_path):
+                    return None
+                cached_entry['last_used'] = time.time()
+                shutil.copyfile(body_path, output_path)
+                return cached_entry['size']
+
+            num_bytes = self._update_index(serve_cached_body)
+            if num_bytes is not None:
+                return num_bytes, True
+
+            # Another sync evicted the cached body in the meantime, so request it again without validators
+            r = self.http_client.download(url, output_path, headers=headers, **kwargs)
+
+        # The new body was saved to the output file, so cache it if the response can be validated later
+        r.raise_for_status()
+        num_bytes = os.path.getsize(output_path)
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if (etag or last_modified) and num_bytes <= self.max_size:
+            def add_entry(index):
+                filename = key + '.body'
+                shutil.copyfile(output_path, os.path.join(self.cache_dir, filename))
+                index[key] = {
+                    'url': url,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'size': num_bytes,
+                    'last_used': time.time(),
+                    'filename': filename,
+                }
+
+            self._update_index(add_entry)
+        return num_bytes, False
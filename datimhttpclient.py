@@ -0,0 +1,329 @@
+"""
+Pooled, retrying HTTP client shared by the DATIM sync, presentation and OCL import classes
+
+One requests.Session is kept per host (scheme + network location) so that keep-alive connections
+are reused across the thousands of requests made during a sync or import. Session cookies returned
+by a host (e.g. the DHIS2 JSESSIONID) are reused so that Basic authentication is only sent again
+when the server rejects the cookie. Transient failures (connection resets, timeouts and 5xx gateway
+errors) are retried with exponential backoff and full jitter. Non-idempotent requests are only retried when the
+server could not have processed them.
+
+Large payloads are saved with DatimHttpClient.download, which negotiates gzip, streams the raw bytes to a
+".part" file and resumes interrupted transfers with Range requests.
+"""
+import httplib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from urlparse import urlparse
+import zlib
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError, ProtocolError, ReadTimeoutError
+
+
+class DatimHttpClient:
+    """ HTTP client that keeps one pooled session per host and retries transient failures """
+
+    # Status codes that are retried for idempotent requests
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+    # Status codes that are retried for non-idempotent requests -- a 503 is returned when the server or gateway
+    # refuses to handle the request. After a 502 or 504 the application server may already have received and
+    # processed the request, so repeating a POST could create duplicate resources or bulk import jobs.
+    RETRY_STATUS_CODES_NON_IDEMPOTENT = [503]
+
+    IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+
+    # Cookies that indicate an authenticated server-side session (DHIS2 uses JSESSIONID)
+    SESSION_COOKIE_NAMES = ['JSESSIONID', 'SESSION']
+
+    DEFAULT_MAX_RETRIES = 5
+    DEFAULT_BACKOFF_BASE = 1.0
+    DEFAULT_BACKOFF_MAX = 60.0
+    DEFAULT_POOL_MAXSIZE = 20
+
+    # (connect, read) timeout in seconds -- the read timeout applies between bytes, not to the whole response
+    DEFAULT_TIMEOUT = (30, 600)
+
+    # Size in bytes of the blocks written to disk by download()
+    DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+    # Errors that interrupt a download after the response headers were received
+    DOWNLOAD_INTERRUPTED_ERRORS = (requests.exceptions.RequestException, ProtocolError, ReadTimeoutError,
+                                   httplib.IncompleteRead, socket.error)
+
+    _shared_client = None
+    _shared_client_lock = threading.Lock()
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_max=DEFAULT_BACKOFF_MAX, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 timeout=DEFAULT_TIMEOUT, verbosity=1):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.verbosity = verbosity
+        self.num_retries = 0
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @classmethod
+    def get_shared_client(cls):
+        """ Returns the process-wide client used by default by all DATIM and OCL classes """
+        with cls._shared_client_lock:
+            if cls._shared_client is None:
+                cls._shared_client = cls()
+            return cls._shared_client
+
+    def log(self, *args):
+        """ Output log information """
+        sys.stdout.write('[' + str(datetime.now()) + '] ')
+        for arg in args:
+            sys.stdout.write(str(arg))
+            sys.stdout.write(' ')
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+
+    def get_session(self, url):
+        """ Returns the pooled session for the host of the specified URL, creating it if needed """
+        parsed_url = urlparse(url)
+        host_key = '%s://%s' % (parsed_url.scheme, parsed_url.netloc)
+        if self._pid != os.getpid():
+            # A forked child (e.g. an import shard process) must not share the parent's keep-alive sockets, so
+            # the inherited sessions are dropped without closing them. The lock may have been held at the fork.
+            self._sessions = {}
+            self._sessions_lock = threading.Lock()
+            self._pid = os.getpid()
+        with self._sessions_lock:
+            if host_key not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host_key] = session
+            return self._sessions[host_key]
+
+    def has_session_cookie(self, session):
+        """ Returns whether the host has issued a server-side session cookie that can replace Basic auth """
+        for cookie in session.cookies:
+            if cookie.name in self.SESSION_COOKIE_NAMES:
+                return True
+        return False
+
+    def get_retry_delay(self, attempt, response=None):
+        """ Exponential backoff with full jitter, honoring a numeric Retry-After header if provided """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, min(self.backoff_max, float(response.headers['Retry-After'])))
+        return delay
+
+    def is_retry_safe(self, method, error):
+        """
+        Returns whether a request that failed without a response can be sent again. Non-idempotent requests are
+        only repeated if the connection could not be established, since a read timeout or a dropped connection
+        may occur after the server has processed the request.
+        """
+        if method in self.IDEMPOTENT_METHODS or isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def request(self, method, url, auth=None, retry_status_codes=None, **kwargs):
+        """
+        Sends a request using the pooled session for the URL's host, retrying transient failures
+        :param method: HTTP method, e.g. 'GET'
+        :param url: Full URL of the request
+        :param auth: Optional requests auth object. Omitted if the host has already issued a session cookie.
+        :param retry_status_codes: Optional list of status codes to retry instead of the defaults for the method,
+            e.g. to leave throttling responses to a caller that paces its own requests
+        :param kwargs: Any additional keyword arguments accepted by requests.Session.request
+        :return: requests.Response
+        """
+        method = method.upper()
+        session = self.get_session(url)
+        kwargs.setdefault('timeout', self.timeout)
+        if retry_status_codes is not None:
+            pass
+        elif method in self.IDEMPOTENT_METHODS:
+            retry_status_codes = self.RETRY_STATUS_CODES
+        else:
+            retry_status_codes = self.RETRY_STATUS_CODES_NON_IDEMPOTENT
+        attempt = 0
+        while True:
+            use_cookie = auth is not None and self.has_session_cookie(session)
+            try:
+                response = session.request(method, url, auth=(None if use_cookie else auth), **kwargs)
+                if use_cookie and response.status_code == requests.codes.unauthorized:
+                    # Session expired, so authenticate again and pick up a new session cookie
+                    response.close()
+                    session.cookies.clear()
+                    response = session.request(method, url, auth=auth, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries or not self.is_retry_safe(method, e):
+                    raise
+                delay = self.get_retry_delay(attempt)
+                if self.verbosity:
+                    self.log('WARNING: %s %s failed (%s). Retrying in %.1f seconds (%s of %s)...' % (
+                        method, url, e, delay, attempt + 1, self.max_retries))
+            else:
+                if response.status_code not in retry_status_codes or attempt >= self.max_retries:
+                    return response
+                delay = self.get_retry_delay(attempt, response=response)
+                if self.verbosity:
+                    self.log('WARNING: %s %s returned %s. Retrying in %.1f seconds (%s of %s)...' % (
+                        method, url, response.status_code, delay, attempt + 1, self.max_retries))
+                response.close()
+            self.num_retries += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def get_download_validator(self, response):
+        """ Returns the strong validator that a resumed request can send in If-Range, or None """
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return response.headers.get('Last-Modified')
+
+    def get_download_total_size(self, response):
+        """ Returns the total size in bytes of the (encoded) payload, or None if the server did not report it """
+        if response.status_code in (requests.codes.partial_content, requests.codes.requested_range_not_satisfiable):
+            total_size = response.headers.get('Content-Range', '').rpartition('/')[2]
+        else:
+            total_size = response.headers.get('Content-Length', '')
+        return int(total_size) if total_size.isdigit() else None
+
+    def download(self, url, output_path, headers=None, **kwargs):
+        """
+        Downloads the response body to output_path. gzip encoding is requested, and the raw bytes are streamed
+        in DOWNLOAD_BLOCK_SIZE blocks to "<output_path>.part", with the validator and size of the payload
+        recorded in "<output_path>.part.json". If the transfer is interrupted (here or in an earlier run), it is
+        resumed from the end of the partial file using Range and If-Range. Once the received length matches
+        the reported length, the body is decompressed (if needed) to output_path. If the server rejects the range
+        with a 416, a partial file that already has the recorded length is decompressed as is and the response is
+        returned with status 200, while any other partial file is deleted and the download starts over.
+        The response is returned without saving anything if the status code is not 200 or 206, e.g. a 304
+        for a conditional request.
+        :param url: Full URL of the request
+        :param output_path: Absolute path of the file to write the decoded response body to
+        :param headers: Optional dictionary of request headers
+        :param kwargs: Any additional keyword arguments accepted by request, e.g. auth
+        :return: requests.Response
+        """
+        part_path = output_path + '.part'
+        meta_path = output_path + '.part.json'
+        meta = {}
+        if os.path.isfile(part_path) and os.path.isfile(meta_path):
+            try:
+                with open(meta_path, 'rb') as meta_file:
+                    meta = json.load(meta_file)
+            except ValueError:
+                meta = {}
+            if meta.get('url') != url or not meta.get('validator'):
+                meta = {}
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part_path) if meta and os.path.isfile(part_path) else 0
+            request_headers = dict(headers or {})
+            request_headers['Accept-Encoding'] = 'gzip'
+            if offset:
+                request_headers['Range'] = 'bytes=%s-' % offset
+                request_headers['If-Range'] = meta['validator']
+            response = self.get(url, headers=request_headers, stream=True, **kwargs)
+            if response.status_code == requests.codes.partial_content and offset:
+                if self.verbosity:
+                    self.log('Resuming download of %s at byte %s' % (url, offset))
+                file_mode = 'ab'
+            elif response.status_code == requests.codes.ok:
+                file_mode = 'wb'
+                meta = {
+                    'url': url,
+                    'validator': self.get_download_validator(response),
+                    'content_encoding': response.headers.get('Content-Encoding', ''),
+                    'total_size': self.get_download_total_size(response),
+                }
+                with open(meta_path, 'wb') as meta_file:
+                    meta_file.write(json.dumps(meta))
+            elif response.status_code == requests.codes.requested_range_not_satisfiable and offset:
+                response.close()
+                if offset == meta['total_size'] and self.get_download_total_size(response) in (None, offset):
+                    # The partial file is complete, e.g. if an earlier run stopped before decoding it
+                    if self.verbosity:
+                        self.log('Download of %s was already complete' % url)
+                    response.status_code = requests.codes.ok
+                    break
+                if self.verbosity:
+                    self.log('WARNING: Partial download of %s does not match the payload. Starting over...' % url)
+                os.remove(part_path)
+                os.remove(meta_path)
+                meta = {}
+                continue
+            else:
+                return response
+
+            # Stream the raw (still encoded) bytes so that a partial file can be resumed byte for byte
+            try:
+                with open(part_path, file_mode) as part_file:
+                    for block in response.raw.stream(self.DOWNLOAD_BLOCK_SIZE, decode_content=False):
+                        part_file.write(block)
+                error = None
+            except self.DOWNLOAD_INTERRUPTED_ERRORS as e:
+                error = e
+            finally:
+                response.close()
+            received_size = os.path.getsize(part_path)
+            if not error and meta['total_size'] is not None and received_size != meta['total_size']:
+                error = 'received %s of %s bytes' % (received_size, meta['total_size'])
+            if not error:
+                break
+            if attempt >= self.max_retries:
+                raise IOError('Download of %s failed: %s' % (url, error))
+            if not meta['validator']:
+                # The payload cannot be matched to the partial file, so start over
+                meta = {}
+            delay = self.get_retry_delay(attempt)
+            if self.verbosity:
+                self.log('WARNING: Download of %s interrupted (%s). Retrying in %.1f seconds (%s of %s)...' % (
+                    url, error, delay, attempt + 1, self.max_retries))
+            self.num_retries += 1
+            attempt += 1
+            time.sleep(delay)
+
+        # Decode the completed payload into the output file
+        if meta['content_encoding'] == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            with open(part_path, 'rb') as part_file:
+                with open(output_path, 'wb') as output_file:
+                    for block in iter(lambda: part_file.read(self.DOWNLOAD_BLOCK_SIZE), ''):
+                        output_file.write(decompressor.decompress(block))
+                    output_file.write(decompressor.flush())
+            os.remove(part_path)
+        else:
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+            os.rename(part_path, output_path)
+        os.remove(meta_path)
+        return response
@@ -0,0 +1,152 @@
+"""
+Adaptive token-bucket rate limiter shared by all processes that send requests to the same API
+
+The current rate, available tokens and time of the last update are kept in a small JSON state file that is
+locked with fcntl while it is read and updated, so that concurrent MER, SIMS and Mechanisms syncs together
+stay within one request budget. The rate is adjusted with additive increase, multiplicative decrease (AIMD):
+each fast, successful response increases the rate by roughly additive_increase requests per second every
+second, while a 429 or 503 response or a response slower than latency_target halves it. The outcome of a
+request is kept in memory and applied together with taking the token for the next request, so that each request
+reads and writes the state file only once.
+"""
+import json
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DatimRateLimiter:
+    """ Token-bucket rate limiter with AIMD rate control, shared across processes through a lock file """
+
+    # Status codes indicating that the server is overloaded
+    THROTTLE_STATUS_CODES = [429, 503]
+
+    DEFAULT_INITIAL_RATE = 5.0
+    DEFAULT_MIN_RATE = 0.1
+    DEFAULT_MAX_RATE = 50.0
+    DEFAULT_ADDITIVE_INCREASE = 0.5
+    DEFAULT_MULTIPLICATIVE_DECREASE = 0.5
+    DEFAULT_LATENCY_TARGET = 5.0
+
+    # Seconds after a decrease during which further slow or throttled responses do not decrease the rate again,
+    # since they were most likely sent before the previous decrease took effect
+    DECREASE_COOLDOWN = 2.0
+
+    # Shared state that has not been updated for this many seconds is discarded and the rate is seeded again
+    STATE_EXPIRATION = 600
+
+    def __init__(self, state_path='', initial_rate=DEFAULT_INITIAL_RATE, min_rate=DEFAULT_MIN_RATE,
+                 max_rate=DEFAULT_MAX_RATE, additive_increase=DEFAULT_ADDITIVE_INCREASE,
+                 multiplicative_decrease=DEFAULT_MULTIPLICATIVE_DECREASE, latency_target=DEFAULT_LATENCY_TARGET):
+        """
+        :param state_path: Path of the state file shared by all processes using the same budget
+        :param initial_rate: Requests per second used when no recent shared state exists
+        :param min_rate: Lower bound of the rate in requests per second
+        :param max_rate: Upper bound of the rate in requests per second
+        :param additive_increase: Requests per second added to the rate for each second of healthy responses
+        :param multiplicative_decrease: Factor applied to the rate when the server is overloaded
+        :param latency_target: Responses slower than this number of seconds are treated as overload
+        """
+        self.state_path = state_path
+        self.initial_rate = max(min_rate, min(max_rate, initial_rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.latency_target = latency_target
+        self._lock = threading.Lock()
+        self._pending_outcomes = []
+        self._pending_lock = threading.Lock()
+
+    @classmethod
+    def from_delay(cls, state_path='', delay=0, **kwargs):
+        """ Returns a rate limiter seeded with the rate implied by a fixed delay in seconds between requests """
+        if delay:
+            kwargs['initial_rate'] = 1.0 / delay
+        return cls(state_path=state_path, **kwargs)
+
+    def _update_state(self, update):
+        """
+        Reads the shared state, refills the token bucket, applies the outcomes recorded since the last update and
+        then update(state, now) while holding both the thread lock and the lock on the state file. Returns the
+        result of update.
+        """
+        with self._lock:
+            with open(self.state_path, 'a+') as state_file:
+                if fcntl:
+                    fcntl.flock(state_file, fcntl.LOCK_EX)
+                try:
+                    now = time.time()
+                    state_file.seek(0)
+                    try:
+                        state = json.loads(state_file.read())
+                    except ValueError:
+                        state = None
+                    if not state or now - state['updated'] > self.STATE_EXPIRATION:
+                        state = {'rate': self.initial_rate, 'tokens': 1.0, 'updated': now, 'last_decrease': 0}
+                    state['tokens'] = min(max(1.0, state['rate']),
+                                          state['tokens'] + max(0, now - state['updated']) * state['rate'])
+                    state['updated'] = now
+                    with self._pending_lock:
+                        outcomes = self._pending_outcomes
+                        self._pending_outcomes = []
+                    for outcome in outcomes:
+                        self._apply_outcome(state, *outcome)
+                    result = update(state, now)
+                    state_file.seek(0)
+                    state_file.truncate()
+                    state_file.write(json.dumps(state))
+                    state_file.flush()
+                finally:
+                    if fcntl:
+                        fcntl.flock(state_file, fcntl.LOCK_UN)
+        return result
+
+    def get_rate(self):
+        """ Returns the current shared rate in requests per second """
+        return self._update_state(lambda state, now: state['rate'])
+
+    def acquire(self):
+        """ Blocks until a request may be sent under the shared budget """
+        def take_token(state, now):
+            # The token is reserved even if the bucket is empty, so the request only waits for it to be refilled
+            # instead of reading the state again
+            state['tokens'] -= 1
+            return max(0, -state['tokens'] / state['rate'])
+
+        wait = self._update_state(take_token)
+        if wait:
+            time.sleep(wait)
+
+    def record(self, latency, status_code=None, latency_target=None):
+        """
+        Records the outcome of a request, which adjusts the shared rate when the next token is taken (or on flush)
+        :param latency: Seconds between sending the request and receiving the response
+        :param status_code: Status code of the response, or None if the request failed without a response
+        :param latency_target: Optional latency target for this request, replacing the default latency_target
+            for requests that are expected to be slow, e.g. large reference requests
+        """
+        if latency_target is None:
+            latency_target = self.latency_target
+        with self._pending_lock:
+            self._pending_outcomes.append((time.time(), latency, status_code, latency_target))
+
+    def flush(self):
+        """ Applies the outcomes recorded since the last token was taken to the shared rate """
+        with self._pending_lock:
+            has_pending_outcomes = bool(self._pending_outcomes)
+        if has_pending_outcomes:
+            self._update_state(lambda state, now: None)
+
+    def _apply_outcome(self, state, recorded, latency, status_code, latency_target):
+        """ Adjusts the rate in the shared state based on the outcome of a request recorded at time recorded """
+        if status_code in self.THROTTLE_STATUS_CODES or latency > latency_target:
+            if recorded - state['last_decrease'] >= self.DECREASE_COOLDOWN:
+                state['rate'] = max(self.min_rate, state['rate'] * self.multiplicative_decrease)
+                state['tokens'] = min(state['tokens'], 1.0)
+                state['last_decrease'] = recorded
+        elif status_code is not None:
+            state['rate'] = min(self.max_rate, state['rate'] + self.additive_increase / state['rate'])
@@ -0,0 +1,291 @@
+"""
+Planner that consolidates the reference lines of an import script into as few OCL reference requests as possible
+
+Compatible references (same collection and cascade setting) from anywhere in the import script are merged and
+written after all concepts and mappings, so that every expression they include has already been created. Each
+batch is bounded by the size of its payload, by a separate cap on the number of concept and mapping
+expressions, and by the latency observed for earlier reference requests to the same collection, so that large
+batches are only sent to collections that the server handles quickly.
+
+Cascading a concept expression to its source mappings makes OCL look up and add every mapping from the concept,
+which is the slowest part of a reference request. The planner drops the cascade for concept expressions whose
+source mappings are all known and will already be in the collection, either because the collection references
+them already or because the import script references them explicitly, and for mapping expressions, to which a
+cascade does not apply.
+"""
+import json
+import os
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DatimReferenceLatencyStats:
+    """
+    Observed latency of reference requests per collection and cascade setting, kept as an exponentially weighted
+    moving average of the seconds per expression and persisted to a JSON file for later syncs
+    """
+
+    # Weight of the most recent observation in the moving average
+    ALPHA = 0.3
+
+    def __init__(self, path=''):
+        """
+        :param path: Path of the JSON file that persists the statistics, or '' to keep them in memory only
+        """
+        self.path = path
+        self._stats = self.load()
+        self._updated_keys = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Returns the statistics saved on disk """
+        if self.path and os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as stats_file:
+                    return json.load(stats_file)
+            except ValueError:
+                pass
+        return {}
+
+    def get_key(self, collection_url, cascade=None):
+        return '%s?cascade=%s' % (collection_url, cascade or '')
+
+    def record(self, collection_url, cascade, num_expressions, latency):
+        """
+        Records the latency of a reference request
+        :param collection_url: URL of the collection, e.g. '/orgs/PEPFAR/collections/MER-R-Facility-FY17Q4/'
+        :param cascade: Cascade setting of the request, e.g. 'sourcemappings', or None
+        :param num_expressions: Number of expressions in the request
+        :param latency: Seconds between sending the request and receiving the response
+        """
+        if not num_expressions:
+            return
+        seconds_per_expression = float(latency) / num_expressions
+        key = self.get_key(collection_url, cascade)
+        with self._lock:
+            if key in self._stats:
+                self._stats[key] = self.ALPHA * seconds_per_expression + (1 - self.ALPHA) * self._stats[key]
+            else:
+                self._stats[key] = seconds_per_expression
+            self._updated_keys.add(key)
+
+    def get_seconds_per_expression(self, collection_url, cascade=None):
+        """ Returns the average seconds per expression, or None if no requests were recorded """
+        with self._lock:
+            return self._stats.get(self.get_key(collection_url, cascade))
+
+    def save(self):
+        """
+        Writes the statistics updated by this object to disk, keeping those saved in the meantime for other
+        collections (e.g. by the other processes of a sharded import). The statistics are read, merged and
+        replaced while holding a lock on a separate lock file, since the statistics file itself is replaced.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            with open(self.path + '.lock', 'a+') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    stats = self.load()
+                    stats.update((key, self._stats[key]) for key in self._updated_keys)
+                    tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                    with open(tmp_path, 'wb') as stats_file:
+                        stats_file.write(json.dumps(stats))
+                    os.rename(tmp_path, self.path)
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DatimReferencePlanner:
+    """
+    Merges reference lines by collection and cascade setting, drops redundant cascades and splits the references
+    into bounded batches
+    """
+
+    # Upper bound for the JSON size of the expressions of a single batch
+    DEFAULT_MAX_BATCH_BYTES = 64 * 1024
+
+    # Number of expressions per batch for collections without observed latency
+    DEFAULT_BATCH_SIZE = 25
+
+    # Upper bounds for the number of concept and mapping expressions per batch
+    DEFAULT_MAX_CONCEPT_BATCH_SIZE = 200
+    DEFAULT_MAX_MAPPING_BATCH_SIZE = 50
+
+    # Target number of seconds for a single reference request, well below the HTTP client timeout
+    DEFAULT_LATENCY_TARGET = 20.0
+
+    CASCADE_SOURCE_MAPPINGS = 'sourcemappings'
+
+    def __init__(self, latency_stats=None, max_batch_bytes=DEFAULT_MAX_BATCH_BYTES,
+                 default_batch_size=DEFAULT_BATCH_SIZE, max_concept_batch_size=DEFAULT_MAX_CONCEPT_BATCH_SIZE,
+                 max_mapping_batch_size=DEFAULT_MAX_MAPPING_BATCH_SIZE, latency_target=DEFAULT_LATENCY_TARGET):
+        """
+        :param latency_stats: Optional DatimReferenceLatencyStats with the latency observed by earlier imports
+        :param max_batch_bytes: Upper bound for the JSON size of the expressions of a batch
+        :param default_batch_size: Number of expressions per batch for collections without observed latency
+        :param max_concept_batch_size: Upper bound for the number of concept expressions per batch
+        :param max_mapping_batch_size: Upper bound for the number of mapping expressions per batch
+        :param latency_target: Target number of seconds for a single reference request
+        """
+        self.latency_stats = latency_stats
+        self.max_batch_bytes = max_batch_bytes
+        self.default_batch_size = default_batch_size
+        self.max_concept_batch_size = max_concept_batch_size
+        self.max_mapping_batch_size = max_mapping_batch_size
+        self.latency_target = latency_target
+        self.num_references = 0
+        self.num_cascades_avoided = 0
+        self._groups = []
+        self._group_index = {}
+        self._complete_source_urls = set()
+        self._source_mappings = {}
+        self._collection_mappings = {}
+
+    @staticmethod
+    def is_mapping_expression(expression):
+        return '/mappings/' in expression
+
+    @staticmethod
+    def get_mapping_id(source_url, from_concept_url, map_type, to_concept_url):
+        # External to-concepts are written with and without a trailing slash depending on where the key was built
+        return source_url, from_concept_url, map_type, to_concept_url.rstrip('/')
+
+    def add_complete_source(self, source_url):
+        """
+        Marks a source whose mappings were all passed to add_source_mapping, e.g. because it was exported from OCL.
+        Cascades are only dropped for concepts of complete sources.
+        :param source_url: Source URL, e.g. '/orgs/PEPFAR/sources/MER/'
+        """
+        self._complete_source_urls.add(source_url)
+
+    def add_source_mapping(self, source_url, from_concept_url, map_type, to_concept_url):
+        """ Adds a mapping that exists in the source or is created by the import script """
+        mapping_id = self.get_mapping_id(source_url, from_concept_url, map_type, to_concept_url)
+        self._source_mappings.setdefault(from_concept_url, set()).add(mapping_id)
+
+    def add_collection_mapping(self, collection_url, source_url, from_concept_url, map_type, to_concept_url):
+        """ Adds a mapping that the collection references already or that the import script references explicitly """
+        mapping_id = self.get_mapping_id(source_url, from_concept_url, map_type, to_concept_url)
+        self._collection_mappings.setdefault(collection_url, set()).add(mapping_id)
+
+    def is_cascade_redundant(self, collection_url, expression):
+        """
+        Returns whether cascading the expression to its source mappings would not add anything to the collection
+        :param collection_url: URL of the collection
+        :param expression: Concept or mapping expression, optionally including a version
+        :return: bool
+        """
+        if self.is_mapping_expression(expression):
+            return True
+        url_parts = expression.split('/')
+        source_url = '/'.join(url_parts[:5]) + '/'
+        concept_url = '/'.join(url_parts[:7]) + '/'
+        if source_url not in self._complete_source_urls:
+            return False
+        source_mappings = set(mapping_id for mapping_id in self._source_mappings.get(concept_url, ())
+                              if mapping_id[0] == source_url)
+        return source_mappings.issubset(self._collection_mappings.get(collection_url, ()))
+
+    def add(self, reference):
+        """
+        Adds a reference line to the plan. Its expressions are merged with those of earlier references to the
+        same collection with the same cascade setting and other fields.
+        :param reference: Reference line of the import script, with 'collection_url' and 'data': {'expressions'}
+        """
+        self.num_references += 1
+        template = dict((k, v) for k, v in reference.iteritems() if k != 'data')
+        key = json.dumps(template, sort_keys=True)
+        if key not in self._group_index:
+            self._group_index[key] = len(self._groups)
+            self._groups.append({'template': template, 'expressions': [], 'distinct': set()})
+        group = self._groups[self._group_index[key]]
+        for expression in (reference.get('data') or {}).get('expressions', []):
+            if expression not in group['distinct']:
+                group['distinct'].add(expression)
+                group['expressions'].append(expression)
+
+    def get_batch_size(self, collection_url, cascade=None):
+        """
+        Returns the number of expressions per batch for the collection, based on its observed latency
+        :param collection_url: URL of the collection
+        :param cascade: Cascade setting of the batch
+        :return: int
+        """
+        seconds_per_expression = None
+        if self.latency_stats:
+            seconds_per_expression = self.latency_stats.get_seconds_per_expression(collection_url, cascade)
+        if seconds_per_expression is None:
+            return self.default_batch_size
+        if seconds_per_expression <= 0:
+            return self.max_concept_batch_size
+        return max(1, min(self.max_concept_batch_size, int(self.latency_target / seconds_per_expression)))
+
+    def get_cascade_aware_groups(self):
+        """
+        Returns the merged references with the cascade removed from the expressions for which it is redundant
+        :return: list of (template, expressions) in the order the groups were first added
+        """
+        self.num_cascades_avoided = 0
+        groups = []
+        group_index = {}
+        for group in self._groups:
+            template = group['template']
+            cascade_free_template = None
+            for expression in group['expressions']:
+                expression_template = template
+                if (template.get('__cascade') == self.CASCADE_SOURCE_MAPPINGS and
+                        self.is_cascade_redundant(template.get('collection_url'), expression)):
+                    if cascade_free_template is None:
+                        cascade_free_template = dict((k, v) for k, v in template.iteritems() if k != '__cascade')
+                    expression_template = cascade_free_template
+                    if not self.is_mapping_expression(expression):
+                        self.num_cascades_avoided += 1
+                key = json.dumps(expression_template, sort_keys=True)
+                if key not in group_index:
+                    group_index[key] = len(groups)
+                    groups.append((expression_template, [], set()))
+                expressions, distinct = groups[group_index[key]][1:]
+                if expression not in distinct:
+                    distinct.add(expression)
+                    expressions.append(expression)
+        return [(group_template, group_expressions) for group_template, group_expressions, _ in groups]
+
+    def plan(self):
+        """
+        Returns the batched reference lines in the order their collections were first referenced
+        :return: list of reference lines
+        """
+        batches = []
+        for template, expressions in self.get_cascade_aware_groups():
+            batch_size = self.get_batch_size(template.get('collection_url'), template.get('__cascade'))
+            batch = []
+            batch_bytes = 0
+            num_mapping_expressions = 0
+            for expression in expressions:
+                expression_bytes = len(json.dumps(expression)) + 2
+                is_mapping = self.is_mapping_expression(expression)
+                if batch and (len(batch) >= batch_size or batch_bytes + expression_bytes > self.max_batch_bytes or
+                              (is_mapping and num_mapping_expressions >= self.max_mapping_batch_size)):
+                    batches.append(self.get_reference(template, batch))
+                    batch = []
+                    batch_bytes = 0
+                    num_mapping_expressions = 0
+                batch.append(expression)
+                batch_bytes += expression_bytes
+                if is_mapping:
+                    num_mapping_expressions += 1
+            if batch:
+                batches.append(self.get_reference(template, batch))
+        return batches
+
+    @staticmethod
+    def get_reference(template, expressions):
+        reference = dict(template)
+        reference['data'] = {'expressions': expressions}
+        return reference
@@ -31,7 +31,8 @@ class DatimShow(DatimBase):
     def __init__(self):
         DatimBase.__init__(self)
 
-    def build_show_grid(self, repo_title='', repo_subtitle='', headers='', input_filename='', show_build_row_method=''):
+    def build_show_grid(self, repo_title='', repo_subtitle='', headers='', input_zipfilename='',
+                        show_build_row_method=''):
         # Setup the headers
         intermediate = {
             'title': repo_title,
@@ -43,7 +44,7 @@ class DatimShow(DatimBase):
         intermediate['width'] = len(intermediate['headers'])
 
         # Read in the content
-        with open(self.attach_absolute_path(input_filename), 'rb') as ifile:
+        with self.open_ocl_export(input_zipfilename) as ifile:
             ocl_export_raw = json.load(ifile)
             for c in ocl_export_raw['concepts']:
                 direct_mappings = [item for item in ocl_export_raw['mappings'] if str(
@@ -202,25 +203,22 @@ class DatimShow(DatimBase):
         self.vlog(1, '**** STEP 1 of 4: Fetch latest version of relevant OCL repository export')
         self.vlog(1, '%s:' % repo_endpoint)
         zipfilename = self.endpoint2filename_ocl_export_tar(repo_endpoint)
-        jsonfilename = self.endpoint2filename_ocl_export_json(repo_endpoint)
         if not self.run_ocl_offline:
-            self.get_ocl_export(endpoint=repo_endpoint, version='latest', zipfilename=zipfilename,
-                                jsonfilename=jsonfilename)
+            self.get_ocl_export(endpoint=repo_endpoint, version='latest', zipfilename=zipfilename)
         else:
-            self.vlog(1, 'OCL-OFFLINE: Using local file "%s"...' % jsonfilename)
-            if os.path.isfile(self.attach_absolute_path(jsonfilename)):
+            self.vlog(1, 'OCL-OFFLINE: Using local file "%s"...' % zipfilename)
+            if os.path.isfile(self.attach_absolute_path(zipfilename)):
                 self.vlog(1, 'OCL-OFFLINE: File "%s" found containing %s bytes. Continuing...' % (
-                    jsonfilename, os.path.getsize(self.attach_absolute_path(jsonfilename))))
+                    zipfilename, os.path.getsize(self.attach_absolute_path(zipfilename))))
             else:
-                self.log('ERROR: Could not find offline OCL file "%s". Exiting...' % jsonfilename)
+                self.log('ERROR: Could not find offline OCL file "%s". Exiting...' % zipfilename)
                 sys.exit(1)
 
         # STEP 2 of 4: Transform OCL export to intermediary state
         self.vlog(1, '**** STEP 2 of 4: Transform to intermediary state')
-        jsonfilename = self.endpoint2filename_ocl_export_json(repo_endpoint)
         intermediate = self.build_show_grid(
             repo_title=repo_title, repo_subtitle=repo_subtitle, headers=self.headers[show_headers_key],
-            input_filename=jsonfilename, show_build_row_method=show_build_row_method)
+            input_zipfilename=zipfilename, show_build_row_method=show_build_row_method)
 
         # STEP 3 of 4: Cache the intermediate output
         self.vlog(1, '**** STEP 3 of 4: Cache the intermediate output')
@@ -14,14 +14,18 @@ Import batches should be structured as follows:
 }
 """
 import json
-import requests
 import os
 import sys
 from requests.auth import HTTPBasicAuth
 from shutil import copyfile
 from datimbase import DatimBase
-from oclfleximporter import OclFlexImporter
-from deepdiff import DeepDiff
+from oclfleximporter import (
+    OclFlexImporter, OclBulkImporter, OclShardedImporter, OclExistenceIndex, OclImportScriptValidator,
+    OclImportError)
+from datimtaskgraph import DatimTaskGraph
+from datimhttpcache import DatimHttpCache
+from datimreferenceplanner import DatimReferencePlanner, DatimReferenceLatencyStats
+from datimdiff import DatimKeyedDiff
 
 
 class DatimSync(DatimBase):
@@ -38,6 +42,14 @@ class DatimSync(DatimBase):
         SYNC_MODE_FULL_IMPORT
     ]
 
+    # Import backend constants
+    IMPORT_BACKEND_FLEX = 'flex'
+    IMPORT_BACKEND_BULK = 'bulk'
+    IMPORT_BACKENDS = [
+        IMPORT_BACKEND_FLEX,
+        IMPORT_BACKEND_BULK
+    ]
+
     # Data check return values
     DATIM_SYNC_NO_DIFF = 0
     DATIM_SYNC_DIFF = 1
@@ -51,9 +63,29 @@ class DatimSync(DatimBase):
 
     DEFAULT_OCL_EXPORT_CLEANING_METHOD = 'clean_ocl_export'
 
-    # Sets an upper limit for the number of concept references to include in a single API request
+    # Default number of OCL exports that are downloaded and decompressed at the same time
+    DEFAULT_OCL_EXPORT_WORKERS = 4
+
+    # Maximum number of downloaded OCL exports waiting to be cleaned before downloads pause
+    DEFAULT_OCL_EXPORT_QUEUE_SIZE = 8
+
+    # Directory and maximum size in bytes of the conditional-GET cache for DHIS2 queries
+    DHIS2_HTTP_CACHE_DIRNAME = 'dhis2-http-cache'
+    DHIS2_HTTP_CACHE_MAX_SIZE = 500 * 1024 * 1024
+
+    # Number of records per page for DHIS2 queries that are defined with 'paged': True
+    DEFAULT_DHIS2_PAGE_SIZE = 1000
+
+    # Maximum number of IDs in the IN filter of a single DHIS2 query defined with a 'chunk_attr'
+    DEFAULT_DHIS2_QUERY_CHUNK_SIZE = 20
+
+    # Number of expressions to include in a single reference request to a collection with no observed latency.
+    # Batches for other collections are sized by DatimReferencePlanner from the latency of earlier requests.
     CONSOLIDATED_REFERENCE_BATCH_LIMIT = 25
 
+    # File in which the latency of reference requests is kept for sizing later reference batches
+    REFERENCE_LATENCY_STATS_FILENAME = 'ocl-reference-latency.json'
+
     # Default fields to strip from OCL exports before performing deep diffs
     DEFAULT_CONCEPT_FIELDS_TO_REMOVE = ['version_created_by', 'created_on', 'updated_on',
                                         'version_created_on', 'created_by', 'updated_by', 'display_name',
@@ -84,9 +116,27 @@ class DatimSync(DatimBase):
         self.compare2previousexport = True
         self.import_limit = 0
         self.import_delay = 0
+        self.import_workers = 1
+        self.resume_import = False
+        self.import_processes = 1
+        self.validate_import_references = True
+        self.compile_import_script = False
+        self.reference_latency_stats = DatimReferenceLatencyStats(
+            path=self.attach_absolute_path(self.REFERENCE_LATENCY_STATS_FILENAME))
+        self.import_backend = self.IMPORT_BACKEND_FLEX
+        self.bulk_import_url = OclBulkImporter.DEFAULT_BULK_IMPORT_URL
         self.diff_result = None
         self.sync_resource_types = None
         self.write_diff_to_file = True
+        self.ocl_export_workers = self.DEFAULT_OCL_EXPORT_WORKERS
+        self.ocl_export_queue_size = self.DEFAULT_OCL_EXPORT_QUEUE_SIZE
+        self.ocl_existence_index = None
+        self.ocl_unversioned_repos = set()
+        self.dhis2_page_size = self.DEFAULT_DHIS2_PAGE_SIZE
+        self.dhis2_query_chunk_size = self.DEFAULT_DHIS2_QUERY_CHUNK_SIZE
+        self.dhis2_http_cache = DatimHttpCache(
+            cache_dir=self.attach_absolute_path(self.DHIS2_HTTP_CACHE_DIRNAME), http_client=self.http_client,
+            max_size=self.DHIS2_HTTP_CACHE_MAX_SIZE)
 
         # Instructs the sync script to combine reference imports to the same source and within the same
         # import batch to a single API request. This results in a significant increase in performance.
@@ -107,15 +157,20 @@ class DatimSync(DatimBase):
         if self.run_ocl_offline:
             self.log('**** RUNNING OCL IN OFFLINE MODE ****')
 
-    def prepare_ocl_exports(self, cleaning_attr=None):
+    def prepare_ocl_exports(self, cleaning_attr=None, ocl_export_def_keys=None):
         """
         Convert OCL exports into the diff format
         :param cleaning_attr: Optional cleaning attributes that are made available to each cleaning method
+        :param ocl_export_def_keys: Optional iterable of OCL_EXPORT_DEFS keys to clean, in the order they become
+            available (e.g. a queue fed by fetch_ocl_exports). Defaults to all export definitions.
         :return: None
         """
+        if ocl_export_def_keys is None:
+            ocl_export_def_keys = self.OCL_EXPORT_DEFS.keys()
         cnt = 0
         num_total = len(self.OCL_EXPORT_DEFS)
-        for ocl_export_def_key, export_def in self.OCL_EXPORT_DEFS.iteritems():
+        for ocl_export_def_key in ocl_export_def_keys:
+            export_def = self.OCL_EXPORT_DEFS[ocl_export_def_key]
             cnt += 1
             self.vlog(1, '** [OCL Export %s of %s] %s:' % (cnt, num_total, ocl_export_def_key))
             cleaning_method_name = export_def.get('cleaning_method', self.DEFAULT_OCL_EXPORT_CLEANING_METHOD)
@@ -151,9 +206,13 @@ class DatimSync(DatimBase):
         :return:
         """
         import_batch_key = ocl_export_def['import_batch']
-        jsonfilename = self.endpoint2filename_ocl_export_json(ocl_export_def['endpoint'])
-        with open(self.attach_absolute_path(jsonfilename), 'rb') as input_file:
+        zipfilename = self.endpoint2filename_ocl_export_tar(ocl_export_def['endpoint'])
+        with self.open_ocl_export(zipfilename) as input_file:
             ocl_repo_export_raw = json.load(input_file)
+            if self.ocl_existence_index:
+                self.ocl_existence_index.add_repo_export(
+                    ocl_export_def['endpoint'], ocl_repo_export_raw,
+                    is_current=ocl_export_def['endpoint'] not in self.ocl_unversioned_repos)
 
             if ocl_repo_export_raw['type'] in ['Source', 'Source Version']:
 
@@ -231,6 +290,138 @@ class DatimSync(DatimBase):
                 self.vlog(1, 'Cleaned %s concept references and skipped %s mapping references' % (
                     num_concept_refs, num_mapping_refs))
 
+    def fetch_ocl_export(self, ocl_export_def_key):
+        """
+        Fetch the latest version of one OCL export, or confirm that the local copy exists if in OCL offline mode
+        :param ocl_export_def_key: Key of the export definition in OCL_EXPORT_DEFS
+        :return: None
+        """
+        export_def = self.OCL_EXPORT_DEFS[ocl_export_def_key]
+        zipfilename = self.endpoint2filename_ocl_export_tar(export_def['endpoint'])
+        if not self.run_ocl_offline:
+            self.get_ocl_export(endpoint=export_def['endpoint'], version='latest', zipfilename=zipfilename)
+        else:
+            self.vlog(1, 'OCL-OFFLINE: Using local file "%s"...' % zipfilename)
+            if os.path.isfile(self.attach_absolute_path(zipfilename)):
+                self.vlog(1, 'OCL-OFFLINE: File "%s" found containing %s bytes. Continuing...' % (
+                    zipfilename, os.path.getsize(self.attach_absolute_path(zipfilename))))
+            else:
+                self.log('ERROR: Could not find offline OCL file "%s". Exiting...' % zipfilename)
+                sys.exit(1)
+
+    def fetch_ocl_exports(self, export_ready_callback=None, parent_graph=None):
+        """
+        Fetch the latest versions of all OCL exports. Generation of missing exports is requested up front for
+        every repository, a single poller waits for those exports concurrently, and up to ocl_export_workers
+        downloads run at the same time as exports become ready. Each export is decompressed to its own file,
+        so workers never share an extraction target.
+        :param export_ready_callback: Optional callable that is passed each OCL_EXPORT_DEFS key as soon as
+            that export is available locally
+        :param parent_graph: Optional DatimTaskGraph running this step. Export requests, polling and downloads
+            stop as soon as another step of that graph fails or exits, e.g. when STEP 3 finds nothing to import.
+        :return: None
+        """
+        ocl_export_def_keys = list(self.OCL_EXPORT_DEFS.keys())
+        num_total = len(ocl_export_def_keys)
+
+        # Offline mode only confirms that the local copies exist
+        if self.run_ocl_offline:
+            for ocl_export_def_key in ocl_export_def_keys:
+                self.vlog(1, '** [OCL Export %s of %s] %s:' % (
+                    ocl_export_def_keys.index(ocl_export_def_key) + 1, num_total, ocl_export_def_key))
+                self.fetch_ocl_export(ocl_export_def_key)
+                if export_ready_callback:
+                    export_ready_callback(ocl_export_def_key)
+            return
+
+        graph = DatimTaskGraph()
+        download_queue = graph.queue()
+        pending_export_requests = []
+
+        def abort_check():
+            graph.raise_if_aborted()
+            if parent_graph:
+                parent_graph.raise_if_aborted()
+
+        def request_export(ocl_export_def_key):
+            abort_check()
+            endpoint = self.OCL_EXPORT_DEFS[ocl_export_def_key]['endpoint']
+            export_request = {
+                'key': ocl_export_def_key,
+                'endpoint': endpoint,
+                'repo_version_id': self.get_ocl_repo_version_id(endpoint=endpoint, version='latest'),
+            }
+            if self.is_ocl_export_unchanged(
+                    endpoint=endpoint, repo_version_id=export_request['repo_version_id'],
+                    zipfilename=self.endpoint2filename_ocl_export_tar(endpoint)):
+                if export_ready_callback:
+                    export_ready_callback(ocl_export_def_key)
+            elif self.request_ocl_export(endpoint=endpoint, repo_version_id=export_request['repo_version_id']):
+                download_queue.put(export_request)
+            else:
+                pending_export_requests.append(export_request)
+
+        def download_export(export_request):
+            abort_check()
+            ocl_export_def_key = export_request['key']
+            self.vlog(1, '** [OCL Export %s of %s] %s:' % (
+                ocl_export_def_keys.index(ocl_export_def_key) + 1, num_total, ocl_export_def_key))
+            self.download_ocl_export(
+                endpoint=export_request['endpoint'], repo_version_id=export_request['repo_version_id'],
+                zipfilename=self.endpoint2filename_ocl_export_tar(export_request['endpoint']))
+            if export_ready_callback:
+                export_ready_callback(ocl_export_def_key)
+
+        def request_exports():
+            self.map_concurrently(request_export, ocl_export_def_keys, num_workers=self.ocl_export_workers)
+
+        def poll_exports():
+            self.wait_for_ocl_exports(pending_export_requests, export_ready_callback=download_queue.put,
+                                      abort_check=abort_check)
+            download_queue.close()
+
+        def download_exports():
+            self.map_concurrently(download_export, download_queue, num_workers=self.ocl_export_workers)
+
+        graph.add_task('request_ocl_exports', request_exports)
+        graph.add_task('poll_ocl_exports', poll_exports, depends_on=['request_ocl_exports'])
+        graph.add_task('download_ocl_exports', download_exports)
+        graph.run()
+
+    def compare_dhis2_exports(self, sync_mode=None):
+        """
+        Quick comparison of current and previous DHIS2 exports. Compares new DHIS2 export to most recent
+        previous export from a successful sync that is available and exits if there is nothing to import.
+        :param sync_mode: Mode of the current sync operation. See SYNC_MODE constants
+        :return: None
+        """
+        complete_match = True
+        if self.compare2previousexport and sync_mode != self.SYNC_MODE_DIFF_ONLY:
+            # Compare files for each of the DHIS2 queries
+            for dhis2_query_key, dhis2_query_def in self.DHIS2_QUERIES.iteritems():
+                self.vlog(1, dhis2_query_key + ':')
+                dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
+                dhis2filename_export_old = self.dhis2filename_export_old(dhis2_query_def['id'])
+                if self.filecmp(self.attach_absolute_path(dhis2filename_export_old),
+                                self.attach_absolute_path(dhis2filename_export_new)):
+                    self.vlog(1, '"%s" and "%s" are identical' % (
+                        dhis2filename_export_old, dhis2filename_export_new))
+                else:
+                    complete_match = True
+                    self.vlog(1, '"%s" and "%s" are NOT identical' % (
+                        dhis2filename_export_old, dhis2filename_export_new))
+
+            # Exit if complete match, because there is no import to perform
+            if complete_match:
+                self.vlog(1, 'All old and new DHIS2 exports are identical so there is no import to perform. Exiting...')
+                sys.exit()
+            else:
+                self.vlog(1, 'At least one DHIS2 export does not match, so continue...')
+        elif sync_mode == self.SYNC_MODE_DIFF_ONLY:
+            self.vlog(1, "SKIPPING: Diff check only...")
+        else:
+            self.vlog(1, "SKIPPING: compare2previousexport == false")
+
     def cache_dhis2_exports(self):
         """
         Delete old DHIS2 cached files if there
@@ -262,24 +453,124 @@ class DatimSync(DatimBase):
             self.vlog(1, 'Transformed DHIS2 exports successfully written to "%s"' % (
                 self.DHIS2_CONVERTED_EXPORT_FILENAME))
 
-    def save_dhis2_query_to_file(self, query='', query_attr=None, outputfilename=''):
-        """ Execute DHIS2 query and save to file """
+    def save_dhis2_query_to_file(self, query='', query_attr=None, outputfilename='', paged=False, chunk_attr=None):
+        """
+        Execute DHIS2 query and save to file, using the conditional-GET cache if the query is unchanged
+        :param query: DHIS2 query relative to dhis2env
+        :param query_attr: Optional attributes to replace in the query
+        :param outputfilename: Filename to save the response to
+        :param paged: Set to True to request the query in pages of dhis2_page_size records concurrently.
+            The pages are merged so that the file matches the response of the query with paging=false.
+        :param chunk_attr: Optional name of a query attribute containing a comma-separated list of IDs (e.g. for
+            an IN filter). The list is split into chunks of dhis2_query_chunk_size IDs that are queried
+            concurrently, and the results are merged and de-duplicated by ID.
+        :return: int number of bytes written to file
+        """
+
+        # Build one query URL for each chunk of IDs
+        query_attr_chunks = self.get_dhis2_query_attr_chunks(query_attr=query_attr, chunk_attr=chunk_attr)
+        urls_dhis2_query = [self.dhis2env + self.replace_attr(query, attr) for attr in query_attr_chunks]
+
+        # Execute a single query, saving the response directly to file
+        if len(urls_dhis2_query) == 1 and not paged:
+            self.vlog(1, 'Request URL:', urls_dhis2_query[0])
+            num_bytes, from_cache = self.dhis2_http_cache.get_to_file(
+                urls_dhis2_query[0], self.attach_absolute_path(outputfilename),
+                auth=HTTPBasicAuth(self.dhis2uid, self.dhis2pwd))
+            if from_cache:
+                self.vlog(1, 'DHIS2 export not modified, so using cached copy')
+            return num_bytes
+
+        # Execute the chunks concurrently and merge the results
+        if len(urls_dhis2_query) > 1:
+            self.vlog(1, 'Splitting "%s" into %s queries...' % (chunk_attr, len(urls_dhis2_query)))
+        contents = self.map_concurrently(
+            lambda (i, url): self.get_dhis2_query_content(
+                url, tmp_filename='%s.chunk%s' % (outputfilename, i + 1), paged=paged),
+            list(enumerate(urls_dhis2_query)), num_workers=self.PAGED_FETCH_WORKERS)
+        output = json.dumps(self.merge_dhis2_query_contents(contents))
+        with open(self.attach_absolute_path(outputfilename), 'wb') as output_file:
+            output_file.write(output)
+        return len(output)
+
+    def get_dhis2_query_attr_chunks(self, query_attr=None, chunk_attr=None):
+        """
+        Splits the comma-separated list of IDs in query_attr[chunk_attr] into chunks of dhis2_query_chunk_size
+        :return: list of query attribute dictionaries, one per chunk
+        """
+        if not query_attr or not chunk_attr or not query_attr.get(chunk_attr) or not self.dhis2_query_chunk_size:
+            return [query_attr]
+        ids = query_attr[chunk_attr].split(',')
+        query_attr_chunks = []
+        for i in range(0, len(ids), self.dhis2_query_chunk_size):
+            query_attr_chunk = dict(query_attr)
+            query_attr_chunk[chunk_attr] = ','.join(ids[i:i + self.dhis2_query_chunk_size])
+            query_attr_chunks.append(query_attr_chunk)
+        return query_attr_chunks
+
+    def merge_dhis2_query_contents(self, contents):
+        """
+        Merges the collection(s) of multiple DHIS2 responses (pages or chunks), dropping the pager and any
+        duplicate records with the same ID
+        :param contents: list of parsed DHIS2 responses
+        :return: dict in the same shape as a single response with paging=false
+        """
+        merged_content = {}
+        ids = {}
+        for content in contents:
+            for key, value in content.iteritems():
+                if key == 'pager':
+                    continue
+                elif isinstance(value, list):
+                    merged_content.setdefault(key, [])
+                    ids.setdefault(key, set())
+                    for record in value:
+                        if isinstance(record, dict) and 'id' in record:
+                            if record['id'] in ids[key]:
+                                continue
+                            ids[key].add(record['id'])
+                        merged_content[key].append(record)
+                else:
+                    merged_content[key] = value
+        return merged_content
 
-        # Replace query attribute names with values and build the query URL
-        url_dhis2_query = self.dhis2env + self.replace_attr(query, query_attr)
+    def get_dhis2_query_content(self, url_dhis2_query, tmp_filename='', paged=False):
+        """
+        Executes a DHIS2 query through the conditional-GET cache and returns the parsed response. If paged,
+        the number of pages is read from the pager of the first page, the remaining pages are fetched
+        concurrently and all pages are merged. Each page is cached separately.
+        :param url_dhis2_query: Full URL of the DHIS2 query, without paging parameters
+        :param tmp_filename: Filename used to temporarily save each response before it is parsed
+        :param paged: Set to True to request the query in pages of dhis2_page_size records
+        :return: dict
+        """
 
-        # Execute the query
-        self.vlog(1, 'Request URL:', url_dhis2_query)
-        r = requests.get(url_dhis2_query, auth=HTTPBasicAuth(self.dhis2uid, self.dhis2pwd))
-        r.raise_for_status()
-        with open(self.attach_absolute_path(outputfilename), 'wb') as handle:
-            for block in r.iter_content(1024):
-                handle.write(block)
-        return r.headers['Content-Length']
+        def fetch_page(page):
+            if paged:
+                url_page = self.add_query_params(url_dhis2_query, {
+                    'paging': 'true', 'pageSize': self.dhis2_page_size, 'page': page})
+                page_filename = '%s.page%s' % (tmp_filename, page)
+            else:
+                url_page = url_dhis2_query
+                page_filename = tmp_filename
+            self.vlog(1, 'Request URL:', url_page)
+            num_bytes, from_cache = self.dhis2_http_cache.get_to_file(
+                url_page, self.attach_absolute_path(page_filename), auth=HTTPBasicAuth(self.dhis2uid, self.dhis2pwd))
+            if from_cache:
+                self.vlog(1, 'DHIS2 export not modified, so using cached copy')
+            with open(self.attach_absolute_path(page_filename), 'rb') as input_file:
+                content = json.load(input_file)
+            os.remove(self.attach_absolute_path(page_filename))
+            return content
+
+        def get_num_pages(content):
+            return content.get('pager', {}).get('pageCount', 1) if paged else 1
+
+        return self.merge_dhis2_query_contents(self.fetch_pages(fetch_page, get_num_pages))
 
     def perform_diff(self, ocl_diff=None, dhis2_diff=None):
         """
-        Performs deep diff on the prepared OCL and DHIS2 resources
+        Performs a keyed diff on the prepared OCL and DHIS2 resources
         :param ocl_diff: Content from OCL for the diff
         :param dhis2_diff: Content from DHIS2 for the diff
         :return:
@@ -289,10 +580,9 @@ class DatimSync(DatimBase):
             diff[import_batch_key] = {}
             for resource_type in self.sync_resource_types:
                 if resource_type in ocl_diff[import_batch_key] and resource_type in dhis2_diff[import_batch_key]:
-                    diff[import_batch_key][resource_type] = DeepDiff(
+                    diff[import_batch_key][resource_type] = DatimKeyedDiff(
                         ocl_diff[import_batch_key][resource_type],
-                        dhis2_diff[import_batch_key][resource_type],
-                        ignore_order=True, verbose_level=2)
+                        dhis2_diff[import_batch_key][resource_type])
                     if self.verbosity:
                         str_log = 'IMPORT_BATCH["%s"]["%s"]: ' % (import_batch_key, resource_type)
                         for k in diff[import_batch_key][resource_type]:
@@ -306,6 +596,10 @@ class DatimSync(DatimBase):
         :param diff: Diff results used to generate the import script
         :return:
         """
+        reference_planner = DatimReferencePlanner(
+            latency_stats=self.reference_latency_stats, default_batch_size=self.CONSOLIDATED_REFERENCE_BATCH_LIMIT)
+        if self.consolidate_references:
+            self.add_mappings_to_reference_planner(reference_planner)
         with open(self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME), 'wb') as output_file:
             for import_batch in self.IMPORT_BATCHES:
                 for resource_type in self.sync_resource_types:
@@ -313,8 +607,6 @@ class DatimSync(DatimBase):
                         continue
 
                     # Process new items
-                    consolidated_concept_refs = {}
-                    consolidated_mapping_refs = {}
                     if 'dictionary_item_added' in diff[import_batch][resource_type]:
                         for k, r in diff[import_batch][resource_type]['dictionary_item_added'].iteritems():
                             if resource_type == self.RESOURCE_TYPE_CONCEPT and r['type'] == self.RESOURCE_TYPE_CONCEPT:
@@ -323,30 +615,11 @@ class DatimSync(DatimBase):
                             elif resource_type == self.RESOURCE_TYPE_MAPPING and r['type'] == self.RESOURCE_TYPE_MAPPING:
                                 output_file.write(json.dumps(r))
                                 output_file.write('\n')
-                            elif resource_type == self.RESOURCE_TYPE_CONCEPT_REF and r['type'] == self.RESOURCE_TYPE_REFERENCE:
-                                r['__cascade'] = 'sourcemappings'
-                                if self.consolidate_references:
-                                    if r['collection_url'] in consolidated_concept_refs:
-                                        consolidated_concept_refs[r['collection_url']]['data']['expressions'].append(
-                                            r['data']['expressions'][0])
-                                        # Go ahead and write if reached the reference limit
-                                        if len(consolidated_concept_refs[r['collection_url']]['data']['expressions']) >= self.CONSOLIDATED_REFERENCE_BATCH_LIMIT:
-                                            output_file.write(json.dumps(consolidated_concept_refs[r['collection_url']]))
-                                            output_file.write('\n')
-                                            del(consolidated_concept_refs[r['collection_url']])
-                                    else:
-                                        consolidated_concept_refs[r['collection_url']] = r.copy()
-                                else:
-                                    output_file.write(json.dumps(r))
-                                    output_file.write('\n')
-                            elif resource_type == self.RESOURCE_TYPE_MAPPING_REF and r['type'] == self.RESOURCE_TYPE_REFERENCE:
+                            elif (resource_type in [self.RESOURCE_TYPE_CONCEPT_REF, self.RESOURCE_TYPE_MAPPING_REF]
+                                  and r['type'] == self.RESOURCE_TYPE_REFERENCE):
                                 r['__cascade'] = 'sourcemappings'
                                 if self.consolidate_references:
-                                    if r['collection_url'] in consolidated_mapping_refs:
-                                        consolidated_mapping_refs[r['collection_url']]['data']['expressions'].append(
-                                            r['data']['expressions'][0])
-                                    else:
-                                        consolidated_mapping_refs[r['collection_url']] = r.copy()
+                                    reference_planner.add(r)
                                 else:
                                     output_file.write(json.dumps(r))
                                     output_file.write('\n')
@@ -354,28 +627,94 @@ class DatimSync(DatimBase):
                                 self.log('ERROR: Unrecognized resource_type "%s": {%s}' % (resource_type, str(r)))
                                 sys.exit(1)
 
-                    # Write consolidated references for new items
-                    if self.consolidate_references:
-                        for collection_url in consolidated_concept_refs:
-                            output_file.write(json.dumps(consolidated_concept_refs[collection_url]))
-                            output_file.write('\n')
-                        for collection_url in consolidated_mapping_refs:
-                            output_file.write(json.dumps(consolidated_mapping_refs[collection_url]))
-                            output_file.write('\n')
-
                     # Process updated items
-                    if 'value_changed' in diff[import_batch][resource_type]:
+                    if 'values_changed' in diff[import_batch][resource_type]:
                         self.vlog(1, 'WARNING: Updates are not yet supported. Skipping %s updates...' % len(
-                            diff[import_batch][resource_type]))
+                            diff[import_batch][resource_type]['values_changed']))
 
                     # Process deleted items
                     if 'dictionary_item_removed' in diff[import_batch][resource_type]:
                         self.vlog(
                             1, 'WARNING: Retiring and deletes are not yet supported. Skipping %s removals...' % len(
-                                diff[import_batch][resource_type]))
+                                diff[import_batch][resource_type]['dictionary_item_removed']))
+
+            # Write the consolidated references after all concepts and mappings that they may include
+            if self.consolidate_references:
+                reference_batches = reference_planner.plan()
+                for reference in reference_batches:
+                    output_file.write(json.dumps(reference))
+                    output_file.write('\n')
+                self.vlog(1, 'Consolidated %s references into %s reference requests' % (
+                    reference_planner.num_references, len(reference_batches)))
+                self.vlog(1, 'Cascade to source mappings avoided for %s expressions already covered by '
+                             'mapping references' % reference_planner.num_cascades_avoided)
 
         self.vlog(1, 'New import script written to file "%s"' % self.NEW_IMPORT_SCRIPT_FILENAME)
 
+    @staticmethod
+    def parse_mapping_key(key):
+        """
+        Splits a mapping key or mapping reference key into its repository URL and query parameters
+        Ex: '/orgs/PEPFAR/sources/MER/mappings/?from=...&maptype=...&to=...' ==>
+        ('/orgs/PEPFAR/sources/MER/', {'from': ..., 'maptype': ..., 'to': ...})
+        """
+        path, _, query = key.partition('?')
+        repo_url = path[:path.rstrip('/').rfind('/') + 1]
+        return repo_url, dict(param.partition('=')[::2] for param in query.split('&'))
+
+    def add_mappings_to_reference_planner(self, reference_planner):
+        """
+        Tells the reference planner which mappings exist in the exported sources or are created by the import, and
+        which mappings each collection references already or will reference explicitly, so that the planner can
+        drop the cascade to source mappings where it would not add anything to the collection
+        :param reference_planner: DatimReferencePlanner
+        :return: None
+        """
+        for ocl_export_def in self.OCL_EXPORT_DEFS.values():
+            if '/sources/' in ocl_export_def['endpoint']:
+                reference_planner.add_complete_source(ocl_export_def['endpoint'])
+        for import_batch in self.IMPORT_BATCHES:
+            for resource_diff in [self.ocl_diff.get(import_batch), self.dhis2_diff.get(import_batch)]:
+                if not resource_diff:
+                    continue
+                for mapping_key in resource_diff.get(self.RESOURCE_TYPE_MAPPING, {}):
+                    source_url, params = self.parse_mapping_key(mapping_key)
+                    reference_planner.add_source_mapping(
+                        source_url, params.get('from', ''), params.get('maptype', ''), params.get('to', ''))
+                for mapping_ref_key in resource_diff.get(self.RESOURCE_TYPE_MAPPING_REF, {}):
+                    collection_url, params = self.parse_mapping_key(mapping_ref_key)
+                    reference_planner.add_collection_mapping(
+                        collection_url, params.get('source', ''), params.get('from', ''), params.get('maptype', ''),
+                        params.get('to', ''))
+
+    def validate_import_script(self):
+        """
+        Moves the lines of the import script whose mappings or references point to concepts or mappings that are
+        neither in the OCL exports nor created earlier in the script to a quarantine file
+        :return: int Number of lines quarantined
+        """
+        validator = OclImportScriptValidator(existence_index=self.ocl_existence_index, verbosity=self.verbosity)
+        num_kept, num_quarantined = validator.validate(
+            self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME),
+            self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME + '.quarantine.json'))
+        if num_quarantined:
+            self.vlog(1, 'WARNING: %s lines with unresolved concepts or mappings quarantined to "%s"' % (
+                num_quarantined, self.NEW_IMPORT_SCRIPT_FILENAME + '.quarantine.json'))
+        else:
+            self.vlog(1, 'All %s lines of the import script passed the referential integrity check' % num_kept)
+        if validator.unconfirmed_urls:
+            self.vlog(1, 'WARNING: %s concepts or mappings used by the import script are missing from the OCL '
+                         'exports and are left to OCL' % len(validator.unconfirmed_urls))
+        return num_quarantined
+
+    def shard_import_script(self):
+        """ Shards the import script by repository so that independent repositories can be imported in parallel """
+        manifest = OclShardedImporter.shard_import_script(
+            self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME),
+            self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME + '.manifest.json'))
+        self.vlog(1, 'Import script split into %s shards listed in "%s"' % (
+            len(manifest['shards']), self.NEW_IMPORT_SCRIPT_FILENAME + '.manifest.json'))
+
     def get_mapping_reference_json_from_export(
             self, full_collection_export_dict=None, collection_url='', collection_owner_id='',
             collection_owner_type='', collection_id='', mapping_url='', strip_mapping_version=False):
@@ -470,7 +809,8 @@ class DatimSync(DatimBase):
                 query_attr = {'active_dataset_ids': self.str_active_dataset_ids}
                 content_length = self.save_dhis2_query_to_file(
                     query=dhis2_query_def['query'], query_attr=query_attr,
-                    outputfilename=dhis2filename_export_new)
+                    outputfilename=dhis2filename_export_new, paged=dhis2_query_def.get('paged', False),
+                    chunk_attr=dhis2_query_def.get('chunk_attr'))
                 self.vlog(1, '%s bytes retrieved from DHIS2 and written to file "%s"' % (
                     content_length, dhis2filename_export_new))
             else:
@@ -500,6 +840,9 @@ class DatimSync(DatimBase):
         if sync_mode not in self.SYNC_MODES:
             self.log('ERROR: Invalid sync_mode "%s"' % sync_mode)
             sys.exit(1)
+        if self.import_backend not in self.IMPORT_BACKENDS:
+            self.log('ERROR: Invalid import_backend "%s"' % self.import_backend)
+            sys.exit(1)
 
         # Determine which resource types will be processed during this run
         if resource_types:
@@ -519,84 +862,60 @@ class DatimSync(DatimBase):
         else:
             self.vlog(1, 'SKIPPING: SYNC_LOAD_DATASETS set to "False"')
 
-        # STEP 2: Load new exports from DATIM-DHIS2
-        # NOTE: This step occurs regardless of sync mode
-        self.vlog(1, '**** STEP 2 of 12: Load new exports from DATIM DHIS2')
-        self.load_dhis2_exports()
-
-        # STEP 3: Quick comparison of current and previous DHIS2 exports
-        # Compares new DHIS2 export to most recent previous export from a successful sync that is available
-        # NOTE: This step is skipped if in DIFF mode or compare2previousexport is set to False
-        self.vlog(1, '**** STEP 3 of 12: Quick comparison of current and previous DHIS2 exports')
-        complete_match = True
-        if self.compare2previousexport and sync_mode != DatimSync.SYNC_MODE_DIFF_ONLY:
-            # Compare files for each of the DHIS2 queries
-            for dhis2_query_key, dhis2_query_def in self.DHIS2_QUERIES.iteritems():
-                self.vlog(1, dhis2_query_key + ':')
-                dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
-                dhis2filename_export_old = self.dhis2filename_export_old(dhis2_query_def['id'])
-                if self.filecmp(self.attach_absolute_path(dhis2filename_export_old),
-                                self.attach_absolute_path(dhis2filename_export_new)):
-                    self.vlog(1, '"%s" and "%s" are identical' % (
-                        dhis2filename_export_old, dhis2filename_export_new))
-                else:
-                    complete_match = True
-                    self.vlog(1, '"%s" and "%s" are NOT identical' % (
-                        dhis2filename_export_old, dhis2filename_export_new))
-
-            # Exit if complete match, because there is no import to perform
-            if complete_match:
-                self.vlog(1, 'All old and new DHIS2 exports are identical so there is no import to perform. Exiting...')
-                sys.exit()
-            else:
-                self.vlog(1, 'At least one DHIS2 export does not match, so continue...')
-        elif sync_mode == DatimSync.SYNC_MODE_DIFF_ONLY:
-            self.vlog(1, "SKIPPING: Diff check only...")
-        else:
-            self.vlog(1, "SKIPPING: compare2previousexport == false")
-
-        # STEP 4: Fetch latest versions of relevant OCL exports
-        # NOTE: This step occurs regardless of sync mode
-        self.vlog(1, '**** STEP 4 of 12: Fetch latest versions of relevant OCL exports')
-        cnt = 0
-        num_total = len(self.OCL_EXPORT_DEFS)
-        for ocl_export_def_key in self.OCL_EXPORT_DEFS:
-            cnt += 1
-            self.vlog(1, '** [OCL Export %s of %s] %s:' % (cnt, num_total, ocl_export_def_key))
-            export_def = self.OCL_EXPORT_DEFS[ocl_export_def_key]
-            zipfilename = self.endpoint2filename_ocl_export_tar(export_def['endpoint'])
-            jsonfilename = self.endpoint2filename_ocl_export_json(export_def['endpoint'])
-            if not self.run_ocl_offline:
-                self.get_ocl_export(endpoint=export_def['endpoint'], version='latest', zipfilename=zipfilename,
-                                    jsonfilename=jsonfilename)
-            else:
-                self.vlog(1, 'OCL-OFFLINE: Using local file "%s"...' % jsonfilename)
-                if os.path.isfile(self.attach_absolute_path(jsonfilename)):
-                    self.vlog(1, 'OCL-OFFLINE: File "%s" found containing %s bytes. Continuing...' % (
-                        jsonfilename, os.path.getsize(self.attach_absolute_path(jsonfilename))))
-                else:
-                    self.log('ERROR: Could not find offline OCL file "%s". Exiting...' % jsonfilename)
-                    sys.exit(1)
-
-        # STEP 5: Transform new DHIS2 export to diff format
-        # NOTE: This step occurs regardless of sync mode
-        self.vlog(1, '**** STEP 5 of 12: Transform DHIS2 exports to OCL-formatted JSON')
+        # STEPS 2-6: Download DHIS2 and OCL content and prepare it for the diff
+        # These steps run as a task graph so that independent steps overlap: DHIS2 queries and OCL exports
+        # download at the same time, and each OCL export is cleaned as soon as it lands. The bounded queue
+        # between STEP 4 and STEP 6 stops downloads from running too far ahead of cleaning.
+        # NOTE: These steps occur regardless of sync mode
         self.dhis2_diff = {}
-        for import_batch_key in self.IMPORT_BATCHES:
-            self.dhis2_diff[import_batch_key] = {}
-            for resource_type in self.DEFAULT_SYNC_RESOURCE_TYPES:
-                self.dhis2_diff[import_batch_key][resource_type] = {}
-        self.transform_dhis2_exports(conversion_attr={'ocl_dataset_repos': self.ocl_dataset_repos})
-
-        # STEP 6: Prepare OCL exports for diff
-        # NOTE: This step occurs regardless of sync mode
-        self.vlog(1, '**** STEP 6 of 12: Prepare OCL exports for diff')
         self.ocl_diff = {}
         for import_batch_key in self.IMPORT_BATCHES:
+            self.dhis2_diff[import_batch_key] = {}
             self.ocl_diff[import_batch_key] = {}
             for resource_type in self.DEFAULT_SYNC_RESOURCE_TYPES:
+                self.dhis2_diff[import_batch_key][resource_type] = {}
                 self.ocl_diff[import_batch_key][resource_type] = {}
-        self.prepare_ocl_exports(cleaning_attr={})
+        if not self.run_ocl_offline:
+            # Lets the importer skip HEAD requests for resources found (or not found) in the exports. Absence
+            # from an export only counts for repositories that no import has changed since their latest version.
+            self.ocl_existence_index = OclExistenceIndex()
+            self.ocl_unversioned_repos = self.get_unversioned_ocl_repos()
+        graph = DatimTaskGraph()
+        ocl_export_queue = graph.queue(maxsize=self.ocl_export_queue_size)
+
+        # STEP 2: Load new exports from DATIM-DHIS2
+        def load_dhis2_exports():
+            self.vlog(1, '**** STEP 2 of 12: Load new exports from DATIM DHIS2')
+            self.load_dhis2_exports()
+
+        # STEP 3: Quick comparison of current and previous DHIS2 exports
+        # NOTE: This step is skipped if in DIFF mode or compare2previousexport is set to False
+        def compare_dhis2_exports():
+            self.vlog(1, '**** STEP 3 of 12: Quick comparison of current and previous DHIS2 exports')
+            self.compare_dhis2_exports(sync_mode=sync_mode)
+
+        # STEP 4: Fetch latest versions of relevant OCL exports -- each export is queued for STEP 6 once saved
+        def fetch_ocl_exports():
+            self.vlog(1, '**** STEP 4 of 12: Fetch latest versions of relevant OCL exports')
+            self.fetch_ocl_exports(export_ready_callback=ocl_export_queue.put, parent_graph=graph)
+            ocl_export_queue.close()
+
+        # STEP 5: Transform new DHIS2 export to diff format -- needs only the DHIS2 exports and dataset repos
+        def transform_dhis2_exports():
+            self.vlog(1, '**** STEP 5 of 12: Transform DHIS2 exports to OCL-formatted JSON')
+            self.transform_dhis2_exports(conversion_attr={'ocl_dataset_repos': self.ocl_dataset_repos})
+
+        # STEP 6: Prepare OCL exports for diff, consuming exports from STEP 4 as they land
+        def prepare_ocl_exports():
+            self.vlog(1, '**** STEP 6 of 12: Prepare OCL exports for diff')
+            self.prepare_ocl_exports(cleaning_attr={}, ocl_export_def_keys=ocl_export_queue)
+
+        graph.add_task('load_dhis2_exports', load_dhis2_exports)
+        graph.add_task('compare_dhis2_exports', compare_dhis2_exports, depends_on=['load_dhis2_exports'])
+        graph.add_task('fetch_ocl_exports', fetch_ocl_exports)
+        graph.add_task('transform_dhis2_exports', transform_dhis2_exports, depends_on=['load_dhis2_exports'])
+        graph.add_task('prepare_ocl_exports', prepare_ocl_exports)
+        graph.run()
 
         # STEP 7: Perform deep diff
         # One deep diff is performed per resource type in each import batch
@@ -628,6 +947,14 @@ class DatimSync(DatimBase):
         self.vlog(1, '**** STEP 9 of 12: Generate import scripts')
         if sync_mode != DatimSync.SYNC_MODE_DIFF_ONLY:
             self.generate_import_scripts(self.diff_result)
+            if self.validate_import_references:
+                self.validate_import_script()
+            if self.compile_import_script and self.import_backend == self.IMPORT_BACKEND_FLEX:
+                num_compiled = OclFlexImporter.compile_import_script(
+                    self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME))
+                self.vlog(1, 'Compiled %s lines of the import script' % num_compiled)
+            if self.import_processes > 1 and self.import_backend == self.IMPORT_BACKEND_FLEX:
+                self.shard_import_script()
         else:
             self.vlog(1, 'SKIPPING: Diff check only')
 
@@ -636,17 +963,55 @@ class DatimSync(DatimBase):
         self.vlog(1, '**** STEP 10 of 12: Perform the import in OCL')
         num_import_rows_processed = 0
         ocl_importer = None
+        import_error = None
         if sync_mode in [DatimSync.SYNC_MODE_TEST_IMPORT, DatimSync.SYNC_MODE_FULL_IMPORT]:
             test_mode = False
             if sync_mode == DatimSync.SYNC_MODE_TEST_IMPORT:
                 test_mode = True
-            ocl_importer = OclFlexImporter(
-                file_path=self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME),
-                api_token=self.oclapitoken, api_url_root=self.oclenv, test_mode=test_mode,
-                do_update_if_exists=False, verbosity=self.verbosity, limit=self.import_limit,
-                import_delay=self.import_delay)
-            num_import_rows_processed = ocl_importer.process()
-            self.vlog(1, 'Import records processed:', num_import_rows_processed)
+            if self.import_backend == self.IMPORT_BACKEND_BULK:
+                ocl_importer = OclBulkImporter(
+                    file_path=self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME),
+                    api_token=self.oclapitoken, api_url_root=self.oclenv, test_mode=test_mode,
+                    do_update_if_exists=False, verbosity=self.verbosity, limit=self.import_limit,
+                    http_client=self.http_client, compact_results=True,
+                    results_detail_log=self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME + '.results.jsonl'),
+                    bulk_import_url=self.bulk_import_url)
+            elif self.import_processes > 1:
+                if self.import_limit:
+                    self.vlog(1, 'WARNING: import_limit is not supported when importing shards. Importing all...')
+                ocl_importer = OclShardedImporter(
+                    manifest_path=self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME + '.manifest.json'),
+                    api_token=self.oclapitoken, api_url_root=self.oclenv, test_mode=test_mode,
+                    do_update_if_exists=False, verbosity=self.verbosity, import_delay=self.import_delay,
+                    num_processes=self.import_processes, num_workers=self.import_workers,
+                    existence_index=self.ocl_existence_index, compact_results=True,
+                    results_detail_log=self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME + '.results.jsonl'),
+                    resume=self.resume_import, reference_latency_stats_path=self.reference_latency_stats.path)
+            else:
+                ocl_importer = OclFlexImporter(
+                    file_path=self.attach_absolute_path(self.NEW_IMPORT_SCRIPT_FILENAME),
+                    api_token=self.oclapitoken, api_url_root=self.oclenv, test_mode=test_mode,
+                    do_update_if_exists=False, verbosity=self.verbosity, limit=self.import_limit,
+                    import_delay=self.import_delay, http_client=self.http_client, num_workers=self.import_workers,
+                    existence_index=self.ocl_existence_index, compact_results=True,
+                    results_detail_log=self.attach_absolute_path(
+                        self.NEW_IMPORT_SCRIPT_FILENAME + '.results.jsonl'),
+                    checkpoint_path=self.attach_absolute_path(
+                        self.NEW_IMPORT_SCRIPT_FILENAME + '.checkpoint.json'),
+                    resume=self.resume_import, reference_latency_stats=self.reference_latency_stats)
+            if not test_mode:
+                # Recorded before the import starts, so that an interrupted import is not missed
+                self.update_unversioned_ocl_repos(
+                    add_endpoints=[ocl_export_def['endpoint'] for ocl_export_def in self.OCL_EXPORT_DEFS.values()])
+            try:
+                num_import_rows_processed = ocl_importer.process()
+                self.vlog(1, 'Import records processed:', num_import_rows_processed)
+            except OclImportError as e:
+                # Repositories imported by the shards that succeeded still get a new version in STEP 12
+                if not isinstance(ocl_importer, OclShardedImporter):
+                    raise
+                import_error = e
+                self.log('ERROR: %s' % e)
         elif sync_mode == DatimSync.SYNC_MODE_DIFF_ONLY:
             self.vlog(1, 'SKIPPING: Diff check only...')
         elif sync_mode == DatimSync.SYNC_MODE_BUILD_IMPORT_SCRIPT:
@@ -655,7 +1020,9 @@ class DatimSync(DatimBase):
         # STEP 11: Save new DHIS2 export for the next sync attempt
         self.vlog(1, '**** STEP 11 of 12: Save the DHIS2 export')
         if sync_mode == DatimSync.SYNC_MODE_FULL_IMPORT:
-            if num_import_rows_processed:
+            if import_error:
+                self.vlog(1, 'SKIPPING: Import failed for some shards...')
+            elif num_import_rows_processed:
                 self.cache_dhis2_exports()
             else:
                 self.vlog(1, 'SKIPPING: No records imported (possibly due to error)...')
@@ -669,9 +1036,16 @@ class DatimSync(DatimBase):
         # STEP 12: Manage OCL repository versions
         self.vlog(1, '**** STEP 12 of 12: Manage OCL repository versions')
         if sync_mode == DatimSync.SYNC_MODE_FULL_IMPORT:
-            if num_import_rows_processed:
-                self.increment_ocl_versions(import_results=ocl_importer.import_results)
+            ocl_export_endpoints = [ocl_export_def['endpoint'] for ocl_export_def in self.OCL_EXPORT_DEFS.values()]
+            if num_import_rows_processed or import_error:
+                settled_endpoints = self.increment_ocl_versions(import_results=ocl_importer.import_results)
+                if not import_error:
+                    # Repositories without any import result were not changed by the import
+                    settled_endpoints += [endpoint for endpoint in ocl_export_endpoints
+                                          if not ocl_importer.import_results.has(root_key=endpoint)]
+                self.update_unversioned_ocl_repos(remove_endpoints=settled_endpoints)
             else:
+                self.update_unversioned_ocl_repos(remove_endpoints=ocl_export_endpoints)
                 self.vlog(1, 'Skipping because no records imported...')
         elif sync_mode == DatimSync.SYNC_MODE_DIFF_ONLY:
             self.vlog(1, 'SKIPPING: Diff check only...')
@@ -684,6 +1058,10 @@ class DatimSync(DatimBase):
             if ocl_importer and ocl_importer.import_results:
                 print(ocl_importer.import_results.get_detailed_summary())
 
+        # Fail the sync once the repositories that were imported have been versioned
+        if import_error:
+            raise import_error
+
         # Return the diff result (may return something else in the end)
         if self.diff_result:
             return self.DATIM_SYNC_DIFF
@@ -157,7 +157,13 @@ oclapitoken = 'c3b42623c04c87e266d12ae0e297abbce7f1cbe8'
 sync_mode = DatimSync.SYNC_MODE_DIFF_ONLY  # Set which operation is performed by the sync script
 verbosity = 2  # 0=none, 1=some, 2=all
 import_limit = 0  # Number of resources to import; 0=all
-import_delay = 3  # Number of seconds to delay between each import request
+import_delay = 3  # Initial number of seconds between import requests; adapts to OCL response times
+import_workers = 1  # Number of import requests sent at the same time; 1=sequential
+import_processes = 1  # Number of repositories imported at the same time by separate processes; 1=one process
+resume_import = False  # Set to True to continue an interrupted import from its checkpoint
+compile_import_script = False  # Set to True to resolve URLs and fields of the import script before importing
+import_backend = DatimSync.IMPORT_BACKEND_FLEX  # 'flex'=one request per line; 'bulk'=OCL bulk import jobs
+bulk_import_url = '/manage/bulkimport/'  # Bulk import endpoint, relative to oclenv or an absolute URL
 compare2previousexport = False  # Set to False to ignore the previous export; set to True only after a full import
 run_dhis2_offline = False  # Set to true to use local copies of dhis2 exports
 run_ocl_offline = False  # Set to true to use local copies of ocl exports
@@ -174,6 +180,18 @@ if len(sys.argv) > 1 and sys.argv[1] in ['true', 'True']:
       import_limit = os.environ['IMPORT_LIMIT']
     if "IMPORT_DELAY" in os.environ:
       import_delay = float(os.environ['IMPORT_DELAY'])
+    if "IMPORT_WORKERS" in os.environ:
+      import_workers = int(os.environ['IMPORT_WORKERS'])
+    if "IMPORT_PROCESSES" in os.environ:
+      import_processes = int(os.environ['IMPORT_PROCESSES'])
+    if "RESUME_IMPORT" in os.environ:
+      resume_import = os.environ['RESUME_IMPORT'] in ['true', 'True']
+    if "COMPILE_IMPORT_SCRIPT" in os.environ:
+      compile_import_script = os.environ['COMPILE_IMPORT_SCRIPT'] in ['true', 'True']
+    if "IMPORT_BACKEND" in os.environ:
+      import_backend = os.environ['IMPORT_BACKEND']
+    if "BULK_IMPORT_URL" in os.environ:
+      bulk_import_url = os.environ['BULK_IMPORT_URL']
     if "COMPARE_PREVIOUS_EXPORT" in os.environ:
       compare2previousexport = os.environ['COMPARE_PREVIOUS_EXPORT'] in ['true', 'True']
     if "SYNC_MODE" in os.environ:
@@ -189,4 +207,10 @@ datim_sync = DatimSyncMechanisms(
     compare2previousexport=compare2previousexport, run_dhis2_offline=run_dhis2_offline,
     run_ocl_offline=run_ocl_offline, verbosity=verbosity, import_limit=import_limit)
 datim_sync.import_delay = import_delay
+datim_sync.import_workers = import_workers
+datim_sync.import_processes = import_processes
+datim_sync.resume_import = resume_import
+datim_sync.compile_import_script = compile_import_script
+datim_sync.import_backend = import_backend
+datim_sync.bulk_import_url = bulk_import_url
 datim_sync.run(sync_mode=sync_mode)
@@ -1,5 +1,4 @@
 import sys
-import requests
 import warnings
 import difflib
 from deepdiff import DeepDiff
@@ -75,7 +74,7 @@ class DatimSyncTest(DatimBase):
         for export_def_key in DatimConstants.MER_OCL_EXPORT_DEFS:
             # Fetch the external_id from OCL, which is the DHIS2 dataSet uid
             url_ocl_repo = self.oclenv + DatimConstants.MER_OCL_EXPORT_DEFS[export_def_key]['endpoint']
-            r = requests.get(url_ocl_repo, headers=self.oclapiheaders)
+            r = self.http_client.get(url_ocl_repo, headers=self.oclapiheaders)
             repo = r.json()
             print('\n**** %s (dataSet.id=%s) ****' % (DatimConstants.MER_OCL_EXPORT_DEFS[export_def_key]['endpoint'], repo['external_id']))
             if not repo['external_id']:
@@ -103,8 +102,8 @@ class DatimSyncTest(DatimBase):
         print('OCL:   %s' % ocl_presentation_url)
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            request_dhis2 = requests.get(dhis2_presentation_url)
-            request_ocl = requests.get(ocl_presentation_url, verify=False)
+            request_dhis2 = self.http_client.get(dhis2_presentation_url)
+            request_ocl = self.http_client.get(ocl_presentation_url, verify=False)
         diff = None
         if format == DatimShow.DATIM_FORMAT_JSON:
             diff = self.test_json(request_dhis2, request_ocl)
@@ -0,0 +1,133 @@
+"""
+Minimal task graph used to overlap independent steps of a DATIM sync
+
+Each task runs in its own thread as soon as all of the tasks it depends on have completed. If a task
+fails (including calls to sys.exit), no further tasks are started, queues between tasks are aborted so
+that no producer or consumer blocks forever, and the first error is re-raised by DatimTaskGraph.run().
+"""
+import sys
+import threading
+import Queue
+
+
+class DatimTaskGraphAborted(Exception):
+    """ Raised inside a running task when another task in the same graph has failed """
+    pass
+
+
+class DatimTaskQueue:
+    """ Bounded queue connecting a producer task to a consumer task, providing backpressure """
+
+    # Seconds between checks of whether the graph has been aborted while blocked
+    POLL_INTERVAL = 0.5
+
+    _END_OF_QUEUE = object()
+
+    def __init__(self, graph, maxsize=0):
+        self.graph = graph
+        self._queue = Queue.Queue(maxsize)
+
+    def put(self, item):
+        """ Add an item, blocking while the queue is full """
+        while True:
+            if self.graph.aborted:
+                raise DatimTaskGraphAborted()
+            try:
+                self._queue.put(item, timeout=self.POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def close(self):
+        """ Signal the consumer that no more items will be added """
+        self.put(self._END_OF_QUEUE)
+
+    def __iter__(self):
+        """ Yield items in the order they were added until the producer closes the queue """
+        while True:
+            if self.graph.aborted:
+                raise DatimTaskGraphAborted()
+            try:
+                item = self._queue.get(timeout=self.POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            if item is self._END_OF_QUEUE:
+                return
+            yield item
+
+
+class DatimTaskGraph:
+    """ Runs a set of named tasks concurrently while respecting their declared dependencies """
+
+    def __init__(self):
+        self.tasks = []
+        self.aborted = False
+        self._completed = set()
+        self._errors = []
+        self._condition = threading.Condition()
+
+    def add_task(self, name, func, depends_on=None):
+        """
+        Add a task to the graph
+        :param name: Unique name of the task
+        :param func: Callable with no arguments
+        :param depends_on: Optional list of names of tasks that must complete before this task starts
+        :return: None
+        """
+        self.tasks.append({'name': name, 'func': func, 'depends_on': list(depends_on or [])})
+
+    def raise_if_aborted(self):
+        """ Raises DatimTaskGraphAborted if another task in this graph has failed """
+        if self.aborted:
+            raise DatimTaskGraphAborted()
+
+    def queue(self, maxsize=0):
+        """ Returns a new bounded queue tied to this graph """
+        return DatimTaskQueue(self, maxsize=maxsize)
+
+    def _run_task(self, task):
+        try:
+            task['func']()
+        except BaseException:
+            with self._condition:
+                if not isinstance(sys.exc_info()[1], DatimTaskGraphAborted):
+                    self._errors.append(sys.exc_info())
+                self.aborted = True
+                self._condition.notify_all()
+            return
+        with self._condition:
+            self._completed.add(task['name'])
+            self._condition.notify_all()
+
+    def run(self):
+        """ Run all tasks and wait for them to finish. Re-raises the first error raised by any task. """
+        task_names = [task['name'] for task in self.tasks]
+        for task in self.tasks:
+            for dependency in task['depends_on']:
+                if dependency not in task_names:
+                    raise ValueError('Task "%s" depends on unknown task "%s"' % (task['name'], dependency))
+
+        pending = list(self.tasks)
+        threads = []
+        with self._condition:
+            while pending and not self.aborted:
+                ready = [task for task in pending if set(task['depends_on']).issubset(self._completed)]
+                if not ready and not [t for t in threads if t.is_alive()]:
+                    raise ValueError('Circular dependency between tasks: %s' % (
+                        ', '.join([task['name'] for task in pending])))
+                for task in ready:
+                    pending.remove(task)
+                    t = threading.Thread(target=self._run_task, args=(task,), name=task['name'])
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                if pending:
+                    # A timeout keeps the main thread responsive to KeyboardInterrupt
+                    self._condition.wait(1)
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+        if self._errors:
+            raise self._errors[0][0], self._errors[0][1], self._errors[0][2]
+        if pending or self.aborted:
+            raise DatimTaskGraphAborted()
@@ -23,12 +23,28 @@ Deviations from OCL API responses:
       is supported when posted here
 """
 
+import collections
+import hashlib
 import json
+import multiprocessing
+import os
+import Queue
+import re
 import requests
 import sys
+import tempfile
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import urllib
+from urlparse import urlparse
+from datimhttpclient import DatimHttpClient
+from datimratelimiter import DatimRateLimiter
+from datimreferenceplanner import DatimReferenceLatencyStats, DatimReferencePlanner
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # Owner fields: ( owner AND owner_type ) OR ( owner_url )
@@ -36,6 +52,17 @@ import urllib
 # Concept/Mapping fieldS: ( id ) OR ( url )
 
 
+def format_log_message(*args):
+    """ Returns a timestamped log line with the specified arguments """
+    return '[' + str(datetime.now()) + '] ' + ''.join([str(arg) + ' ' for arg in args]) + '\n'
+
+
+def write_log(*args):
+    """ Output log information -- written as a single line so that output from concurrent threads does not mix """
+    sys.stdout.write(format_log_message(*args))
+    sys.stdout.flush()
+
+
 class OclImportError(Exception):
     """ Base exception for this module """
     pass
@@ -69,19 +96,58 @@ class InvalidObjectDefinition(OclImportError):
         self.message = message
 
 
+class BulkImportError(OclImportError):
+    """ Exception raised when an OCL bulk import job fails """
+    def __init__(self, expression, message):
+        self.expression = expression
+        self.message = message
+
+
 class OclImportResults:
-    """ Class to capture the results of processing an import script """
+    """
+    Class to capture the results of processing an import script.
+    In compact mode, only running totals and interned root keys are kept in memory. The result of each
+    request and skipped line can also be appended to a JSON-lines detail log, which iter_details reads back.
+    """
 
     SKIP_KEY = 'SKIPPED'
     NO_OBJECT_TYPE_KEY = 'NO-OBJECT-TYPE'
     ORGS_RESULTS_ROOT = '/orgs/'
     USERS_RESULTS_ROOT = '/users/'
 
-    def __init__(self, total_lines=0):
+    def __init__(self, total_lines=0, compact=False, detail_log_path=''):
+        """
+        :param total_lines: Total number of lines in the import script
+        :param compact: Set to True to keep only running totals in memory instead of every result
+        :param detail_log_path: Optional path of a JSON-lines file that each result is appended to
+        """
         self._results = {}
         self.count = 0
         self.num_skipped = 0
         self.total_lines = total_lines
+        self.compact = compact
+        self.detail_log_path = detail_log_path
+        self._detail_log = open(detail_log_path, 'wb') if detail_log_path else None
+        self._root_keys = {}
+
+        # Running totals by root key, action type and status code, and by action type and status code, so
+        # that summaries do not need to walk every stored result
+        self._root_counts = {}
+        self._counts = {}
+
+    def _increment_counts(self, root_key, action_type, status_code):
+        root_key = self._root_keys.setdefault(root_key, root_key)
+        root_counts = self._root_counts.setdefault(root_key, {}).setdefault(action_type, {})
+        root_counts[status_code] = root_counts.get(status_code, 0) + 1
+        counts = self._counts.setdefault(action_type, {})
+        counts[status_code] = counts.get(status_code, 0) + 1
+
+    @staticmethod
+    def is_success_code(status_code):
+        try:
+            return 200 <= int(status_code) < 300
+        except (TypeError, ValueError):
+            return False
 
     def add(self, obj_url='', action_type='', obj_type='', obj_repo_url='', http_method='', obj_owner_url='',
             status_code=None):
@@ -113,14 +179,27 @@ class OclImportResults:
         elif obj_type == OclFlexImporter.OBJ_TYPE_USER:
             logging_root = self.USERS_RESULTS_ROOT
 
-        # Add the result to the results object
-        if logging_root not in self._results:
-            self._results[logging_root] = {}
-        if action_type not in self._results[logging_root]:
-            self._results[logging_root][action_type] = {}
-        if status_code not in self._results[logging_root][action_type]:
-            self._results[logging_root][action_type][status_code] = []
-        self._results[logging_root][action_type][status_code].append('%s %s' % (http_method, obj_url))
+        self.add_result(logging_root, action_type, status_code, '%s %s' % (http_method, obj_url))
+
+    def add_result(self, root_key, action_type, status_code, text):
+        """
+        Add a result under an already determined root key, e.g. a result reported by the OCL bulk import API
+        :param root_key: Logging root of the result, e.g. the URL of its repository
+        :param action_type: e.g. 'new'
+        :param status_code: Status code of the request
+        :param text: Description of the request, e.g. 'POST /orgs/PEPFAR/sources/MER/concepts/'
+        :return:
+        """
+        if not self.compact:
+            if root_key not in self._results:
+                self._results[root_key] = {}
+            if action_type not in self._results[root_key]:
+                self._results[root_key][action_type] = {}
+            if status_code not in self._results[root_key][action_type]:
+                self._results[root_key][action_type][status_code] = []
+            self._results[root_key][action_type][status_code].append(text)
+        self._increment_counts(root_key, action_type, status_code)
+        self._write_detail(root_key, action_type, status_code, text)
 
         self.count += 1
 
@@ -131,18 +210,126 @@ class OclImportResults:
         :param text:
         :return:
         """
-        if self.SKIP_KEY not in self._results:
-            self._results[self.SKIP_KEY] = {}
         if not obj_type:
             obj_type = self.NO_OBJECT_TYPE_KEY
-        if obj_type not in self._results[self.SKIP_KEY]:
-            self._results[self.SKIP_KEY][obj_type] = []
-        if self.SKIP_KEY not in self._results[self.SKIP_KEY][obj_type]:
-            self._results[self.SKIP_KEY][obj_type][self.SKIP_KEY] = []
-        self._results[self.SKIP_KEY][obj_type][self.SKIP_KEY].append(text)
+        if not self.compact:
+            if self.SKIP_KEY not in self._results:
+                self._results[self.SKIP_KEY] = {}
+            if obj_type not in self._results[self.SKIP_KEY]:
+                self._results[self.SKIP_KEY][obj_type] = {}
+            if self.SKIP_KEY not in self._results[self.SKIP_KEY][obj_type]:
+                self._results[self.SKIP_KEY][obj_type][self.SKIP_KEY] = []
+            self._results[self.SKIP_KEY][obj_type][self.SKIP_KEY].append(text)
+        self._increment_counts(self.SKIP_KEY, obj_type, self.SKIP_KEY)
+        self._write_detail(self.SKIP_KEY, obj_type, self.SKIP_KEY, text)
         self.num_skipped += 1
         self.count += 1
 
+    def _write_detail(self, root_key, action_type, status_code, detail):
+        if self._detail_log:
+            self._detail_log.write(json.dumps(
+                {'root_key': root_key, 'action_type': action_type, 'status_code': status_code, 'detail': detail}))
+            self._detail_log.write('\n')
+
+    def close(self):
+        """ Flushes and closes the detail log """
+        if self._detail_log:
+            self._detail_log.close()
+            self._detail_log = None
+
+    def iter_details(self, root_key=None, limit_to_success_codes=False):
+        """
+        Yields the results recorded in the detail log, optionally filtered by root_key
+        :param root_key: Optional root_key to filter the results
+        :param limit_to_success_codes: Set to true to only yield successful import results
+        :return: generator of dicts with keys root_key, action_type, status_code and detail
+        """
+        if self._detail_log:
+            self._detail_log.flush()
+        with open(self.detail_log_path, 'rb') as detail_log:
+            for line in detail_log:
+                detail = json.loads(line)
+                if root_key is not None and detail['root_key'] != root_key:
+                    continue
+                if limit_to_success_codes and not self.is_success_code(detail['status_code']):
+                    continue
+                yield detail
+
+    def get_state(self):
+        """
+        Returns the totals and stored results as a JSON-serializable dict, flushing the detail log so that its
+        current size can be recorded. Status codes are kept as values (not keys) so they survive serialization.
+        """
+        detail_log_size = 0
+        if self._detail_log:
+            self._detail_log.flush()
+            detail_log_size = self._detail_log.tell()
+        elif self.detail_log_path and os.path.isfile(self.detail_log_path):
+            detail_log_size = os.path.getsize(self.detail_log_path)
+        counts = []
+        for root_key, root_counts in self._root_counts.iteritems():
+            for action_type, status_counts in root_counts.iteritems():
+                for status_code, num in status_counts.iteritems():
+                    counts.append([root_key, action_type, status_code, num])
+        results = []
+        for root_key, root_results in self._results.iteritems():
+            for action_type, status_results in root_results.iteritems():
+                for status_code, items in status_results.iteritems():
+                    results.append([root_key, action_type, status_code, items])
+        return {
+            'count': self.count,
+            'num_skipped': self.num_skipped,
+            'total_lines': self.total_lines,
+            'counts': counts,
+            'results': results,
+            'detail_log_size': detail_log_size,
+        }
+
+    @classmethod
+    def from_state(cls, state, total_lines=0, compact=False, detail_log_path=''):
+        """
+        Returns an OclImportResults object restored from a dict returned by get_state. The detail log, if any, is
+        truncated to the size it had when the state was saved and further results are appended to it.
+        """
+        import_results = cls(total_lines=total_lines or state['total_lines'], compact=compact)
+        import_results.merge_state(state)
+        if detail_log_path:
+            import_results.detail_log_path = detail_log_path
+            import_results._detail_log = open(detail_log_path, 'ab' if os.path.isfile(detail_log_path) else 'wb')
+            import_results._detail_log.truncate(min(state['detail_log_size'], os.path.getsize(detail_log_path)))
+            import_results._detail_log.seek(0, os.SEEK_END)
+        return import_results
+
+    def merge_state(self, state, detail_log_path=''):
+        """
+        Adds the totals and stored results from a dict returned by get_state, e.g. the partial results of an import
+        shard, to this object
+        :param state: dict returned by OclImportResults.get_state
+        :param detail_log_path: Optional path of the detail log of the merged results, which is appended to the
+            detail log of this object (up to the size recorded in the state)
+        """
+        self.count += state['count']
+        self.num_skipped += state['num_skipped']
+        for root_key, action_type, status_code, num in state['counts']:
+            root_key = self._root_keys.setdefault(root_key, root_key)
+            root_counts = self._root_counts.setdefault(root_key, {}).setdefault(action_type, {})
+            root_counts[status_code] = root_counts.get(status_code, 0) + num
+            counts = self._counts.setdefault(action_type, {})
+            counts[status_code] = counts.get(status_code, 0) + num
+        if not self.compact:
+            for root_key, action_type, status_code, items in state['results']:
+                self._results.setdefault(root_key, {}).setdefault(action_type, {}).setdefault(
+                    status_code, []).extend(items)
+        if self._detail_log and detail_log_path and os.path.isfile(detail_log_path):
+            remaining = state['detail_log_size']
+            with open(detail_log_path, 'rb') as detail_log:
+                while remaining > 0:
+                    data = detail_log.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    self._detail_log.write(data)
+                    remaining -= len(data)
+
     def has(self, root_key='', limit_to_success_codes=False):
         """
         Return whether this OclImportResults object contains a result matching the specified root_key
@@ -150,12 +337,12 @@ class OclImportResults:
         :param limit_to_success_codes: Set to true to only match a successful import result
         :return: True if a match found; False otherwise
         """
-        if root_key in self._results and not limit_to_success_codes:
+        if root_key in self._root_counts and not limit_to_success_codes:
             return True
-        elif root_key in self._results and limit_to_success_codes:
-            for action_type in self._results[root_key]:
-                for status_code in self._results[root_key][action_type]:
-                    if int(status_code) >= 200 and int(status_code) < 300:
+        elif root_key in self._root_counts and limit_to_success_codes:
+            for action_type in self._root_counts[root_key]:
+                for status_code in self._root_counts[root_key][action_type]:
+                    if self.is_success_code(status_code):
                         return True
         return False
 
@@ -169,47 +356,40 @@ class OclImportResults:
         :param root_key: Optional root_key to filter the summary results
         :return:
         """
-        if not root_key:
+        if not root_key and not self.total_lines:
+            return 'Processed %s' % self.count
+        elif not root_key:
             return 'Processed %s of %s total' % (self.count, self.total_lines)
         elif self.has(root_key=root_key):
             num_processed = 0
-            for action_type in self._results[root_key]:
-                for status_code in self._results[root_key][action_type]:
-                    num_processed += len(self._results[root_key][action_type][status_code])
+            for action_type in self._root_counts[root_key]:
+                num_processed += sum(self._root_counts[root_key][action_type].values())
             return 'Processed %s for key "%s"' % (num_processed, root_key)
 
     def get_detailed_summary(self, root_key=None, limit_to_success_codes=False):
-        # Build a results summary dictionary
-        results_summary = {}
+        # Select the running totals for the root key or for all results
         if root_key:
-            keys = [root_key]
+            counts = self._root_counts.get(root_key, {})
         else:
-            keys = self._results.keys()
+            counts = self._counts
         total_count = 0
-        for k in keys:
-            for action_type in self._results[k]:
-                if action_type not in results_summary:
-                    results_summary[action_type] = {}
-                for status_code in self._results[k][action_type]:
-                    if limit_to_success_codes and (int(status_code) < 200 or int(status_code) >= 300):
-                        continue
-                    status_code_count = len(self._results[k][action_type][status_code])
-                    results_summary[action_type][status_code] = status_code_count
-                    total_count += status_code_count
 
-        # Turn the results summary dictionary into a string
+        # Turn the totals into a string
         output = ''
-        for action_type in results_summary:
-            if output:
-                output += '; '
+        for action_type in counts:
             status_code_summary = ''
             action_type_count = 0
-            for status_code in results_summary[action_type]:
-                action_type_count += results_summary[action_type][status_code]
+            for status_code in counts[action_type]:
+                if limit_to_success_codes and not self.is_success_code(status_code):
+                    continue
+                action_type_count += counts[action_type][status_code]
                 if status_code_summary:
                     status_code_summary += ', '
-                status_code_summary += '%s: %s' % (status_code, results_summary[action_type][status_code])
+                status_code_summary += '%s: %s' % (status_code, counts[action_type][status_code])
+            if output:
+                output += '; '
             output += '%s %s (%s)' % (action_type_count, action_type, status_code_summary)
+            total_count += action_type_count
 
         # Polish it all off
         if limit_to_success_codes:
@@ -218,6 +398,8 @@ class OclImportResults:
             process_str = 'Processed'
         if root_key:
             output = '%s %s for key "%s"' % (process_str, output, root_key)
+        elif not self.total_lines:
+            output = '%s %s and skipped %s -- %s' % (process_str, total_count, self.num_skipped, output)
         else:
             output = '%s %s and skipped %s of %s total -- %s' % (
                 process_str, total_count, self.num_skipped, self.total_lines, output)
@@ -225,6 +407,364 @@ class OclImportResults:
         return output
 
 
+class OclImportResultsBuffer:
+    """
+    Records the results of a single line processed by a concurrent import, so that they can be added to the
+    OclImportResults object in line order
+    """
+
+    def __init__(self):
+        self._calls = []
+
+    def add(self, **kwargs):
+        self._calls.append(('add', kwargs))
+
+    def add_skip(self, **kwargs):
+        self._calls.append(('add_skip', kwargs))
+
+    def commit(self, import_results):
+        """ Add the buffered results to the specified OclImportResults object """
+        for method, kwargs in self._calls:
+            getattr(import_results, method)(**kwargs)
+
+    def get_state(self):
+        """ Returns the buffered results as a JSON-serializable list, e.g. to save them in a checkpoint """
+        return [[method, kwargs] for method, kwargs in self._calls]
+
+    @classmethod
+    def from_state(cls, state):
+        """ Returns a buffer restored from a list returned by get_state """
+        results_buffer = cls()
+        results_buffer._calls = [(method, kwargs) for method, kwargs in state]
+        return results_buffer
+
+
+class OclExistenceIndex:
+    """
+    Index of OCL resource URLs that are known to exist, built from repository exports, that lets the importer
+    answer existence checks without sending a HEAD request. Exports of released repository versions may miss
+    resources created since the release (e.g. by an import that stopped before the new version was created), so
+    absence from the index is only authoritative for repositories whose export is known to be current, e.g. an
+    export of HEAD or of the latest version of a repository that no import has changed since. For the other
+    repositories, a URL missing from the index is left to an HTTP check.
+    The index is ignored once it is older than max_age seconds.
+    """
+
+    DEFAULT_MAX_AGE = 3600
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        self.created = time.time()
+        self.urls = set()
+        self.complete_repo_urls = set()
+        self.current_repo_urls = set()
+        self.references = {}
+
+    def is_stale(self):
+        return time.time() - self.created > self.max_age
+
+    def add_repo_export(self, repo_url, export, is_current=False):
+        """
+        Adds the owner, repository, concepts, mappings and references of a complete repository export
+        :param repo_url: Repository URL, e.g. '/orgs/PEPFAR/sources/MER/'
+        :param export: Parsed OCL export of the repository
+        :param is_current: Set to True if the export reflects the current state of the repository
+        """
+        self.urls.add('/'.join(repo_url.split('/')[:3]) + '/')
+        self.urls.add(repo_url)
+        self.complete_repo_urls.add(repo_url)
+        if is_current:
+            self.current_repo_urls.add(repo_url)
+        for resource in export.get('concepts', []) + export.get('mappings', []):
+            for url_field in ['url', 'version_url']:
+                if resource.get(url_field):
+                    self.urls.add(resource[url_field])
+        self.references.setdefault(repo_url, set()).update(
+            [reference['expression'] for reference in export.get('references', [])])
+
+    def lookup(self, url):
+        """
+        Returns whether the resource at the URL exists according to the index
+        :param url: Resource URL relative to the API root
+        :return: True or False, or None if the index cannot tell (e.g. the URL is not in a current export)
+        """
+        if url in self.urls:
+            return True
+        for repo_url in self.current_repo_urls:
+            if url.startswith(repo_url):
+                return False
+        return None
+
+    def is_missing_from_export(self, url):
+        """ Returns whether the URL is in an exported repository but missing from its (possibly released) export """
+        if url in self.urls:
+            return False
+        for repo_url in self.complete_repo_urls:
+            if url.startswith(repo_url):
+                return True
+        return False
+
+    def has_references(self, collection_url, expressions):
+        """ Returns whether all of the expressions are known to be referenced by the collection """
+        return bool(expressions) and set(expressions).issubset(self.references.get(collection_url, ()))
+
+
+class OclImportScriptValidator:
+    """
+    Checks the concepts and mappings that the mappings and references in an import script point to against the
+    concepts created earlier in the same script and an optional OclExistenceIndex of the current OCL exports.
+    Lines that point to a resource that is known not to exist are moved to a quarantine file instead of being
+    sent to OCL. URLs that cannot be checked (e.g. in a repository that is not in the index) are left to OCL.
+    URLs that are only missing from the export of a released repository version may have been created since the
+    release, so their lines are kept and the URLs are collected in unconfirmed_urls instead.
+    """
+
+    def __init__(self, existence_index=None, verbosity=1):
+        """
+        :param existence_index: Optional OclExistenceIndex of the OCL exports. Ignored if stale.
+        :param verbosity: Set to 2 to output each unresolved URL
+        """
+        if existence_index and existence_index.is_stale():
+            existence_index = None
+        self.existence_index = existence_index
+        self.verbosity = verbosity
+        self.created_concept_urls = set()
+        self.mapping_repo_urls = set()
+        self.unconfirmed_urls = set()
+
+    def log(self, *args):
+        """ Output log information """
+        write_log(*args)
+
+    def is_resolved(self, url):
+        """
+        Returns whether the concept or mapping at the URL exists or is created earlier in the script
+        :param url: Concept or mapping URL, optionally including a version
+        :return: True or False, or None if it cannot be determined
+        """
+        if url in self.created_concept_urls:
+            return True
+        if '/mappings/' in url and url[:OclFlexImporter.find_nth(url, '/', 5) + 1] in self.mapping_repo_urls:
+            # The URLs of new mappings are assigned by OCL, so they cannot be checked
+            return None
+        if self.existence_index:
+            exists = self.existence_index.lookup(url)
+            if exists is None and self.existence_index.is_missing_from_export(url):
+                if self.verbosity >= 2 and url not in self.unconfirmed_urls:
+                    self.log('WARNING: %s is missing from the OCL export, but may have been created since the '
+                             'exported version was released. Leaving it to OCL.' % url)
+                self.unconfirmed_urls.add(url)
+            return exists
+        return None
+
+    def get_unresolved_urls(self, obj_type, obj):
+        """
+        Records the concepts and mappings created by a line and returns the URLs it points to that do not resolve
+        :param obj_type: Type of the resource
+        :param obj: Resource definition from the JSON line (not modified)
+        :return: list of unresolved URLs
+        """
+        if obj_type == OclFlexImporter.OBJ_TYPE_CONCEPT:
+            try:
+                self.created_concept_urls.add(OclFlexImporter.resolve_urls(obj_type, dict(obj))['obj_url'])
+            except OclImportError:
+                pass
+            return []
+        elif obj_type == OclFlexImporter.OBJ_TYPE_MAPPING:
+            try:
+                self.mapping_repo_urls.add(OclFlexImporter.resolve_urls(obj_type, dict(obj))['obj_repo_url'])
+            except OclImportError:
+                pass
+            urls = [obj[field_name] for field_name in ['from_concept_url', 'to_concept_url'] if obj.get(field_name)]
+        elif obj_type == OclFlexImporter.OBJ_TYPE_REFERENCE:
+            urls = (obj.get('data') or {}).get('expressions', [])
+        else:
+            return []
+        return [url for url in urls if self.is_resolved(url) is False]
+
+    def validate(self, file_path, quarantine_path):
+        """
+        Rewrites the import script without the lines that point to unresolved concepts or mappings and writes
+        those lines to the quarantine file. For references with several expressions, only the unresolved
+        expressions are quarantined.
+        :param file_path: Path of the import script, which is replaced by the validated script
+        :param quarantine_path: Path of the JSON lines file to write the quarantined lines to
+        :return: tuple (int number of lines kept, int number of lines quarantined)
+        """
+        num_kept = 0
+        num_quarantined = 0
+        with open(file_path, 'rb') as json_file, open(file_path + '.tmp', 'wb') as output_file, \
+                open(quarantine_path, 'wb') as quarantine_file:
+            for json_line_raw in json_file:
+                try:
+                    obj = json.loads(json_line_raw)
+                except ValueError:
+                    obj = None
+                obj_type = obj.get('type') if isinstance(obj, dict) else None
+                unresolved_urls = self.get_unresolved_urls(obj_type, obj) if obj_type else []
+                if not unresolved_urls:
+                    output_file.write(json_line_raw)
+                    num_kept += 1
+                    continue
+                if self.verbosity >= 2:
+                    self.log('QUARANTINED: %s line pointing to unresolved %s' % (obj_type, ', '.join(unresolved_urls)))
+                expressions = (obj.get('data') or {}).get('expressions', [])
+                if obj_type == OclFlexImporter.OBJ_TYPE_REFERENCE and len(unresolved_urls) < len(expressions):
+                    # Keep the resolved expressions of the reference and quarantine the others
+                    resolved_obj = json.loads(json_line_raw)
+                    resolved_obj['data']['expressions'] = [url for url in expressions if url not in unresolved_urls]
+                    output_file.write(json.dumps(resolved_obj) + '\n')
+                    num_kept += 1
+                    obj['data']['expressions'] = unresolved_urls
+                    json_line_raw = json.dumps(obj) + '\n'
+                quarantine_file.write(json_line_raw)
+                num_quarantined += 1
+        os.rename(file_path + '.tmp', file_path)
+        return num_kept, num_quarantined
+
+
+class OclExistenceCache:
+    """
+    Cache of the results of existence checks, including resources that were not found. Results for owners and
+    repositories are saved on disk so that later imports do not check them again, and expire after ttl seconds.
+    The cache file is shared by concurrent imports (e.g. the processes of a sharded import), so it is merged on
+    save, keeping the most recent result for each URL. Results for other resources (e.g. concepts) change with
+    every import, so they are only kept in memory for the current import.
+    """
+
+    DEFAULT_TTL = 3600
+
+    SAVED_URL_PATTERN = re.compile(r'^/(orgs|users)/[^/]+/((sources|collections)/[^/]+/)?$')
+
+    def __init__(self, path='', ttl=DEFAULT_TTL):
+        """
+        :param path: Path of the JSON file that persists the cache, or '' to keep it in memory only
+        :param ttl: Number of seconds for which a saved result is reused
+        """
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = self.load()
+        self._run_entries = {}
+
+    def load(self):
+        """ Returns the results saved on disk """
+        if self.path and os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rb') as cache_file:
+                    return json.load(cache_file)
+            except ValueError:
+                pass
+        return {}
+
+    def get(self, url, include_saved=True):
+        """
+        Returns whether the resource at the URL exists, or None if the result is unknown or expired
+        :param url: Resource URL relative to the API root
+        :param include_saved: Set to False to only return results of checks made by the current import
+        """
+        if url in self._run_entries:
+            return self._run_entries[url]
+        entry = self._entries.get(url) if include_saved else None
+        if entry and time.time() - entry['checked'] <= self.ttl:
+            return entry['exists']
+        return None
+
+    def set(self, url, exists):
+        with self._lock:
+            self._run_entries[url] = exists
+            if self.SAVED_URL_PATTERN.match(url):
+                self._entries[url] = {'exists': exists, 'checked': time.time()}
+
+    def save(self):
+        """
+        Merges the unexpired results with those saved on disk in the meantime, keeping the most recent result for
+        each URL, and writes them to disk. The cache is read, merged and replaced while holding a lock on a separate
+        lock file, since the cache file itself is replaced.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            with open(self.path + '.lock', 'a+') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    entries = self.load()
+                    for url, entry in self._entries.iteritems():
+                        if url not in entries or entries[url]['checked'] < entry['checked']:
+                            entries[url] = entry
+                    now = time.time()
+                    entries = dict((url, entry) for url, entry in entries.iteritems()
+                                   if now - entry['checked'] <= self.ttl)
+                    tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                    with open(tmp_path, 'wb') as cache_file:
+                        cache_file.write(json.dumps(entries))
+                    os.rename(tmp_path, self.path)
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._entries = entries
+
+
+class OclImportProgress:
+    """
+    Tracks the progress of an import from the byte offset of the next line in the import file. The line, request
+    and byte rates are measured over a sliding window of recent samples, and the byte rate is used to estimate the
+    remaining time.
+    """
+
+    DEFAULT_WINDOW = 60
+    DEFAULT_INTERVAL = 10
+
+    def __init__(self, total_bytes=0, start_offset=0, start_line=0, window=DEFAULT_WINDOW,
+                 interval=DEFAULT_INTERVAL):
+        """
+        :param total_bytes: Size of the import file in bytes
+        :param start_offset: Byte offset the import starts at, e.g. when resuming from a checkpoint
+        :param start_line: Number of lines completed before the import starts
+        :param window: Number of seconds of samples used to measure the rates
+        :param interval: Minimum number of seconds between progress reports
+        """
+        self.total_bytes = total_bytes
+        self.window = window
+        self.interval = interval
+        self.last_report = time.time()
+        self._samples = collections.deque([(self.last_report, start_offset, start_line, 0)])
+
+    def update(self, offset, num_lines, num_requests):
+        """
+        Records a sample and returns a progress report if at least interval seconds passed since the last one
+        :param offset: Byte offset of the next line in the import file
+        :param num_lines: Number of lines completed
+        :param num_requests: Number of requests sent
+        :return: str Progress report, or None
+        """
+        now = time.time()
+        self._samples.append((now, offset, num_lines, num_requests))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+        if now - self.last_report < self.interval:
+            return None
+        self.last_report = now
+        return self.get_report()
+
+    def get_report(self):
+        """ Returns a progress report based on the samples in the window """
+        start_time, start_offset, start_lines, start_requests = self._samples[0]
+        end_time, offset, num_lines, num_requests = self._samples[-1]
+        elapsed = max(end_time - start_time, 0.001)
+        byte_rate = (offset - start_offset) / elapsed
+        report = 'PROGRESS: %s lines, %.1f of %.1f MB' % (
+            num_lines, offset / 1048576.0, self.total_bytes / 1048576.0)
+        if self.total_bytes:
+            report += ' (%.1f%%)' % (100.0 * offset / self.total_bytes)
+        report += ', %.1f lines/s, %.1f requests/s, %.1f KB/s' % (
+            (num_lines - start_lines) / elapsed, (num_requests - start_requests) / elapsed, byte_rate / 1024)
+        if byte_rate > 0:
+            report += ', ETA %s' % timedelta(seconds=int(max(0, self.total_bytes - offset) / byte_rate))
+        return report
+
+
 class OclFlexImporter:
     """ Class to flexibly import multiple resource types into OCL from JSON lines files via the OCL API """
 
@@ -247,6 +787,22 @@ class OclFlexImporter:
     ACTION_TYPE_DELETE = 'delete'
     ACTION_TYPE_OTHER = 'other'
 
+    # Maximum number of lines per worker that are read ahead of the oldest line that has not completed
+    MAX_PENDING_LINES_PER_WORKER = 100
+
+    # Number of owner and repository existence checks sent at the same time by the preflight
+    PREFLIGHT_WORKERS = 8
+
+    # Number of completed lines between checkpoints
+    CHECKPOINT_INTERVAL = 100
+
+    # Field of a compiled line that holds its resolved URLs, request method and query parameters
+    COMPILED_FIELD = '__compiled'
+
+    # Reference requests are sized by DatimReferencePlanner to take up to its latency target, so the rate limiter
+    # only treats reference responses well beyond that target as a sign of overload
+    REFERENCE_LATENCY_TARGET = 2 * DatimReferencePlanner.DEFAULT_LATENCY_TARGET
+
     # Resource type definitions
     obj_def = {
         OBJ_TYPE_ORGANIZATION: {
@@ -333,8 +889,23 @@ class OclFlexImporter:
     }
 
     def __init__(self, file_path='', api_url_root='', api_token='', limit=0,
-                 test_mode=False, verbosity=1, do_update_if_exists=False, import_delay=0):
-        """ Initialize this object """
+                 test_mode=False, verbosity=1, do_update_if_exists=False, import_delay=0, http_client=None,
+                 num_workers=1, rate_limiter=None, existence_index=None, existence_cache=None,
+                 compact_results=False, results_detail_log='', checkpoint_path='', resume=False,
+                 reference_latency_stats=None):
+        """
+        Initialize this object
+        Requests are paced by an adaptive rate limiter that is shared by all importers sending requests to the
+        same API, unless a rate_limiter is provided. import_delay seeds its initial rate (1 request every
+        import_delay seconds). An optional OclExistenceIndex replaces existence checks via HEAD requests.
+        Existence check results are kept in an OclExistenceCache, which persists the results for owners and
+        repositories for later runs against the same API, unless an existence_cache is provided. Set compact_results to keep only running totals of the
+        import results in memory, and results_detail_log to append each result to a JSON-lines file.
+        If a checkpoint_path is provided, the position in the import file and the results so far are saved there
+        every CHECKPOINT_INTERVAL lines and when the import fails. Set resume to continue from that checkpoint.
+        The latency of reference requests is recorded in reference_latency_stats (DatimReferenceLatencyStats), if
+        provided, and saved when the import completes.
+        """
 
         self.file_path = file_path
         self.api_token = api_token
@@ -344,10 +915,40 @@ class OclFlexImporter:
         self.verbosity = verbosity
         self.limit = limit
         self.import_delay = import_delay
-        self.skip_line_count = False
+        self.compact_results = compact_results
+        self.results_detail_log = results_detail_log
+        self.checkpoint_path = checkpoint_path
+        self._file_hash = None
+        self._completed_lines = {}
+        self.resume = resume
+        self.reference_latency_stats = reference_latency_stats
+        self.num_workers = num_workers
+
+        # Pooled, retrying HTTP client -- shared with the sync scripts unless one is provided
+        if http_client:
+            self.http_client = http_client
+        else:
+            self.http_client = DatimHttpClient.get_shared_client()
+
+        # Adaptive rate limiter -- shared through a state file by all processes importing into the same API
+        if rate_limiter:
+            self.rate_limiter = rate_limiter
+        else:
+            self.rate_limiter = DatimRateLimiter.from_delay(
+                state_path=self.get_api_host_filename('ocl-import-rate-limiter'), delay=self.import_delay)
 
         self.import_results = None
-        self.cache_obj_exists = {}
+        self.progress = None
+        self.num_requests = 0
+        self._request_lock = threading.Lock()
+        self.existence_index = existence_index
+        if existence_cache:
+            self.existence_cache = existence_cache
+        else:
+            self.existence_cache = OclExistenceCache(path=self.get_api_host_filename('ocl-import-existence-cache'))
+
+        # Log output and results of the line being processed by the current thread in concurrent mode
+        self._thread_local = threading.local()
 
         # Prepare the headers
         self.api_headers = {
@@ -356,14 +957,68 @@ class OclFlexImporter:
         }
 
     def log(self, *args):
-        """ Output log information """
-        sys.stdout.write('[' + str(datetime.now()) + '] ')
-        for arg in args:
-            sys.stdout.write(str(arg))
-            sys.stdout.write(' ')
-        sys.stdout.write('\n')
+        """ Output log information, buffering it if the current thread is processing a line concurrently """
+        str_log = format_log_message(*args)
+        log_buffer = getattr(self._thread_local, 'log_buffer', None)
+        if log_buffer is not None:
+            log_buffer.append(str_log)
+            return
+        sys.stdout.write(str_log)
         sys.stdout.flush()
 
+    def get_api_host_filename(self, prefix):
+        """ Returns the path of a state file in the temp directory shared by all importers using the same API host """
+        api_host = re.sub(r'[^A-Za-z0-9.-]', '_', urlparse(self.api_url_root).netloc)
+        return os.path.join(tempfile.gettempdir(), '%s-%s.json' % (prefix, api_host))
+
+    def send_request(self, method, url, latency_target=None, **kwargs):
+        """
+        Sends a request to the OCL API once the rate limiter allows it, and feeds the latency and status code of
+        the response back to the rate limiter. The latency of a response is that of its final round trip, i.e.
+        response.elapsed, excluding the wait for the rate limiter and any retries by the HTTP client. Throttling
+        responses (see DatimRateLimiter.THROTTLE_STATUS_CODES) are retried here rather than by the HTTP client,
+        so that the rate limiter sees every one of them and each retry waits for a token like any other request.
+        :param method: HTTP method, e.g. 'POST'
+        :param url: URL relative to api_url_root
+        :param latency_target: Optional number of seconds beyond which the rate limiter treats the response as a
+            sign of overload, for requests that are expected to be slow
+        :param kwargs: Any additional keyword arguments accepted by DatimHttpClient.request
+        :return: requests.Response
+        """
+        if method.upper() in DatimHttpClient.IDEMPOTENT_METHODS:
+            retry_status_codes = DatimHttpClient.RETRY_STATUS_CODES
+        else:
+            retry_status_codes = DatimHttpClient.RETRY_STATUS_CODES_NON_IDEMPOTENT
+        kwargs['retry_status_codes'] = [
+            code for code in retry_status_codes if code not in DatimRateLimiter.THROTTLE_STATUS_CODES]
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            with self._request_lock:
+                self.num_requests += 1
+            start_time = time.time()
+            try:
+                response = self.http_client.request(method, self.api_url_root + url, **kwargs)
+            except requests.exceptions.RequestException:
+                self.rate_limiter.record(time.time() - start_time, latency_target=latency_target)
+                raise
+            self.rate_limiter.record(
+                response.elapsed.total_seconds(), status_code=response.status_code, latency_target=latency_target)
+            if (response.status_code not in DatimRateLimiter.THROTTLE_STATUS_CODES or
+                    attempt >= self.http_client.max_retries):
+                return response
+            delay = self.http_client.get_retry_delay(attempt, response=response)
+            if self.verbosity:
+                self.log('WARNING: %s %s returned %s. Retrying in %.1f seconds (%s of %s)...' % (
+                    method, url, response.status_code, delay, attempt + 1, self.http_client.max_retries))
+            response.close()
+            attempt += 1
+            time.sleep(delay)
+
+    def get_import_results(self):
+        """ Returns the results object for the line being processed by the current thread """
+        return getattr(self._thread_local, 'import_results', None) or self.import_results
+
     def log_settings(self):
         """ Output log of the object settings """
         self.log("**** OCL IMPORT SCRIPT SETTINGS ****",
@@ -373,7 +1028,11 @@ class OclFlexImporter:
                  ", Test Mode:", self.test_mode,
                  ", Update Resource if Exists: ", self.do_update_if_exists,
                  ", Verbosity:", self.verbosity,
-                 ", Import Delay: ", self.import_delay)
+                 ", Import Delay: ", self.import_delay,
+                 ", Initial Rate: ", self.rate_limiter.initial_rate,
+                 ", Workers: ", self.num_workers,
+                 ", Checkpoint: ", self.checkpoint_path,
+                 ", Resume: ", self.resume)
 
     def process(self):
         """
@@ -385,58 +1044,451 @@ class OclFlexImporter:
         if self.verbosity:
             self.log_settings()
 
-        # Count lines (unless settings indicate skipping this for better performance)
-        num_lines = 0
-        if not self.skip_line_count:
-            with open(self.file_path) as json_file:
-                for line in json_file:
-                    num_lines += 1
-
-        # Loop through each JSON object in the file
-        self.import_results = OclImportResults(total_lines=num_lines)
-        obj_def_keys = self.obj_def.keys()
-        with open(self.file_path) as json_file:
-            count = 0
-            num_processed = 0
-            num_skipped = 0
-            for json_line_raw in json_file:
+        # Continue from the checkpoint of an interrupted import, if requested
+        checkpoint = self.load_checkpoint() if self.resume else None
+        if checkpoint:
+            self.import_results = OclImportResults.from_state(
+                checkpoint['import_results'], compact=self.compact_results, detail_log_path=self.results_detail_log)
+            self._completed_lines = dict((int(line_no), results_state) for line_no, results_state
+                                         in checkpoint.get('completed_lines', {}).iteritems())
+            self.log('Resuming import from line %s (byte offset %s), skipping %s later lines that completed' % (
+                checkpoint['line'], checkpoint['offset'], len(self._completed_lines)))
+        else:
+            self.import_results = OclImportResults(
+                compact=self.compact_results, detail_log_path=self.results_detail_log)
+
+        # Loop through each JSON object in the file. Lines are read with readline so that tell() returns the
+        # byte offset of the next line, which is recorded in checkpoints and used to report progress.
+        try:
+            with open(self.file_path, 'rb') as json_file:
+                if checkpoint:
+                    json_file.seek(checkpoint['offset'])
+                    count = checkpoint['line']
+                else:
+                    count = 0
+                self.progress = OclImportProgress(
+                    total_bytes=os.path.getsize(self.file_path), start_offset=json_file.tell(), start_line=count)
+                if self.num_workers > 1:
+                    count = self.process_concurrently(json_file, count)
+                else:
+                    offset = json_file.tell()
+                    try:
+                        for json_line_raw in iter(json_file.readline, ''):
+                            if self.limit > 0 and count >= self.limit:
+                                break
+                            if count + 1 in self._completed_lines:
+                                # Completed by a concurrent import after the line it was checkpointed at
+                                line = None
+                                OclImportResultsBuffer.from_state(self._completed_lines[count + 1]).commit(
+                                    self.import_results)
+                            else:
+                                line = self.parse_line(json_line_raw)
+                            if line:
+                                self.log('')
+                                self.process_object(*line)
+                                self.log('[%s]' % self.import_results.get_detailed_summary())
+                            count += 1
+                            offset = json_file.tell()
+                            self.report_progress(count, offset)
+                            if self.checkpoint_path and count % self.CHECKPOINT_INTERVAL == 0:
+                                self.save_checkpoint(count, offset)
+                    except BaseException:
+                        if self.checkpoint_path:
+                            self.save_checkpoint(count, offset)
+                        raise
+        finally:
+            self.existence_cache.save()
+            self.import_results.close()
+            self.rate_limiter.flush()
+            if self.reference_latency_stats:
+                self.reference_latency_stats.save()
+
+        # The import completed, so the checkpoint is no longer needed
+        if self.checkpoint_path and os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        return count
+
+    def report_progress(self, num_lines, offset):
+        """
+        Records the progress of the import and outputs a progress report at the interval of the progress tracker
+        :param num_lines: int Number of lines in the import file that have been completed
+        :param offset: int Byte offset in the import file of the next line to import
+        """
+        report = self.progress.update(offset, num_lines, self.num_requests)
+        if report and self.verbosity:
+            self.log(report)
+
+    def get_file_hash(self):
+        """ Returns the SHA-1 hex digest of the import file, which identifies the file a checkpoint was saved for """
+        if self._file_hash is None:
+            file_hash = hashlib.sha1()
+            with open(self.file_path, 'rb') as json_file:
+                for block in iter(lambda: json_file.read(1024 * 1024), ''):
+                    file_hash.update(block)
+            self._file_hash = file_hash.hexdigest()
+        return self._file_hash
+
+    def save_checkpoint(self, line_no, offset, import_results_state=None, completed_lines=None):
+        """
+        Atomically writes the position of the next line to import and the results so far to the checkpoint file,
+        and saves the existence cache so that a resumed import does not check its owners and repositories again
+        :param line_no: int Number of lines in the import file that have been completed
+        :param offset: int Byte offset in the import file of the next line to import
+        :param import_results_state: Optional state of the results of the first line_no lines, if import_results
+            also holds results of later lines
+        :param completed_lines: Optional dict of line number -> OclImportResultsBuffer state of the lines after
+            line_no that completed, which are skipped on resume. Lines completed by the import resumed from the
+            previous checkpoint are carried over.
+        """
+        all_completed_lines = dict((completed_line_no, results_state) for completed_line_no, results_state
+                                   in self._completed_lines.iteritems() if completed_line_no > line_no)
+        all_completed_lines.update(completed_lines or {})
+        checkpoint = {
+            'file_path': os.path.abspath(self.file_path),
+            'file_sha1': self.get_file_hash(),
+            'line': line_no,
+            'offset': offset,
+            'saved': time.time(),
+            'import_results': import_results_state or self.import_results.get_state(),
+            'completed_lines': all_completed_lines,
+        }
+        with open(self.checkpoint_path + '.tmp', 'wb') as checkpoint_file:
+            checkpoint_file.write(json.dumps(checkpoint))
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        self.existence_cache.save()
+        if self.verbosity >= 2:
+            self.log('Checkpoint saved at line %s (byte offset %s)' % (line_no, offset))
+
+    def load_checkpoint(self):
+        """
+        Returns the checkpoint saved for the import file, or None if there is no checkpoint or it was saved for
+        a different file, or for a different version of the same file
+        """
+        if not self.checkpoint_path or not os.path.isfile(self.checkpoint_path):
+            return None
+        try:
+            with open(self.checkpoint_path, 'rb') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except ValueError:
+            self.log('WARNING: Ignoring unreadable checkpoint "%s"' % self.checkpoint_path)
+            return None
+        if (checkpoint['file_path'] != os.path.abspath(self.file_path) or
+                checkpoint.get('file_sha1') != self.get_file_hash()):
+            self.log('WARNING: Ignoring checkpoint "%s" saved for a different import file' % self.checkpoint_path)
+            return None
+        return checkpoint
+
+    def preflight(self, urls):
+        """
+        Checks the existence of owners and repositories concurrently, before any line is processed, so that lines
+        find the results in the existence cache, which is saved for other importers using the same API (e.g. the
+        processes of a sharded import). URLs with an unexpired result in the cache (e.g. from an earlier run) or
+        that the existence index can answer are not checked. Lines check any other owners and repositories when
+        they are processed.
+        :param urls: Owner and repository URLs, e.g. the repositories listed in the manifest of a sharded import
+        :return: int Number of URLs checked
+        """
+        distinct_urls = set(url for url in urls if url)
+        urls = []
+        for url in sorted(distinct_urls):
+            if self.existence_cache.get(url) is not None:
+                continue
+            if (self.existence_index and not self.existence_index.is_stale() and
+                    self.existence_index.lookup(url) is not None):
+                continue
+            urls.append(url)
+
+        # Check them concurrently
+        url_queue = Queue.Queue()
+        for url in urls:
+            url_queue.put(url)
+
+        def worker():
+            while True:
+                try:
+                    url = url_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.does_object_exist(url)
+                except (UnexpectedStatusCodeError, requests.exceptions.RequestException):
+                    # Checked again when the line is processed
+                    pass
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.PREFLIGHT_WORKERS, len(urls)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+        self.existence_cache.save()
+        if self.verbosity:
+            self.log('Preflight checked %s of %s owners and repositories' % (len(urls), len(distinct_urls)))
+        return len(urls)
+
+    def parse_line(self, json_line_raw):
+        """
+        Parses a JSON line, recording it as skipped if its type is missing or unrecognized
+        :param json_line_raw: Raw JSON line
+        :return: tuple (obj_type, obj) or None if skipped
+        """
+        json_line_obj = json.loads(json_line_raw)
+        if "type" in json_line_obj:
+            obj_type = json_line_obj.pop("type")
+            if obj_type in self.obj_def:
+                return obj_type, json_line_obj
+            self.get_import_results().add_skip(obj_type=obj_type, text=json_line_raw)
+            self.log("**** SKIPPING: Unrecognized 'type' attribute '" + obj_type + "' for object: " + json_line_raw)
+        else:
+            self.get_import_results().add_skip(text=json_line_raw)
+            self.log("**** SKIPPING: No 'type' attribute: " + json_line_raw)
+        return None
+
+    def process_concurrently(self, json_file, count=0):
+        """
+        Imports the lines of a JSON-lines file using num_workers threads. A line starts once all earlier lines
+        that it depends on have completed (see get_line_dependencies), so unrelated lines run in parallel.
+        Log output and results are buffered for each line and committed in line order, so that they match a
+        sequential import. If a line raises an error, no new lines are started and the error is re-raised
+        once the running lines have completed. Checkpoints are saved as lines are committed, up to the first line
+        that failed. The lines after it that completed anyway are saved in the checkpoint with their results, so
+        that a resumed import skips them and still records their results.
+        :param json_file: Open JSON-lines file, positioned at the line after line number count
+        :param count: int Number of lines already completed, e.g. when resuming from a checkpoint
+        :return: int Number of JSON lines processed
+        """
+        lines = {}
+        outstanding = {}
+        ready = Queue.Queue()
+        condition = threading.Condition()
+        state = {'next_commit': count + 1, 'errors': [], 'checkpoint_line': count,
+                 'checkpoint_offset': json_file.tell(), 'checkpoint_results': None, 'completed_lines': {}}
+
+        def complete(line_no):
+            """ Marks a line as completed and starts the lines waiting on it. Must hold the condition. """
+            line = lines[line_no]
+            line['done'] = True
+            for key in line['provides']:
+                outstanding[key].discard(line_no)
+            for dependent_no in line['dependents']:
+                lines[dependent_no]['waiting_on'].discard(line_no)
+                if not lines[dependent_no]['waiting_on']:
+                    ready.put(dependent_no)
+            condition.notify_all()
+
+        def commit():
+            """ Outputs the log and results of completed lines in line order. Must hold the condition. """
+            while state['next_commit'] in lines and lines[state['next_commit']]['done']:
+                line_no = state['next_commit']
+                line = lines.pop(line_no)
+                state['next_commit'] += 1
+                if (line['cancelled'] or line['error']) and state['checkpoint_results'] is None:
+                    # Record the position of the first line that did not complete, before its results are added
+                    state['checkpoint_results'] = self.import_results.get_state()
+                    if self.checkpoint_path:
+                        self.save_checkpoint(state['checkpoint_line'], state['checkpoint_offset'],
+                                             import_results_state=state['checkpoint_results'])
+                if line['cancelled']:
+                    continue
+                sys.stdout.write(''.join(line['log']))
+                sys.stdout.flush()
+                line['import_results'].commit(self.import_results)
+                if line['obj_type'] and not line['error']:
+                    self.log('[%s]' % self.import_results.get_detailed_summary())
+                self.report_progress(line_no, line['end_offset'])
+                if state['checkpoint_results'] is None:
+                    state['checkpoint_line'] = line_no
+                    state['checkpoint_offset'] = line['end_offset']
+                    if self.checkpoint_path and line_no % self.CHECKPOINT_INTERVAL == 0:
+                        self.save_checkpoint(line_no, line['end_offset'])
+                elif not line['error']:
+                    state['completed_lines'][line_no] = line['import_results'].get_state()
+
+        def worker():
+            while True:
+                line_no = ready.get()
+                if line_no is None:
+                    return
+                line = lines[line_no]
+                if state['errors']:
+                    line['cancelled'] = True
+                else:
+                    self._thread_local.log_buffer = line['log']
+                    self._thread_local.import_results = line['import_results']
+                    try:
+                        self.log('')
+                        self.process_object(line['obj_type'], line['obj'])
+                    except BaseException:
+                        line['error'] = True
+                        with condition:
+                            state['errors'].append(sys.exc_info())
+                    finally:
+                        self._thread_local.log_buffer = None
+                        self._thread_local.import_results = None
+                with condition:
+                    complete(line_no)
+
+        threads = [threading.Thread(target=worker) for _ in range(self.num_workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for json_line_raw in iter(json_file.readline, ''):
                 if self.limit > 0 and count >= self.limit:
                     break
+
+                # Limit how far ahead of the oldest incomplete line the file is read
+                with condition:
+                    commit()
+                    while (count + 1 - state['next_commit'] >= self.num_workers * self.MAX_PENDING_LINES_PER_WORKER
+                           and not state['errors']):
+                        condition.wait(1)
+                        commit()
+                    if state['errors']:
+                        break
                 count += 1
-                json_line_obj = json.loads(json_line_raw)
-                if "type" in json_line_obj:
-                    obj_type = json_line_obj.pop("type")
-                    if obj_type in obj_def_keys:
-                        self.log('')
-                        self.process_object(obj_type, json_line_obj)
-                        num_processed += 1
-                        self.log('[%s]' % self.import_results.get_detailed_summary())
-                    else:
-                        self.import_results.add_skip(obj_type=obj_type, text=json_line_raw)
-                        self.log("**** SKIPPING: Unrecognized 'type' attribute '" + obj_type + "' for object: " + json_line_raw)
-                        num_skipped += 1
-                else:
-                    self.import_results.add_skip(text=json_line_raw)
-                    self.log("**** SKIPPING: No 'type' attribute: " + json_line_raw)
-                    num_skipped += 1
-                if self.import_delay and not self.test_mode:
-                    time.sleep(self.import_delay)
 
+                # Parse the line, buffering the results of skipped lines so they are committed in order
+                line = {'log': [], 'import_results': OclImportResultsBuffer(), 'obj_type': None, 'obj': None,
+                        'provides': [], 'dependents': [], 'waiting_on': set(), 'done': False, 'cancelled': False,
+                        'error': False, 'end_offset': json_file.tell()}
+                if count in self._completed_lines:
+                    # Completed by an earlier import after the line it was checkpointed at
+                    line['import_results'] = OclImportResultsBuffer.from_state(self._completed_lines[count])
+                    parsed_line = None
+                else:
+                    self._thread_local.log_buffer = line['log']
+                    self._thread_local.import_results = line['import_results']
+                    try:
+                        parsed_line = self.parse_line(json_line_raw)
+                    finally:
+                        self._thread_local.log_buffer = None
+                        self._thread_local.import_results = None
+
+                # Schedule the line after the incomplete lines it depends on
+                with condition:
+                    lines[count] = line
+                    if not parsed_line:
+                        complete(count)
+                        continue
+                    line['obj_type'], line['obj'] = parsed_line
+                    requires, line['provides'] = self.get_line_dependencies(*parsed_line)
+                    for key in requires:
+                        for dependency_no in outstanding.get(key, ()):
+                            if dependency_no not in line['waiting_on']:
+                                line['waiting_on'].add(dependency_no)
+                                lines[dependency_no]['dependents'].append(count)
+                    for key in line['provides']:
+                        outstanding.setdefault(key, set()).add(count)
+                    if not line['waiting_on']:
+                        ready.put(count)
+
+            # Wait for the remaining lines
+            with condition:
+                commit()
+                while state['next_commit'] <= count:
+                    condition.wait(1)
+                    commit()
+        finally:
+            for _ in threads:
+                ready.put(None)
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+            with condition:
+                commit()
+                if self.checkpoint_path and (state['checkpoint_results'] is not None or state['next_commit'] <= count):
+                    self.save_checkpoint(state['checkpoint_line'], state['checkpoint_offset'],
+                                         import_results_state=state['checkpoint_results'],
+                                         completed_lines=state['completed_lines'])
+
+        if state['errors']:
+            raise state['errors'][0][0], state['errors'][0][1], state['errors'][0][2]
         return count
 
+    @classmethod
+    def get_line_dependencies(cls, obj_type, obj):
+        """
+        Returns the keys of the resources that a line requires and the keys of the resources that it creates or
+        adds to. In concurrent mode, a line starts only after all earlier lines that provide one of its required
+        keys have completed, e.g. a repository before its concepts, concepts before the mappings that use them,
+        and mappings before the references that include them. References to the same collection are serialized.
+        A repository version is a barrier: it waits for all earlier content of its repository and the content of
+        the repository that follows it waits for the version, so versions of the same repository are serialized.
+        :param obj_type: Type of the resource
+        :param obj: Resource definition from the JSON line (not modified)
+        :return: tuple (list of required keys, list of provided keys)
+        """
+        try:
+            urls = cls.resolve_urls(obj_type, dict(obj))
+        except OclImportError:
+            # Invalid lines raise an error when processed, so they do not wait for other lines
+            return [], []
+        owner_url = urls['obj_owner_url']
+        repo_url = urls['obj_repo_url']
+
+        requires = []
+        provides = []
+        if owner_url:
+            requires.append(('owner', owner_url))
+        if repo_url:
+            requires.append(('repo', repo_url))
+            requires.append(('version', repo_url))
+        if obj_type == cls.OBJ_TYPE_ORGANIZATION:
+            provides.append(('owner', urls['obj_url']))
+        elif obj_type in [cls.OBJ_TYPE_SOURCE, cls.OBJ_TYPE_COLLECTION]:
+            provides.append(('repo', urls['obj_url']))
+        elif obj_type == cls.OBJ_TYPE_CONCEPT:
+            provides.append(('concept', urls['obj_url']))
+            provides.append(('content', repo_url))
+        elif obj_type == cls.OBJ_TYPE_MAPPING:
+            for field_name in ['from_concept_url', 'to_concept_url']:
+                if obj.get(field_name):
+                    requires.append(('concept', obj[field_name]))
+            provides.append(('content', repo_url))
+        elif obj_type == cls.OBJ_TYPE_REFERENCE:
+            # Each expression requires all earlier concepts and mappings in its source
+            for expression in (obj.get('data') or {}).get('expressions', []):
+                expression_repo_url = expression[:cls.find_nth(expression, '/', 5) + 1]
+                requires.append(('content', expression_repo_url))
+                requires.append(('version', expression_repo_url))
+            requires.append(('references', repo_url))
+            provides.append(('references', repo_url))
+            provides.append(('content', repo_url))
+        elif obj_type in [cls.OBJ_TYPE_SOURCE_VERSION, cls.OBJ_TYPE_COLLECTION_VERSION]:
+            requires.append(('content', repo_url))
+            provides.append(('version', repo_url))
+        return requires, provides
+
     def does_object_exist(self, obj_url, use_cache=True):
         """ Returns whether an object at the specified URL already exists """
 
-        # If obj existence cached, then just return True
-        if use_cache and obj_url in self.cache_obj_exists and self.cache_obj_exists[obj_url]:
-            return True
+        # Use the result of an earlier existence check or creation by this import, then the existence index, which
+        # reflects the current exports, and only then the owners and repositories checked by earlier imports
+        if use_cache:
+            obj_exists = self.existence_cache.get(obj_url, include_saved=False)
+            if obj_exists is not None:
+                return obj_exists
+        if self.existence_index and not self.existence_index.is_stale():
+            obj_exists = self.existence_index.lookup(obj_url)
+            if obj_exists is not None:
+                return obj_exists
+        if use_cache:
+            obj_exists = self.existence_cache.get(obj_url)
+            if obj_exists is not None:
+                return obj_exists
 
         # Object existence not cached, so use API to check if it exists
-        request_existence = requests.head(self.api_url_root + obj_url, headers=self.api_headers)
+        request_existence = self.send_request('HEAD', obj_url, headers=self.api_headers, allow_redirects=False)
         if request_existence.status_code == requests.codes.ok:
-            self.cache_obj_exists[obj_url] = True
+            self.existence_cache.set(obj_url, True)
             return True
         elif request_existence.status_code == requests.codes.not_found:
+            self.existence_cache.set(obj_url, False)
             return False
         else:
             raise UnexpectedStatusCodeError(
@@ -502,6 +1554,12 @@ class OclFlexImporter:
     def does_reference_exist(self, obj_url, obj):
         """ Returns whether the specified reference already exists """
 
+        # Only the existence index is used to check references
+        if self.existence_index and not self.existence_index.is_stale():
+            collection_url = obj_url[:-len(self.obj_def[self.OBJ_TYPE_REFERENCE]['url_name']) - 1]
+            if self.existence_index.has_references(collection_url, (obj.get('data') or {}).get('expressions')):
+                return True
+
         '''
         # Return false if no expression
         if 'expression' not in obj or not obj['expression']:
@@ -526,25 +1584,37 @@ class OclFlexImporter:
 
         return False
 
-    def process_object(self, obj_type, obj):
-        """ Processes an individual document in the import file """
+    @classmethod
+    def resolve_urls(cls, obj_type, obj):
+        """
+        Resolves the owner, repository and object URLs of an import line. The owner and repository fields are
+        removed from obj, so pass a copy if obj must not be modified.
+        :param obj_type: Type of the resource
+        :param obj: Resource definition from the JSON line
+        :return: dict with keys obj_id, has_owner, has_source, has_collection, obj_owner_url, obj_repo_url,
+            obj_url and new_obj_url
+        """
+
+        # Compiled lines carry the URLs resolved when the script was compiled
+        if cls.COMPILED_FIELD in obj:
+            return obj.pop(cls.COMPILED_FIELD)
 
         # Grab the ID
         obj_id = ''
-        if 'id_field' in self.obj_def[obj_type] and self.obj_def[obj_type]['id_field'] in obj:
-            obj_id = obj[self.obj_def[obj_type]['id_field']]
+        if 'id_field' in cls.obj_def[obj_type] and cls.obj_def[obj_type]['id_field'] in obj:
+            obj_id = obj[cls.obj_def[obj_type]['id_field']]
 
         # Determine whether this resource has an owner, source, or collection
         has_owner = False
         has_source = False
         has_collection = False
-        if self.obj_def[obj_type]["has_owner"]:
+        if cls.obj_def[obj_type]["has_owner"]:
             has_owner = True
-        if self.obj_def[obj_type]["has_source"] and self.obj_def[obj_type]["has_collection"]:
+        if cls.obj_def[obj_type]["has_source"] and cls.obj_def[obj_type]["has_collection"]:
             raise InvalidObjectDefinition(obj, "Object definition for '" + obj_type + "' must not have both 'has_source' and 'has_collection' set to True")
-        elif self.obj_def[obj_type]["has_source"]:
+        elif cls.obj_def[obj_type]["has_source"]:
             has_source = True
-        elif self.obj_def[obj_type]["has_collection"]:
+        elif cls.obj_def[obj_type]["has_collection"]:
             has_collection = True
 
         # Set owner URL using ("owner_url") OR ("owner" AND "owner_type")
@@ -559,18 +1629,18 @@ class OclFlexImporter:
             elif "owner" in obj and "owner_type" in obj:
                 obj_owner_type = obj.pop("owner_type")
                 obj_owner = obj.pop("owner")
-                if obj_owner_type == self.OBJ_TYPE_ORGANIZATION:
-                    obj_owner_url = "/" + self.obj_def[self.OBJ_TYPE_ORGANIZATION]["url_name"] + "/" + obj_owner + "/"
-                elif obj_owner_url == self.OBJ_TYPE_USER:
-                    obj_owner_url = "/" + self.obj_def[self.OBJ_TYPE_USER]["url_name"] + "/" + obj_owner + "/"
+                if obj_owner_type == cls.OBJ_TYPE_ORGANIZATION:
+                    obj_owner_url = "/" + cls.obj_def[cls.OBJ_TYPE_ORGANIZATION]["url_name"] + "/" + obj_owner + "/"
+                elif obj_owner_type == cls.OBJ_TYPE_USER:
+                    obj_owner_url = "/users/" + obj_owner + "/"
                 else:
                     raise InvalidOwnerError(obj, "Valid owner information required for object of type '" + obj_type + "'")
             elif has_source and 'source_url' in obj and obj['source_url']:
                 # Extract owner info from the source URL
-                obj_owner_url = obj['source_url'][:self.find_nth(obj['source_url'], '/', 3) + 1]
+                obj_owner_url = obj['source_url'][:cls.find_nth(obj['source_url'], '/', 3) + 1]
             elif has_collection and 'collection_url' in obj and obj['collection_url']:
                 # Extract owner info from the collection URL
-                obj_owner_url = obj['collection_url'][:self.find_nth(obj['collection_url'], '/', 3) + 1]
+                obj_owner_url = obj['collection_url'][:cls.find_nth(obj['collection_url'], '/', 3) + 1]
             else:
                 raise InvalidOwnerError(obj, "Valid owner information required for object of type '" + obj_type + "'")
 
@@ -597,38 +1667,130 @@ class OclFlexImporter:
 
         # Build object URLs -- note that these always end with forward slashes
         if has_source or has_collection:
-            if 'omit_resource_name_on_get' in self.obj_def[obj_type] and self.obj_def[obj_type]['omit_resource_name_on_get']:
+            if 'omit_resource_name_on_get' in cls.obj_def[obj_type] and cls.obj_def[obj_type]['omit_resource_name_on_get']:
                 # Source or collection version does not use 'versions' in endpoint
-                new_obj_url = obj_repo_url + self.obj_def[obj_type]["url_name"] + "/"
+                new_obj_url = obj_repo_url + cls.obj_def[obj_type]["url_name"] + "/"
                 obj_url = obj_repo_url + obj_id + "/"
             elif obj_id:
                 # Concept
-                new_obj_url = obj_repo_url + self.obj_def[obj_type]["url_name"] + "/"
+                new_obj_url = obj_repo_url + cls.obj_def[obj_type]["url_name"] + "/"
                 obj_url = new_obj_url + obj_id + "/"
             else:
                 # Mapping, reference, etc.
-                new_obj_url = obj_url = obj_repo_url + self.obj_def[obj_type]["url_name"] + "/"
+                new_obj_url = obj_url = obj_repo_url + cls.obj_def[obj_type]["url_name"] + "/"
         elif has_owner:
             # Repositories (source or collection) and anything that also has a repository
-            new_obj_url = obj_owner_url + self.obj_def[obj_type]["url_name"] + "/"
+            new_obj_url = obj_owner_url + cls.obj_def[obj_type]["url_name"] + "/"
             obj_url = new_obj_url + obj_id + "/"
         else:
             # Only organizations and users don't have an owner or repository -- and only orgs can be created here
-            new_obj_url = '/' + self.obj_def[obj_type]["url_name"] + "/"
+            new_obj_url = '/' + cls.obj_def[obj_type]["url_name"] + "/"
             obj_url = new_obj_url + obj_id + "/"
 
-        # Handle query parameters
+        return {
+            'obj_id': obj_id,
+            'has_owner': has_owner,
+            'has_source': has_source,
+            'has_collection': has_collection,
+            'obj_owner_url': obj_owner_url,
+            'obj_repo_url': obj_repo_url,
+            'obj_url': obj_url,
+            'new_obj_url': new_obj_url,
+        }
+
+    @classmethod
+    def pop_query_params(cls, obj_type, obj):
+        """ Removes the query parameter fields from an import line and returns the query parameters """
         # NOTE: This is hard coded just for references for now
         query_params = {}
-        if obj_type == self.OBJ_TYPE_REFERENCE:
+        if obj_type == cls.OBJ_TYPE_REFERENCE:
             if "__cascade" in obj:
                 query_params["cascade"] = obj.pop("__cascade")
+        return query_params
 
-        # Pull out the fields that aren't allowed
+    @classmethod
+    def pop_fields_not_allowed(cls, obj_type, obj):
+        """ Removes the fields that are not sent to OCL from an import line and returns them """
         obj_not_allowed = {}
         for k in obj.keys():
-            if k not in self.obj_def[obj_type]["allowed_fields"]:
+            if k not in cls.obj_def[obj_type]["allowed_fields"]:
                 obj_not_allowed[k] = obj.pop(k)
+        return obj_not_allowed
+
+    @classmethod
+    def compile_line(cls, obj_type, obj):
+        """
+        Returns the compiled form of an import line, which carries its resolved URLs, request method and query
+        parameters in COMPILED_FIELD and only the fields that are sent to OCL, so that importing the line needs
+        no further processing. Compiled lines are imported, validated and sharded like any other line.
+        :param obj_type: Type of the resource
+        :param obj: Resource definition from the JSON line, without "type" (not modified)
+        :return: dict Compiled line, including "type"
+        :raises OclImportError: if the URLs of the line cannot be resolved
+        """
+        obj = dict(obj)
+        if cls.COMPILED_FIELD not in obj:
+            compiled = cls.resolve_urls(obj_type, obj)
+            compiled['method'] = cls.obj_def[obj_type]['create_method']
+            compiled['query_params'] = cls.pop_query_params(obj_type, obj)
+            cls.pop_fields_not_allowed(obj_type, obj)
+            obj[cls.COMPILED_FIELD] = compiled
+        obj['type'] = obj_type
+        return obj
+
+    @staticmethod
+    def compile_import_script(file_path, output_path=''):
+        """
+        Writes the compiled form of each line of a JSON lines import script (see compile_line). Lines that cannot
+        be compiled are written unchanged, so that they are reported when the script is imported.
+        Compiled scripts are imported by OclFlexImporter and OclShardedImporter, but not by the OCL bulk import.
+        :param file_path: Path of the import script
+        :param output_path: Path of the compiled script, or '' to replace the import script
+        :return: int Number of lines compiled
+        """
+        output_path = output_path or file_path
+        num_compiled = 0
+        with open(file_path, 'rb') as json_file, open(output_path + '.tmp', 'wb') as output_file:
+            for json_line_raw in json_file:
+                try:
+                    obj = json.loads(json_line_raw)
+                    obj_type = obj.pop('type', None)
+                    if obj_type in OclFlexImporter.obj_def:
+                        json_line_raw = json.dumps(OclFlexImporter.compile_line(obj_type, obj)) + '\n'
+                        num_compiled += 1
+                except (ValueError, AttributeError, OclImportError):
+                    pass
+                output_file.write(json_line_raw)
+        os.rename(output_path + '.tmp', output_path)
+        return num_compiled
+
+    def process_object(self, obj_type, obj):
+        """ Processes an individual document in the import file """
+
+        # Resolve the owner, repository and object URLs. Compiled lines carry their URLs, request method, query
+        # parameters and only the allowed fields, so they skip the rest of the preparation.
+        is_compiled = self.COMPILED_FIELD in obj
+        urls = self.resolve_urls(obj_type, obj)
+        obj_id = urls['obj_id']
+        has_owner = urls['has_owner']
+        has_source = urls['has_source']
+        has_collection = urls['has_collection']
+        obj_owner_url = urls['obj_owner_url']
+        obj_repo_url = urls['obj_repo_url']
+        obj_url = urls['obj_url']
+        new_obj_url = urls['new_obj_url']
+
+        if is_compiled:
+            create_method = urls['method']
+            query_params = urls['query_params']
+            obj_not_allowed = {}
+        else:
+            # Handle query parameters
+            create_method = self.obj_def[obj_type]['create_method']
+            query_params = self.pop_query_params(obj_type, obj)
+
+            # Pull out the fields that aren't allowed
+            obj_not_allowed = self.pop_fields_not_allowed(obj_type, obj)
 
         # Display some debug info
         if self.verbosity >= 1:
@@ -697,7 +1859,7 @@ class OclFlexImporter:
                 new_obj_url=new_obj_url,
                 obj_already_exists=obj_already_exists,
                 obj=obj, obj_not_allowed=obj_not_allowed,
-                query_params=query_params)
+                query_params=query_params, create_method=create_method)
         except requests.exceptions.HTTPError as e:
             self.log("ERROR: ", e)
 
@@ -705,7 +1867,7 @@ class OclFlexImporter:
                          obj_repo_url='', obj_url='', new_obj_url='',
                          obj_already_exists=False,
                          obj=None, obj_not_allowed=None,
-                         query_params=None):
+                         query_params=None, create_method=None):
         """ Posts an object to the OCL API as either an update or create """
 
         # Determine which URL to use based on whether or not object already exists
@@ -715,7 +1877,7 @@ class OclFlexImporter:
             url = obj_url
             action_type = self.ACTION_TYPE_UPDATE
         else:
-            method = self.obj_def[obj_type]['create_method']
+            method = create_method or self.obj_def[obj_type]['create_method']
             url = new_obj_url
             action_type = self.ACTION_TYPE_NEW
 
@@ -737,23 +1899,582 @@ class OclFlexImporter:
         # Create or update the object
         self.log(method, " ", self.api_url_root + url + '  ', json.dumps(obj))
         if method == 'POST':
-            request_result = requests.post(self.api_url_root + url, headers=self.api_headers,
-                                         data=json.dumps(obj))
+            request_result = self.send_request('POST', url, headers=self.api_headers, data=json.dumps(obj))
         elif method == 'PUT':
-            request_result = requests.put(self.api_url_root + url, headers=self.api_headers,
-                                         data=json.dumps(obj))
+            latency_target = self.REFERENCE_LATENCY_TARGET if obj_type == self.OBJ_TYPE_REFERENCE else None
+            request_result = self.send_request(
+                'PUT', url, latency_target=latency_target, headers=self.api_headers, data=json.dumps(obj))
+            # Only successful responses reflect the time needed to add a batch of references
+            if (obj_type == self.OBJ_TYPE_REFERENCE and self.reference_latency_stats and
+                    200 <= request_result.status_code < 300):
+                self.reference_latency_stats.record(
+                    obj_repo_url, (query_params or {}).get('cascade'),
+                    len((obj.get('data') or {}).get('expressions', [])), request_result.elapsed.total_seconds())
         self.log("STATUS CODE:", request_result.status_code)
         self.log(request_result.headers)
         self.log(request_result.text)
-        self.import_results.add(
+        self.get_import_results().add(
             obj_url=obj_url, action_type=action_type, obj_type=obj_type, obj_repo_url=obj_repo_url,
             http_method=method, obj_owner_url=obj_owner_url, status_code=request_result.status_code)
         request_result.raise_for_status()
+        if action_type == self.ACTION_TYPE_NEW and obj_id:
+            self.existence_cache.set(obj_url, True)
 
-    def find_nth(self, haystack, needle, n):
+    @staticmethod
+    def find_nth(haystack, needle, n):
         """ Find nth occurrence of a substring within a string """
         start = haystack.find(needle)
         while start >= 0 and n > 1:
             start = haystack.find(needle, start+len(needle))
             n -= 1
         return start
+
+
+class OclBulkImporter:
+    """
+    Class to import a JSON lines file using the asynchronous bulk import API of OCL instead of one request per line.
+    The file is uploaded in parts of at most max_part_size bytes, split on line boundaries, and each part is
+    submitted as a bulk import job that is polled until it completes before the next part is uploaded, so that
+    lines are still imported in order. The per-line results reported by OCL are added to an OclImportResults
+    object, so that it can be used in the same way as the results of OclFlexImporter.
+    """
+
+    DEFAULT_BULK_IMPORT_URL = '/manage/bulkimport/'
+    DEFAULT_MAX_PART_SIZE = 5 * 1024 * 1024
+
+    # Seconds between status checks of a bulk import job, doubling up to the maximum while the job is pending
+    POLL_INTERVAL = 1
+    MAX_POLL_INTERVAL = 30
+
+    # Maximum number of seconds to wait for a single bulk import job to complete
+    JOB_TIMEOUT = 6 * 60 * 60
+
+    # States reported by OCL while a bulk import job has not completed yet
+    PENDING_STATES = ['PENDING', 'RECEIVED', 'STARTED', 'RETRY']
+
+    def __init__(self, file_path='', api_url_root='', api_token='', limit=0, test_mode=False, verbosity=1,
+                 do_update_if_exists=False, http_client=None, compact_results=False, results_detail_log='',
+                 bulk_import_url=DEFAULT_BULK_IMPORT_URL, max_part_size=DEFAULT_MAX_PART_SIZE):
+        """
+        Initialize this object
+        bulk_import_url is the bulk import endpoint, either relative to api_url_root or an absolute URL (e.g. of a
+        local stand-in for testing). In test mode, the parts are prepared but not submitted.
+        """
+        self.file_path = file_path
+        self.api_url_root = api_url_root
+        self.api_token = api_token
+        self.limit = limit
+        self.test_mode = test_mode
+        self.verbosity = verbosity
+        self.do_update_if_exists = do_update_if_exists
+        self.compact_results = compact_results
+        self.results_detail_log = results_detail_log
+        self.bulk_import_url = bulk_import_url
+        self.max_part_size = max_part_size
+        self.import_results = None
+
+        # Pooled, retrying HTTP client -- shared with the sync scripts unless one is provided
+        if http_client:
+            self.http_client = http_client
+        else:
+            self.http_client = DatimHttpClient.get_shared_client()
+
+        # Prepare the headers
+        self.api_headers = {
+            'Authorization': 'Token ' + self.api_token,
+            'Content-Type': 'application/json'
+        }
+
+    def log(self, *args):
+        """ Output log information """
+        write_log(*args)
+
+    def log_settings(self):
+        """ Output log of the object settings """
+        self.log("**** OCL BULK IMPORT SETTINGS ****",
+                 "API Root URL:", self.api_url_root,
+                 ", API Token:", self.api_token,
+                 ", Import File:", self.file_path,
+                 ", Bulk Import URL:", self.get_bulk_import_url(),
+                 ", Max Part Size:", self.max_part_size,
+                 ", Test Mode:", self.test_mode,
+                 ", Update Resource if Exists: ", self.do_update_if_exists,
+                 ", Verbosity:", self.verbosity)
+
+    def get_bulk_import_url(self):
+        """ Returns the absolute URL of the bulk import endpoint """
+        if urlparse(self.bulk_import_url).scheme:
+            return self.bulk_import_url
+        return self.api_url_root + self.bulk_import_url
+
+    def iter_parts(self):
+        """
+        Yields the lines of the import file (up to limit) in parts of at most max_part_size bytes. A line that is
+        longer than max_part_size is yielded as a part by itself.
+        :return: generator of tuples (str part, int number of lines in the part)
+        """
+        part = []
+        part_size = 0
+        count = 0
+        with open(self.file_path, 'rb') as json_file:
+            for json_line_raw in iter(json_file.readline, ''):
+                if self.limit > 0 and count >= self.limit:
+                    break
+                if not json_line_raw.strip():
+                    continue
+                if not json_line_raw.endswith('\n'):
+                    json_line_raw += '\n'
+                if part and part_size + len(json_line_raw) > self.max_part_size:
+                    yield ''.join(part), len(part)
+                    part = []
+                    part_size = 0
+                part.append(json_line_raw)
+                part_size += len(json_line_raw)
+                count += 1
+        if part:
+            yield ''.join(part), len(part)
+
+    def process(self):
+        """
+        Imports a JSON-lines file using the OCL bulk import API
+        :return: int Number of JSON lines processed
+        """
+        if self.verbosity:
+            self.log_settings()
+
+        self.import_results = OclImportResults(
+            compact=self.compact_results, detail_log_path=self.results_detail_log)
+        count = 0
+        try:
+            for part_number, (part, num_lines) in enumerate(self.iter_parts(), 1):
+                count += num_lines
+                self.import_results.total_lines = count
+                if self.test_mode:
+                    self.log('[TEST MODE] Skipping bulk import of part %s: %s lines, %s bytes' % (
+                        part_number, num_lines, len(part)))
+                    continue
+                task_id = self.submit_part(part)
+                self.log('Submitted part %s (%s lines, %s bytes) as bulk import job "%s"' % (
+                    part_number, num_lines, len(part), task_id))
+                self.add_bulk_import_results(self.wait_for_job(task_id))
+                self.log('[%s]' % self.import_results.get_detailed_summary())
+        finally:
+            self.import_results.close()
+        return count
+
+    def submit_part(self, part):
+        """
+        Submits a part of the import file as a bulk import job
+        :param part: str JSON lines to import
+        :return: str ID of the bulk import job
+        """
+        url = self.get_bulk_import_url()
+        params = {'update_if_exists': 'true' if self.do_update_if_exists else 'false'}
+        response = self.http_client.request('POST', url, headers=self.api_headers, data=part, params=params)
+        if response.status_code not in [requests.codes.ok, requests.codes.created, requests.codes.accepted]:
+            raise UnexpectedStatusCodeError(
+                "POST " + url, "Unexpected status code returned: " + str(response.status_code))
+        task_id = response.json().get('task')
+        if not task_id:
+            raise BulkImportError("POST " + url, "No bulk import job ID returned: " + response.text)
+        return task_id
+
+    def wait_for_job(self, task_id):
+        """
+        Polls the status of a bulk import job until it completes
+        :param task_id: str ID of the bulk import job
+        :return: dict Results of the bulk import job
+        """
+        url = self.get_bulk_import_url()
+        params = {'task': task_id, 'result': 'json'}
+        poll_interval = self.POLL_INTERVAL
+        start_time = time.time()
+        while True:
+            response = self.http_client.request('GET', url, headers=self.api_headers, params=params)
+            try:
+                job_status = response.json()
+            except ValueError:
+                job_status = None
+            if not isinstance(job_status, dict):
+                # Only a pending job may report its status without a JSON object
+                if response.status_code != requests.codes.accepted:
+                    raise BulkImportError(
+                        "GET " + url, "Bulk import job '%s' returned status code %s without valid results: %s" % (
+                            task_id, response.status_code, response.text))
+                job_status = {}
+            state = str(job_status.get('state', '')).upper()
+            if response.status_code == requests.codes.accepted or state in self.PENDING_STATES:
+                if time.time() - start_time > self.JOB_TIMEOUT:
+                    raise BulkImportError("GET " + url, "Bulk import job '%s' timed out" % task_id)
+                if self.verbosity >= 2:
+                    self.log('Bulk import job "%s" is %s' % (task_id, state or 'pending'))
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, self.MAX_POLL_INTERVAL)
+            elif response.status_code == requests.codes.ok and state not in ['FAILURE', 'REVOKED']:
+                if not isinstance(job_status.get('results'), dict):
+                    raise BulkImportError(
+                        "GET " + url, "Bulk import job '%s' completed without results: %s" % (task_id, response.text))
+                return job_status
+            else:
+                raise BulkImportError(
+                    "GET " + url, "Bulk import job '%s' failed with status code %s: %s" % (
+                        task_id, response.status_code, response.text))
+
+    def add_bulk_import_results(self, job_results):
+        """
+        Adds the per-line results of a completed bulk import job to the import results. The results are nested by
+        root key, action type and status code, like OclImportResults, where each result is either a dict with the
+        keys of OclImportResults.add (obj_url, http_method, ...) or a string describing the request.
+        :param job_results: dict Results of a bulk import job
+        """
+        results = job_results.get('results', {})
+        for root_key, action_types in results.iteritems():
+            for action_type, status_codes in action_types.iteritems():
+                for status_code, items in status_codes.iteritems():
+                    for item in items:
+                        if root_key == OclImportResults.SKIP_KEY:
+                            if not isinstance(item, basestring):
+                                item = json.dumps(item)
+                            self.import_results.add_skip(obj_type=action_type, text=item)
+                            continue
+                        if isinstance(item, dict):
+                            item = '%s %s' % (item.get('http_method', ''), item.get('obj_url', ''))
+                        if isinstance(status_code, basestring) and status_code.isdigit():
+                            status_code = int(status_code)
+                        self.import_results.add_result(root_key, action_type, status_code, item)
+
+
+def import_shard(shard_settings):
+    """
+    Imports a single shard of a sharded import script in a worker process of OclShardedImporter. The output of the
+    importer is written to the log file of the shard and the partial results are saved to its results file.
+    :param shard_settings: dict with keys shard_id, file_path, log_path, results_path, importer_kwargs and
+        reference_latency_stats_path
+    :return: str Path of the partial results file
+    """
+    stdout = sys.stdout
+    importer = None
+    error = None
+    count = 0
+    with open(shard_settings['log_path'], 'ab') as log_file:
+        sys.stdout = log_file
+        try:
+            reference_latency_stats = None
+            if shard_settings['reference_latency_stats_path']:
+                reference_latency_stats = DatimReferenceLatencyStats(
+                    path=shard_settings['reference_latency_stats_path'])
+            importer = OclFlexImporter(
+                file_path=shard_settings['file_path'], reference_latency_stats=reference_latency_stats,
+                **shard_settings['importer_kwargs'])
+            count = importer.process()
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, getattr(e, 'message', None) or str(e))
+            log_file.write('[%s] ERROR: %s\n' % (datetime.now(), error))
+        finally:
+            sys.stdout = stdout
+    results_state = importer.import_results.get_state() if importer and importer.import_results else None
+    with open(shard_settings['results_path'] + '.tmp', 'wb') as results_file:
+        results_file.write(json.dumps({
+            'shard_id': shard_settings['shard_id'],
+            'count': count,
+            'error': error,
+            'import_results': results_state,
+        }))
+    os.rename(shard_settings['results_path'] + '.tmp', shard_settings['results_path'])
+    return shard_settings['results_path']
+
+
+class OclShardedImporter:
+    """
+    Class to import a JSON lines file that has been split into shards by target repository (see
+    shard_import_script) using a pool of worker processes. A shard starts once all shards it depends on have been
+    imported, so independent shards are imported in parallel. Each worker imports its shard with an
+    OclFlexImporter and saves its partial results, which are merged into one OclImportResults object.
+    """
+
+    DEFAULT_NUM_PROCESSES = 4
+
+    # Seconds between checks for completed shards
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, manifest_path='', api_url_root='', api_token='', test_mode=False, verbosity=1,
+                 do_update_if_exists=False, import_delay=0, num_processes=DEFAULT_NUM_PROCESSES, num_workers=1,
+                 existence_index=None, compact_results=False, results_detail_log='', resume=False,
+                 reference_latency_stats_path=''):
+        """
+        Initialize this object
+        num_processes is the number of shards imported at the same time, and num_workers the number of threads
+        used by the importer of each shard. Each shard is checkpointed, so resume continues interrupted shards.
+        """
+        self.manifest_path = manifest_path
+        self.api_url_root = api_url_root
+        self.api_token = api_token
+        self.test_mode = test_mode
+        self.verbosity = verbosity
+        self.do_update_if_exists = do_update_if_exists
+        self.import_delay = import_delay
+        self.num_processes = num_processes
+        self.num_workers = num_workers
+        self.existence_index = existence_index
+        self.compact_results = compact_results
+        self.results_detail_log = results_detail_log
+        self.resume = resume
+        self.reference_latency_stats_path = reference_latency_stats_path
+        self.import_results = None
+
+    def log(self, *args):
+        """ Output log information """
+        write_log(*args)
+
+    def log_settings(self):
+        """ Output log of the object settings """
+        self.log("**** OCL SHARDED IMPORT SETTINGS ****",
+                 "API Root URL:", self.api_url_root,
+                 ", API Token:", self.api_token,
+                 ", Manifest:", self.manifest_path,
+                 ", Test Mode:", self.test_mode,
+                 ", Update Resource if Exists: ", self.do_update_if_exists,
+                 ", Verbosity:", self.verbosity,
+                 ", Import Delay: ", self.import_delay,
+                 ", Processes: ", self.num_processes,
+                 ", Workers: ", self.num_workers,
+                 ", Resume: ", self.resume)
+
+    @staticmethod
+    def shard_import_script(file_path, manifest_path):
+        """
+        Splits a JSON lines import script into shards by target repository and writes a manifest that lists the
+        shards and the shards each depends on. Lines keep their order within each shard. A shard depends on
+        another if one of its lines requires a resource provided by an earlier line of the other shard (see
+        OclFlexImporter.get_line_dependencies). Shards that depend on each other are combined into one shard.
+        :param file_path: Path of the import script
+        :param manifest_path: Path of the manifest. Shards are written next to it.
+        :return: dict Manifest
+        """
+
+        # Assign each line to the repository (or owner) it targets and collect the dependencies between them
+        line_keys = []
+        shard_keys = {}
+        providers = {}
+        dependencies = {}
+        with open(file_path, 'rb') as json_file:
+            for json_line_raw in json_file:
+                try:
+                    obj = json.loads(json_line_raw)
+                except ValueError:
+                    obj = {}
+                obj_type = obj.pop('type', None) if isinstance(obj, dict) else None
+                if obj_type in OclFlexImporter.obj_def:
+                    requires, provides = OclFlexImporter.get_line_dependencies(obj_type, obj)
+                else:
+                    requires, provides = [], []
+                shard_key = ''
+                for kind, url in provides:
+                    if kind in ['owner', 'repo', 'content', 'references', 'version']:
+                        shard_key = url
+                        break
+                else:
+                    for kind, url in requires:
+                        if kind == 'repo':
+                            shard_key = url
+                shard_key = shard_keys.setdefault(shard_key, shard_key)
+                dependencies.setdefault(shard_key, set())
+                line_keys.append(shard_key)
+                for key in requires:
+                    for provider in providers.get(key, ()):
+                        if provider != shard_key:
+                            dependencies[shard_key].add(provider)
+                for key in provides:
+                    providers.setdefault(key, set()).add(shard_key)
+
+        # Combine shards that depend on each other, i.e. the strongly connected components of the dependency graph
+        groups = OclShardedImporter.get_strongly_connected_components(dependencies)
+        group_ids = {}
+        for group_id, group in enumerate(groups):
+            for shard_key in group:
+                group_ids[shard_key] = group_id
+
+        # Write the shards and the manifest
+        manifest = {'file_path': os.path.abspath(file_path), 'shards': []}
+        output_files = {}
+        try:
+            for group_id, group in enumerate(groups):
+                shard_path = '%s.shard%s.json' % (manifest_path, group_id)
+                output_files[group_id] = open(shard_path, 'wb')
+                depends_on = set()
+                for shard_key in group:
+                    depends_on.update(group_ids[dependency] for dependency in dependencies[shard_key])
+                depends_on.discard(group_id)
+                manifest['shards'].append({
+                    'id': group_id,
+                    'file_path': shard_path,
+                    'repo_urls': sorted(group),
+                    'num_lines': 0,
+                    'depends_on': sorted(depends_on),
+                })
+            with open(file_path, 'rb') as json_file:
+                for line_number, json_line_raw in enumerate(json_file):
+                    group_id = group_ids[line_keys[line_number]]
+                    output_files[group_id].write(json_line_raw)
+                    manifest['shards'][group_id]['num_lines'] += 1
+        finally:
+            for output_file in output_files.values():
+                output_file.close()
+        with open(manifest_path + '.tmp', 'wb') as manifest_file:
+            manifest_file.write(json.dumps(manifest, indent=4))
+        os.rename(manifest_path + '.tmp', manifest_path)
+        return manifest
+
+    @staticmethod
+    def get_strongly_connected_components(dependencies):
+        """
+        Returns the strongly connected components of a dependency graph, ordered so that each component comes
+        after the components it depends on (Tarjan's algorithm, without recursion)
+        :param dependencies: dict of node -> set of the nodes it depends on
+        :return: list of lists of nodes
+        """
+        index = {}
+        low_link = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in sorted(dependencies):
+            if root in index:
+                continue
+            work = [(root, iter(sorted(dependencies[root])))]
+            index[root] = low_link[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low_link[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(dependencies[child]))))
+                        break
+                    elif child in on_stack:
+                        low_link[node] = min(low_link[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        low_link[work[-1][0]] = min(low_link[work[-1][0]], low_link[node])
+                    if low_link[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(sorted(component))
+        return components
+
+    def process(self):
+        """
+        Imports the shards listed in the manifest using a pool of worker processes. If any shard fails, an
+        OclImportError is raised once all other shards are done, and import_results still holds their results.
+        :return: int Number of JSON lines processed
+        """
+        if self.verbosity:
+            self.log_settings()
+        with open(self.manifest_path, 'rb') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        # Check the owners and repositories of all shards at once, so that each shard finds them in the shared
+        # existence cache instead of checking them again
+        preflight_urls = set()
+        for shard in manifest['shards']:
+            for repo_url in shard['repo_urls']:
+                if repo_url:
+                    preflight_urls.add(repo_url)
+                    preflight_urls.add(repo_url[:OclFlexImporter.find_nth(repo_url, '/', 3) + 1])
+        OclFlexImporter(
+            api_url_root=self.api_url_root, api_token=self.api_token, verbosity=self.verbosity,
+            import_delay=self.import_delay, existence_index=self.existence_index).preflight(preflight_urls)
+
+        # Settings passed to the importer of each shard
+        importer_kwargs = {
+            'api_url_root': self.api_url_root,
+            'api_token': self.api_token,
+            'test_mode': self.test_mode,
+            'verbosity': self.verbosity,
+            'do_update_if_exists': self.do_update_if_exists,
+            'import_delay': self.import_delay,
+            'num_workers': self.num_workers,
+            'existence_index': self.existence_index,
+            'compact_results': self.compact_results,
+            'resume': self.resume,
+        }
+
+        self.import_results = OclImportResults(
+            total_lines=sum(shard['num_lines'] for shard in manifest['shards']), compact=self.compact_results,
+            detail_log_path=self.results_detail_log)
+        pending = dict((shard['id'], shard) for shard in manifest['shards'])
+        running = {}
+        completed = set()
+        failed = {}
+        count = 0
+        pool = multiprocessing.Pool(processes=self.num_processes)
+        try:
+            while pending or running:
+                # Start the shards whose dependencies have been imported, and skip those with failed dependencies
+                for shard_id in sorted(pending):
+                    shard = pending[shard_id]
+                    failed_dependencies = [dependency for dependency in shard['depends_on'] if dependency in failed]
+                    if failed_dependencies:
+                        del pending[shard_id]
+                        failed[shard_id] = 'Skipped because shard(s) %s failed' % failed_dependencies
+                        self.log('**** SKIPPING shard %s: %s' % (shard_id, failed[shard_id]))
+                    elif all(dependency in completed for dependency in shard['depends_on']):
+                        del pending[shard_id]
+                        shard_importer_kwargs = dict(importer_kwargs)
+                        shard_importer_kwargs['results_detail_log'] = shard['file_path'] + '.results.jsonl'
+                        shard_importer_kwargs['checkpoint_path'] = shard['file_path'] + '.checkpoint.json'
+                        running[shard_id] = pool.apply_async(import_shard, ({
+                            'shard_id': shard_id,
+                            'file_path': shard['file_path'],
+                            'log_path': shard['file_path'] + '.log',
+                            'results_path': shard['file_path'] + '.results.json',
+                            'importer_kwargs': shard_importer_kwargs,
+                            'reference_latency_stats_path': self.reference_latency_stats_path,
+                        },))
+                        self.log('Started shard %s (%s lines): %s' % (
+                            shard_id, shard['num_lines'], ', '.join(shard['repo_urls'])))
+                if not running:
+                    for shard_id in pending:
+                        failed[shard_id] = 'Not started because its dependencies were not imported'
+                    break
+
+                # Merge the partial results of completed shards
+                finished = [shard_id for shard_id in running if running[shard_id].ready()]
+                if not finished:
+                    time.sleep(self.POLL_INTERVAL)
+                for shard_id in finished:
+                    results_path = running.pop(shard_id).get()
+                    with open(results_path, 'rb') as results_file:
+                        shard_results = json.load(results_file)
+                    if shard_results['import_results']:
+                        self.import_results.merge_state(
+                            shard_results['import_results'],
+                            detail_log_path=manifest['shards'][shard_id]['file_path'] + '.results.jsonl')
+                    count += shard_results['count']
+                    if shard_results['error']:
+                        failed[shard_id] = shard_results['error']
+                        self.log('ERROR: Shard %s failed: %s' % (shard_id, shard_results['error']))
+                    else:
+                        completed.add(shard_id)
+                        self.log('Completed shard %s: %s' % (shard_id, self.import_results.get_detailed_summary()))
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.import_results.close()
+
+        if failed:
+            raise OclImportError('Failed to import shard(s) %s. See the log file of each shard for details.' % (
+                ', '.join(str(shard_id) for shard_id in sorted(failed))))
+        return count
@@ -0,0 +1,30 @@
+"""
+Tests for the keyed diff of the OCL and DHIS2 resources prepared for a sync
+
+Usage: python -m unittest test_datimdiff
+"""
+import unittest
+from datimdiff import DatimKeyedDiff
+
+
+class DatimKeyedDiffTest(unittest.TestCase):
+
+    def test_changed_resources_are_diffed_by_field(self):
+        diff = DatimKeyedDiff(
+            {'/a/': {'x': 'P', 'names': ['A', 'B']}, '/b/': {'x': 'Q'}, '/c/': {'x': 'R'}},
+            {'/a/': {'x': 'S', 'names': ['B', 'C']}, '/b/': {'x': 'Q'}, '/d/': {'x': 'T'}})
+        self.assertEqual(diff['dictionary_item_added'], {"root['/d/']": {'x': 'T'}})
+        self.assertEqual(diff['dictionary_item_removed'], {"root['/c/']": {'x': 'R'}})
+        self.assertEqual(diff['values_changed'], {"root['/a/']['x']": {'old_value': 'P', 'new_value': 'S'}})
+        self.assertEqual(diff['iterable_item_added'], {"root['/a/']['names'][1]": 'C'})
+        self.assertEqual(diff['iterable_item_removed'], {"root['/a/']['names'][0]": 'A'})
+        self.assertEqual(diff.num_unchanged, 1)
+
+    def test_equal_values_of_different_types_are_unchanged(self):
+        diff = DatimKeyedDiff({'a': {'x': u'P', 'y': 1, 'n': 1}}, {'a': {'x': 'P', 'y': 1.0, 'n': 2}})
+        self.assertNotIn('type_changes', diff)
+        self.assertEqual(diff['values_changed'], {"root['a']['n']": {'old_value': 1, 'new_value': 2}})
+
+
+if __name__ == '__main__':
+    unittest.main()
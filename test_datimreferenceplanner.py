@@ -0,0 +1,79 @@
+"""
+Tests for splitting the reference lines of an import script into bounded batches
+
+Usage: python -m unittest test_datimreferenceplanner
+"""
+import json
+import unittest
+from datimreferenceplanner import DatimReferenceLatencyStats, DatimReferencePlanner
+
+
+class DatimReferencePlannerTest(unittest.TestCase):
+
+    COLLECTION_URL = '/orgs/PEPFAR/collections/MER-R-Facility-FY17Q4/'
+    SOURCE_URL = '/orgs/PEPFAR/sources/MER/'
+
+    def get_concept_expressions(self, num):
+        return ['%sconcepts/CONCEPT-%s/' % (self.SOURCE_URL, i) for i in range(num)]
+
+    def get_mapping_expressions(self, num):
+        return ['%smappings/MAPPING-%s/' % (self.SOURCE_URL, i) for i in range(num)]
+
+    def get_planner(self, expressions, **kwargs):
+        planner = DatimReferencePlanner(**kwargs)
+        # Split over several reference lines, which are merged again
+        for i in range(0, len(expressions), 7):
+            planner.add({'type': 'Reference', 'owner': 'PEPFAR', 'owner_type': 'Organization',
+                         'collection_url': self.COLLECTION_URL, 'data': {'expressions': expressions[i:i + 7]}})
+        return planner
+
+    @staticmethod
+    def get_batch_expressions(batches):
+        return [batch['data']['expressions'] for batch in batches]
+
+    def test_batches_respect_max_batch_bytes(self):
+        expressions = self.get_concept_expressions(60)
+        max_batch_bytes = 500
+        batches = self.get_batch_expressions(self.get_planner(
+            expressions, max_batch_bytes=max_batch_bytes, default_batch_size=1000,
+            max_concept_batch_size=1000).plan())
+        self.assertGreater(len(batches), 1)
+        for batch in batches:
+            self.assertLessEqual(len(json.dumps(batch)), max_batch_bytes)
+        self.assertEqual(sum(batches, []), expressions)
+
+    def test_batches_respect_max_mapping_batch_size(self):
+        concept_expressions = self.get_concept_expressions(10)
+        mapping_expressions = self.get_mapping_expressions(10)
+        expressions = concept_expressions + mapping_expressions
+        batches = self.get_batch_expressions(self.get_planner(
+            expressions, default_batch_size=100, max_mapping_batch_size=4).plan())
+        self.assertEqual([len(batch) for batch in batches], [14, 4, 2])
+        for batch in batches:
+            self.assertLessEqual(len([e for e in batch if DatimReferencePlanner.is_mapping_expression(e)]), 4)
+        self.assertEqual(sum(batches, []), expressions)
+
+    def test_batch_size_follows_observed_latency(self):
+        expressions = self.get_concept_expressions(45)
+
+        # Without observed latency, the default batch size is used
+        batches = self.get_batch_expressions(self.get_planner(expressions, default_batch_size=25).plan())
+        self.assertEqual([len(batch) for batch in batches], [25, 20])
+
+        # 2 seconds per expression and a latency target of 20 seconds allow 10 expressions per batch
+        latency_stats = DatimReferenceLatencyStats()
+        latency_stats.record(self.COLLECTION_URL, None, 5, 10.0)
+        batches = self.get_batch_expressions(self.get_planner(
+            expressions, latency_stats=latency_stats, latency_target=20.0).plan())
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 10, 10, 5])
+
+        # Fast collections are still capped at max_concept_batch_size
+        latency_stats = DatimReferenceLatencyStats()
+        latency_stats.record(self.COLLECTION_URL, None, 5, 0.001)
+        batches = self.get_batch_expressions(self.get_planner(
+            expressions, latency_stats=latency_stats, max_concept_batch_size=30).plan())
+        self.assertEqual([len(batch) for batch in batches], [30, 15])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,403 @@
+"""
+Tests for the OCL importers, using a stub HTTP client or a local stub HTTP server in place of the OCL API
+
+Usage: python -m unittest test_oclfleximporter
+"""
+import BaseHTTPServer
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from urlparse import parse_qs, urlparse
+import requests
+from datimhttpclient import DatimHttpClient
+from datimratelimiter import DatimRateLimiter
+from oclfleximporter import BulkImportError, OclBulkImporter, OclExistenceCache, OclExistenceIndex, OclFlexImporter
+
+
+class StubOclApi:
+    """
+    Stub HTTP client that creates concepts on POST and answers HEAD requests. The first POST of fail_id fails
+    without a response and the first POST of throttle_id is answered with 503 Service Unavailable.
+    """
+
+    max_retries = 3
+
+    def __init__(self, fail_id=None, throttle_id=None):
+        self.fail_id = fail_id
+        self.throttle_id = throttle_id
+        self.created_urls = set()
+        self.num_posts = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_response(status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = ''
+        response.raw = io.BytesIO()
+        response.elapsed = timedelta(seconds=0.001)
+        return response
+
+    def request(self, method, url, **kwargs):
+        path = url[url.index('/orgs/'):]
+        if method == 'HEAD':
+            with self._lock:
+                return self.get_response(200 if path in self.created_urls else 404)
+        obj = json.loads(kwargs['data'])
+        if obj['id'] == self.fail_id:
+            self.fail_id = None
+            # Give the lines that are running at the same time the chance to complete
+            time.sleep(0.2)
+            raise requests.exceptions.ConnectionError('Connection reset')
+        if obj['id'] == self.throttle_id:
+            self.throttle_id = None
+            return self.get_response(503)
+        with self._lock:
+            self.num_posts += 1
+            self.created_urls.add(path + obj['id'] + '/')
+        return self.get_response(201)
+
+    def get_retry_delay(self, attempt, response=None):
+        return 0
+
+
+class OclFlexImporterResumeTest(unittest.TestCase):
+
+    NUM_CONCEPTS = 47
+    SOURCE_URL = '/orgs/PEPFAR/sources/MER/'
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, 'import.json')
+        with open(self.file_path, 'wb') as import_file:
+            for i in range(self.NUM_CONCEPTS):
+                import_file.write(json.dumps({
+                    'type': 'Concept', 'id': 'C%s' % i, 'concept_class': 'Indicator', 'datatype': 'None',
+                    'owner': 'PEPFAR', 'owner_type': 'Organization', 'source': 'MER',
+                    'names': [{'name': 'Concept %s' % i, 'locale': 'en'}]}) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_importer(self, api, num_workers, resume=False):
+        existence_cache = OclExistenceCache()
+        existence_cache.set('/orgs/PEPFAR/', True)
+        existence_cache.set(self.SOURCE_URL, True)
+        rate_limiter = DatimRateLimiter(
+            state_path=os.path.join(self.temp_dir, 'rate-limiter.json'), initial_rate=1000, max_rate=1000)
+        return OclFlexImporter(
+            file_path=self.file_path, api_url_root='https://api.example.org', api_token='token', verbosity=0,
+            http_client=api, num_workers=num_workers, rate_limiter=rate_limiter, existence_cache=existence_cache,
+            checkpoint_path=os.path.join(self.temp_dir, 'import.json.checkpoint.json'), resume=resume)
+
+    def assert_resume_records_all_results(self, num_workers):
+        api = StubOclApi(fail_id='C10')
+        self.assertRaises(requests.exceptions.ConnectionError, self.get_importer(api, num_workers).process)
+        importer = self.get_importer(api, num_workers, resume=True)
+        self.assertEqual(importer.process(), self.NUM_CONCEPTS)
+        self.assertEqual(api.num_posts, self.NUM_CONCEPTS)
+        self.assertEqual(importer.import_results.count, self.NUM_CONCEPTS)
+        self.assertTrue(importer.import_results.has(root_key=self.SOURCE_URL, limit_to_success_codes=True))
+
+    def test_resume_sequential_import(self):
+        self.assert_resume_records_all_results(num_workers=1)
+
+    def test_resume_concurrent_import(self):
+        self.assert_resume_records_all_results(num_workers=8)
+
+    def test_checkpoint_of_changed_file_is_ignored(self):
+        api = StubOclApi(fail_id='C10')
+        self.assertRaises(requests.exceptions.ConnectionError, self.get_importer(api, 1).process)
+
+        # Same size, different content
+        with open(self.file_path, 'rb') as import_file:
+            content = import_file.read()
+        with open(self.file_path, 'wb') as import_file:
+            import_file.write(content.replace('"C1"', '"X1"'))
+        self.assertIsNone(self.get_importer(api, 1, resume=True).load_checkpoint())
+
+    def test_throttled_request_is_retried_and_slows_down_import(self):
+        api = StubOclApi(throttle_id='C10')
+        importer = self.get_importer(api, 1)
+        self.assertEqual(importer.process(), self.NUM_CONCEPTS)
+        self.assertEqual(api.num_posts, self.NUM_CONCEPTS)
+        self.assertTrue(importer.import_results.has(root_key=self.SOURCE_URL, limit_to_success_codes=True))
+        self.assertLess(importer.rate_limiter.get_rate(), 1000)
+
+
+class OrderRecordingOclApi(StubOclApi):
+    """
+    Stub HTTP client that records the order in which concepts, mappings and repository versions are created.
+    Versions are created immediately, while concepts and mappings take a little longer, so that a version that
+    does not wait for the content before it is created first.
+    """
+
+    DELAYS = {'concepts': 0.02, 'mappings': 0.01, 'versions': 0}
+
+    def __init__(self):
+        StubOclApi.__init__(self)
+        self.created = []
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, url, **kwargs):
+        path = url[url.index('/orgs/'):]
+        if method == 'HEAD':
+            return StubOclApi.request(self, method, url, **kwargs)
+        obj = json.loads(kwargs['data'])
+        resource_type = path.split('/')[-2]
+        with self._lock:
+            self.num_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+        time.sleep(self.DELAYS[resource_type])
+        with self._lock:
+            self.num_in_flight -= 1
+            self.num_posts += 1
+            if resource_type == 'concepts':
+                self.created_urls.add(path + obj['id'] + '/')
+                self.created.append(obj['id'])
+            elif resource_type == 'versions':
+                self.created_urls.add(path[:-len('versions/')] + obj['id'] + '/')
+                self.created.append(obj['id'])
+            else:
+                self.created.append('%s-%s' % (obj['from_concept_url'].split('/')[-2],
+                                               obj['to_concept_url'].split('/')[-2]))
+        return self.get_response(201)
+
+
+class OclFlexImporterConcurrencyTest(unittest.TestCase):
+
+    SOURCE_URL = '/orgs/PEPFAR/sources/MER/'
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, 'import.json')
+        lines = [self.get_concept(i) for i in range(6)]
+        lines += [self.get_mapping(0, 1), self.get_mapping(2, 3), {'type': 'Source Version', 'id': 'v1'}]
+        lines += [self.get_concept(i) for i in range(6, 9)]
+        lines += [self.get_mapping(6, 0), {'type': 'Source Version', 'id': 'v2'}, self.get_concept(9)]
+        with open(self.file_path, 'wb') as import_file:
+            for line in lines:
+                line.update({'owner': 'PEPFAR', 'owner_type': 'Organization', 'source': 'MER'})
+                import_file.write(json.dumps(line) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def get_concept(i):
+        return {'type': 'Concept', 'id': 'C%s' % i, 'concept_class': 'Indicator', 'datatype': 'None',
+                'names': [{'name': 'Concept %s' % i, 'locale': 'en'}]}
+
+    def get_mapping(self, from_i, to_i):
+        return {'type': 'Mapping', 'map_type': 'Has Child',
+                'from_concept_url': '%sconcepts/C%s/' % (self.SOURCE_URL, from_i),
+                'to_concept_url': '%sconcepts/C%s/' % (self.SOURCE_URL, to_i)}
+
+    def import_file(self, num_workers):
+        api = OrderRecordingOclApi()
+        existence_cache = OclExistenceCache()
+        existence_cache.set('/orgs/PEPFAR/', True)
+        existence_cache.set(self.SOURCE_URL, True)
+        rate_limiter = DatimRateLimiter(
+            state_path=os.path.join(self.temp_dir, 'rate-limiter.json'), initial_rate=1000, max_rate=1000)
+        importer = OclFlexImporter(
+            file_path=self.file_path, api_url_root='https://api.example.org', api_token='token', verbosity=0,
+            http_client=api, num_workers=num_workers, rate_limiter=rate_limiter, existence_cache=existence_cache)
+        self.assertEqual(importer.process(), 15)
+        return api, importer.import_results
+
+    def test_concurrent_import_keeps_dependency_order(self):
+        api, _ = self.import_file(num_workers=8)
+        self.assertEqual(len(api.created), 15)
+        order = dict((name, index) for index, name in enumerate(api.created))
+        for mapping in ['C0-C1', 'C2-C3', 'C6-C0']:
+            from_id, to_id = mapping.split('-')
+            self.assertGreater(order[mapping], max(order[from_id], order[to_id]))
+        for name in ['C0', 'C1', 'C2', 'C3', 'C4', 'C5', 'C0-C1', 'C2-C3']:
+            self.assertLess(order[name], order['v1'])
+        for name in ['C6', 'C7', 'C8', 'C6-C0']:
+            self.assertGreater(order[name], order['v1'])
+            self.assertLess(order[name], order['v2'])
+        self.assertGreater(order['C9'], order['v2'])
+
+        # Lines without dependencies between them still run in parallel
+        self.assertGreater(api.max_in_flight, 1)
+
+    def test_concurrent_import_records_same_results_as_sequential_import(self):
+        _, sequential_results = self.import_file(num_workers=1)
+        _, concurrent_results = self.import_file(num_workers=8)
+        sequential_state = sequential_results.get_state()
+        concurrent_state = concurrent_results.get_state()
+        self.assertEqual(concurrent_state['count'], sequential_state['count'])
+        self.assertEqual(sorted(concurrent_state['counts']), sorted(sequential_state['counts']))
+        self.assertEqual(sorted(concurrent_state['results']), sorted(sequential_state['results']))
+        self.assertEqual(concurrent_results.get_detailed_summary(), sequential_results.get_detailed_summary())
+
+
+class OclExistenceCacheTest(unittest.TestCase):
+
+    SOURCE_URL = '/orgs/PEPFAR/sources/MER/'
+    CONCEPT_URL = '/orgs/PEPFAR/sources/MER/concepts/C1/'
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'existence-cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_only_owners_and_repositories_are_saved(self):
+        existence_cache = OclExistenceCache(path=self.cache_path)
+        existence_cache.set('/orgs/PEPFAR/', True)
+        existence_cache.set(self.SOURCE_URL, True)
+        existence_cache.set(self.CONCEPT_URL, False)
+        self.assertFalse(existence_cache.get(self.CONCEPT_URL))
+        existence_cache.save()
+
+        existence_cache = OclExistenceCache(path=self.cache_path)
+        self.assertTrue(existence_cache.get('/orgs/PEPFAR/'))
+        self.assertTrue(existence_cache.get(self.SOURCE_URL))
+        self.assertIsNone(existence_cache.get(self.CONCEPT_URL))
+
+    def test_existence_index_takes_precedence_over_saved_results(self):
+        existence_cache = OclExistenceCache(path=self.cache_path)
+        existence_cache.set(self.SOURCE_URL, False)
+        existence_cache.save()
+
+        # The repository has been created since the cache was saved
+        existence_index = OclExistenceIndex()
+        existence_index.add_repo_export(self.SOURCE_URL, {}, is_current=True)
+        importer = OclFlexImporter(
+            file_path='', api_url_root='https://api.example.org', api_token='token', verbosity=0,
+            http_client=StubOclApi(), existence_index=existence_index,
+            existence_cache=OclExistenceCache(path=self.cache_path))
+        self.assertTrue(importer.does_object_exist(self.SOURCE_URL))
+
+        # Results of this import take precedence over the index
+        importer.existence_cache.set(self.CONCEPT_URL, True)
+        self.assertTrue(importer.does_object_exist(self.CONCEPT_URL))
+        self.assertFalse(importer.does_object_exist('/orgs/PEPFAR/sources/MER/concepts/C2/'))
+
+class StubBulkImportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stub of the OCL bulk import API. Each uploaded part becomes a job that is pending on the first poll and then
+    reports a 201 result for each line, unless the part includes a line with the id 'FAIL', which fails the job.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status_code, content=None):
+        body = json.dumps(content) if content is not None else ''
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        lines = [json.loads(line) for line in self.rfile.read(int(self.headers['Content-Length'])).splitlines()]
+        with self.server.lock:
+            task_id = 'task-%s' % len(self.server.parts)
+            self.server.parts.append(lines)
+            self.server.num_polls[task_id] = 0
+        self.send_json(202, {'task': task_id})
+
+    def do_GET(self):
+        task_id = parse_qs(urlparse(self.path).query)['task'][0]
+        with self.server.lock:
+            lines = self.server.parts[int(task_id.split('-')[1])]
+            self.server.num_polls[task_id] += 1
+            is_pending = self.server.num_polls[task_id] == 1
+        if is_pending:
+            self.send_json(202)
+        elif any(line['id'] == 'FAIL' for line in lines):
+            self.send_json(200, {'state': 'FAILURE', 'task': task_id})
+        else:
+            results = {}
+            for line in lines:
+                repo_url = '/orgs/%s/sources/%s/' % (line['owner'], line['source'])
+                results.setdefault(repo_url, {}).setdefault('new', {}).setdefault('201', []).append(
+                    {'obj_url': '%sconcepts/%s/' % (repo_url, line['id']), 'http_method': 'POST'})
+            self.send_json(200, {'state': 'SUCCESS', 'task': task_id, 'results': results})
+
+
+class OclBulkImporterTest(unittest.TestCase):
+
+    NUM_CONCEPTS = 10
+    SOURCE_URL = '/orgs/PEPFAR/sources/MER/'
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.temp_dir, 'import.json')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubBulkImportHandler)
+        self.server.lock = threading.Lock()
+        self.server.parts = []
+        self.server.num_polls = {}
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def write_import_file(self, concept_ids):
+        with open(self.file_path, 'wb') as import_file:
+            for concept_id in concept_ids:
+                import_file.write(json.dumps({
+                    'type': 'Concept', 'id': concept_id, 'concept_class': 'Indicator', 'datatype': 'None',
+                    'owner': 'PEPFAR', 'owner_type': 'Organization', 'source': 'MER',
+                    'names': [{'name': 'Concept %s' % concept_id, 'locale': 'en'}]}) + '\n')
+
+    def get_importer(self, max_part_size):
+        importer = OclBulkImporter(
+            file_path=self.file_path, api_url_root='https://api.example.org', api_token='token', verbosity=0,
+            http_client=DatimHttpClient(max_retries=0, verbosity=0),
+            results_detail_log=os.path.join(self.temp_dir, 'results.json'),
+            bulk_import_url='http://127.0.0.1:%s/manage/bulkimport/' % self.server.server_port,
+            max_part_size=max_part_size)
+        importer.POLL_INTERVAL = 0.01
+        return importer
+
+    def test_parts_are_imported_in_order_and_results_are_recorded(self):
+        concept_ids = ['C%s' % i for i in range(self.NUM_CONCEPTS)]
+        self.write_import_file(concept_ids)
+        with open(self.file_path, 'rb') as import_file:
+            line_size = len(import_file.readline())
+        importer = self.get_importer(max_part_size=line_size * 3)
+        self.assertEqual(importer.process(), self.NUM_CONCEPTS)
+
+        # Each part is uploaded after the job of the previous part completed, after a pending (202) poll
+        self.assertEqual([len(part) for part in self.server.parts], [3, 3, 3, 1])
+        self.assertEqual([line['id'] for part in self.server.parts for line in part], concept_ids)
+        self.assertEqual(sorted(self.server.num_polls.values()), [2, 2, 2, 2])
+
+        self.assertEqual(importer.import_results.count, self.NUM_CONCEPTS)
+        self.assertTrue(importer.import_results.has(root_key=self.SOURCE_URL, limit_to_success_codes=True))
+        details = list(importer.import_results.iter_details(root_key=self.SOURCE_URL))
+        self.assertEqual([detail['status_code'] for detail in details], [201] * self.NUM_CONCEPTS)
+        self.assertEqual(details[0]['detail'], 'POST %sconcepts/C0/' % self.SOURCE_URL)
+
+    def test_failed_job_stops_import(self):
+        self.write_import_file(['C000', 'FAIL', 'C002', 'C003'])
+        with open(self.file_path, 'rb') as import_file:
+            line_size = len(import_file.readline())
+        importer = self.get_importer(max_part_size=line_size * 2)
+        self.assertRaises(BulkImportError, importer.process)
+
+        # The part after the failed job is not uploaded
+        self.assertEqual(len(self.server.parts), 1)
+        self.assertEqual(importer.import_results.count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()